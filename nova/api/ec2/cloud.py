@@ -23,6 +23,7 @@ datastore.
 """
 
 import base64
+import functools
 import netaddr
 import os
 import re
@@ -54,10 +55,36 @@ from nova.image import s3
 FLAGS = flags.FLAGS
 flags.DECLARE('dhcp_domain', 'nova.network.manager')
 flags.DECLARE('service_down_time', 'nova.scheduler.driver')
+flags.DEFINE_integer('metadata_cache_ttl', 15,
+                     'Seconds a metadata response is cached per fixed ip '
+                     '(0 disables the cache)')
 
 LOG = logging.getLogger("nova.api.cloud")
 
 
+class MetadataCache(utils.TTLCache):
+    """Metadata responses by fixed ip, kept for FLAGS.metadata_cache_ttl.
+
+    Instances fetch their metadata many times while booting, so this saves
+    rebuilding it from the database on every request.  The values are
+    (<instance id>, <metadata>)."""
+
+    def __init__(self):
+        super(MetadataCache, self).__init__(FLAGS['metadata_cache_ttl'])
+
+    def invalidate(self, instance_id=None):
+        """Drop the cached metadata of an instance, or of all of them."""
+        if instance_id is None:
+            super(MetadataCache, self).invalidate()
+            return
+        for address, (cached_instance_id, data) in self.items():
+            if cached_instance_id == instance_id:
+                super(MetadataCache, self).invalidate(address)
+
+
+metadata_cache = MetadataCache()
+
+
 def _gen_key(context, user_id, key_name):
     """Generate a key
 
@@ -358,22 +385,58 @@ class CloudController(object):
 
         return mappings
 
-    def get_metadata(self, address):
-        ctxt = context.get_admin_context()
+    def _get_instance_id_by_address(self, context, address):
+        """Find the instance a fixed ip belongs to, through the fixed ip
+        itself where possible rather than filtering all instances."""
+        try:
+            fixed_ip = db.fixed_ip_get_by_address(context, address)
+            if fixed_ip['instance_id'] is not None:
+                return fixed_ip['instance_id']
+        except exception.NotFound:
+            pass
         search_opts = {'fixed_ip': address, 'deleted': False}
         try:
-            instance_ref = self.compute_api.get_all(ctxt,
+            instance_ref = self.compute_api.get_all(context,
                     search_opts=search_opts)
         except exception.NotFound:
             instance_ref = None
         if not instance_ref:
             return None
+        return instance_ref[0]['id']
+
+    def get_metadata(self, address):
+        """Returns the metadata of the instance with a fixed ip.
+
+        The 'mpi' value is returned as a callable, since it is costly and
+        seldom asked for; it is computed by calling it."""
+        ctxt = context.get_admin_context()
+        entry = metadata_cache.get(address)
+        if entry is not None:
+            # NOTE: the address may have been given to another instance
+            #       since, by a service which could not invalidate this
+            #       process' cache, so check who has it now
+            try:
+                fixed_ip = db.fixed_ip_get_by_address(ctxt, address)
+                instance_id = fixed_ip['instance_id']
+            except exception.NotFound:
+                instance_id = None
+            if instance_id == entry[0]:
+                return entry[1]
+            metadata_cache.invalidate(entry[0])
+
+        instance_id = self._get_instance_id_by_address(ctxt, address)
+        if instance_id is None:
+            return None
 
         # This ensures that all attributes of the instance
         # are populated.
-        instance_ref = db.instance_get(ctxt, instance_ref[0]['id'])
+        try:
+            instance_ref = db.instance_get(ctxt, instance_id)
+        except exception.NotFound:
+            return None
 
-        mpi = self._get_mpi_data(ctxt, instance_ref['project_id'])
+        mpi = functools.partial(self._get_mpi_data, ctxt,
+                                instance_ref['project_id'])
         hostname = "%s.%s" % (instance_ref['hostname'], FLAGS.dhcp_domain)
         host = instance_ref['host']
         availability_zone = self._get_availability_zone_by_host(ctxt, host)
@@ -424,6 +487,7 @@ class CloudController(object):
             data['ancestor-ami-ids'] = []
         if False:  # TODO(vish): store product codes
             data['product-codes'] = []
+        metadata_cache.set(address, (instance_ref['id'], data))
         return data
 
     def describe_availability_zones(self, context, **kwargs):
@@ -1410,11 +1474,13 @@ class CloudController(object):
         self.compute_api.associate_floating_ip(context,
                                                instance_id=instance_id,
                                                address=public_ip)
+        metadata_cache.invalidate(instance_id)
         return {'associateResponse': ["Address associated."]}
 
     def disassociate_address(self, context, public_ip, **kwargs):
         LOG.audit(_("Disassociate address %s"), public_ip, context=context)
         self.network_api.disassociate_floating_ip(context, address=public_ip)
+        metadata_cache.invalidate()
         return {'disassociateResponse': ["Address disassociated."]}
 
     def run_instances(self, context, **kwargs):
@@ -1472,6 +1538,8 @@ class CloudController(object):
         instance_id is a kwarg so its name cannot be modified."""
         LOG.debug(_("Going to start terminating instances"))
         self._do_instances(self.compute_api.delete, context, instance_id)
+        for ec2_id in instance_id:
+            metadata_cache.invalidate(ec2utils.ec2_id_to_id(ec2_id))
         return True
 
     def reboot_instances(self, context, instance_id, **kwargs):
@@ -1514,6 +1582,7 @@ class CloudController(object):
             instance_id = ec2utils.ec2_id_to_id(instance_id)
             self.compute_api.update(context, instance_id=instance_id,
                                     **changes)
+            metadata_cache.invalidate(instance_id)
         return True
 
     @staticmethod
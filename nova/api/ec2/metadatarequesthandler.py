@@ -46,7 +46,9 @@ class MetadataRequestHandler(wsgi.Application):
                 if key == '_name':
                     continue
                 output += key
-                if isinstance(data[key], dict):
+                if callable(data[key]):
+                    output += '/'
+                elif isinstance(data[key], dict):
                     if '_name' in data[key]:
                         output += '=' + str(data[key]['_name'])
                     else:
@@ -67,6 +69,10 @@ class MetadataRequestHandler(wsgi.Application):
                     return data
                 if not item in data:
                     return None
+                if callable(data[item]):
+                    # NOTE: costly values are computed only once asked
+                    # for, and kept with the (cached) metadata
+                    data[item] = data[item]()
                 data = data[item]
         return data
 
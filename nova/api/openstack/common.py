@@ -167,26 +167,19 @@ def limited(items, request, max_limit=FLAGS.osapi_max_limit):
     return items[offset:range_end]
 
 
-def limited_by_marker(items, request, max_limit=FLAGS.osapi_max_limit):
-    """Return a slice of items according to the requested marker and limit."""
+def get_limit_and_marker(request, max_limit=FLAGS.osapi_max_limit):
+    """Return a (limit, marker) tuple for keyset pagination of a request.
+
+    limit defaults to, and is capped at, max_limit.  marker is None if the
+    request didn't specify one.
+    """
     params = get_pagination_params(request)
 
     limit = params.get('limit', max_limit)
-    marker = params.get('marker')
-
-    limit = min(max_limit, limit)
-    start_index = 0
-    if marker:
-        start_index = -1
-        for i, item in enumerate(items):
-            if item['id'] == marker:
-                start_index = i + 1
-                break
-        if start_index < 0:
-            msg = _('marker [%s] not found') % marker
-            raise webob.exc.HTTPBadRequest(explanation=msg)
-    range_end = start_index + limit
-    return items[start_index:range_end]
+    limit = min(max_limit, limit or max_limit)
+    marker = params.get('marker') or None
+
+    return limit, marker
 
 
 def get_id_from_href(href):
@@ -66,6 +66,7 @@ class QuotaSetsController(object):
                     db.quota_create(context, project_id, key, value)
                 except exception.AdminRequired:
                     return webob.Response(status_int=403)
+        quota.invalidate_project_quotas(project_id)
         return {'quota_set': quota.get_project_quotas(context, project_id)}
 
     def defaults(self, req, id):
@@ -91,6 +91,9 @@ class Controller(object):
     def _build_list(self, req, instances, is_detail=False):
         raise NotImplementedError()
 
+    def _get_limit_and_marker(self, req):
+        raise NotImplementedError()
+
     def _limit_items(self, items, req):
         raise NotImplementedError()
 
@@ -154,8 +157,15 @@ class Controller(object):
                 # No 'changes-since', so we only want non-deleted servers
                 search_opts['deleted'] = False
 
-        instance_list = self.compute_api.get_all(context,
-                                                 search_opts=search_opts)
+        limit, marker = self._get_limit_and_marker(req)
+        try:
+            instance_list = self.compute_api.get_all(context,
+                                                     search_opts=search_opts,
+                                                     limit=limit,
+                                                     marker=marker)
+        except exception.MarkerNotFound:
+            msg = _('marker [%s] not found') % marker
+            raise exc.HTTPBadRequest(explanation=msg)
 
         limited_list = self._limit_items(instance_list, req)
         return self._build_list(req, limited_list, is_detail=is_detail)
@@ -816,6 +826,11 @@ class ControllerV10(Controller):
         builder = views_servers.ViewBuilderV10(context, addresses)
         return builder.build_list(instances, is_detail=is_detail)
 
+    def _get_limit_and_marker(self, req):
+        # The 1.0 API pages by offset, which can't be done with a keyset
+        # query, so the whole listing is fetched and sliced afterwards.
+        return None, None
+
     def _limit_items(self, items, req):
         return common.limited(items, req)
 
@@ -941,8 +956,14 @@ class ControllerV11(Controller):
         self.compute_api.set_admin_password(context, id, password)
         return webob.Response(status_int=202)
 
+    def _get_limit_and_marker(self, req):
+        return common.get_limit_and_marker(req)
+
     def _limit_items(self, items, req):
-        return common.limited_by_marker(items, req)
+        # compute already paged the local instances, but child zones may
+        # have added their own on top
+        limit = self._get_limit_and_marker(req)[0]
+        return items[:limit]
 
     def _validate_metadata(self, metadata):
         """Ensure that we can work with the metadata given."""
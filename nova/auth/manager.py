@@ -23,6 +23,7 @@ Keystone is the recommended solution for auth management.
 Nova authentication management
 """
 
+import hashlib
 import os
 import shutil
 import string  # pylint: disable=W0402
@@ -75,6 +76,17 @@ flags.DEFINE_string('credential_rc_file', '%src',
                     'replaced by name of the region (nova by default)')
 flags.DEFINE_string('auth_driver', 'nova.auth.dbdriver.DbDriver',
                     'Driver that auth manager uses')
+flags.DEFINE_string('auth_cache_driver', 'nova.auth.manager.CredentialCache',
+                    'Class that auth manager caches lookups with')
+flags.DEFINE_integer('auth_cache_ttl', 0,
+                     'seconds to cache users, projects and admin status '
+                     'looked up by the auth manager, 0 disables the cache')
+flags.DEFINE_integer('auth_cache_size', 1024,
+                     'number of lookups kept in the in-process auth cache')
+flags.DEFINE_bool('auth_cache_memcache', False,
+                  'also keep cached auth lookups in memcache, so they are '
+                  'shared between api processes; users and their secrets '
+                  'are only ever cached in process')
 
 LOG = logging.getLogger('nova.auth.manager')
 
@@ -199,6 +211,54 @@ class Project(AuthBase):
         return "Project('%s', '%s')" % (self.id, self.name)
 
 
+class CredentialCache(object):
+    """LRU cache of auth lookups, kept for FLAGS.auth_cache_ttl.
+
+    Every api request looks up the same user, project and admin status, so
+    this saves several driver calls per request.  With auth_cache_memcache
+    the entries set as shared are also written to memcache, so they are
+    shared between api processes and survive falling out of the local
+    cache.  Anything holding a secret must not be shared.
+    """
+
+    def __init__(self, mc=None):
+        self.mc = mc
+        self.local = utils.TTLCache(FLAGS['auth_cache_ttl'],
+                                    FLAGS['auth_cache_size'])
+
+    def _mc_key(self, key):
+        return 'authcache-' + hashlib.md5(key).hexdigest()
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        if self.mc is None or not FLAGS.auth_cache_memcache:
+            return None
+        value = self.mc.get(self._mc_key(key))
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    def set(self, key, value, shared=True):
+        if FLAGS.auth_cache_ttl <= 0:
+            return
+        self.local.set(key, value)
+        if shared and self.mc is not None and FLAGS.auth_cache_memcache:
+            self.mc.set(self._mc_key(key), value, FLAGS.auth_cache_ttl)
+
+    def invalidate(self, key):
+        self.local.invalidate(key)
+        if self.mc is not None and FLAGS.auth_cache_memcache:
+            # NOTE: fakememcache has no delete, so clear it like
+            #       AuthManager._clear_mc_key does
+            self.mc.set(self._mc_key(key), None)
+
+    def clear(self):
+        """Drop every entry kept in this process."""
+        self.local.invalidate()
+
+
 class AuthManager(object):
     """Manager Singleton for dealing with Users, Projects, and Keypairs
 
@@ -213,6 +273,7 @@ class AuthManager(object):
 
     _instance = None
     mc = None
+    cache = None
 
     def __new__(cls, *args, **kwargs):
         """Returns the AuthManager singleton"""
@@ -231,6 +292,12 @@ class AuthManager(object):
             self.driver = utils.import_class(driver or FLAGS.auth_driver)
         if AuthManager.mc is None:
             AuthManager.mc = memcache.Client(FLAGS.memcached_servers, debug=0)
+        if AuthManager.cache is None:
+            cache_class = utils.import_class(FLAGS.auth_cache_driver)
+            AuthManager.cache = cache_class(AuthManager.mc)
+        if not hasattr(self, 'signers'):
+            # { <secret> : <signer.Signer> }
+            self.signers = {}
 
     def authenticate(self, access, signature, params, verb='GET',
                      server_string='127.0.0.1:8773', path='/',
@@ -305,7 +372,7 @@ class AuthManager(object):
             raise exception.ProjectMembershipNotFound(project_id=pjid,
                                                       user_id=uid)
         if check_type == 's3':
-            sign = signer.Signer(user.secret.encode())
+            sign = self._get_signer(user.secret)
             expected_signature = sign.s3_authorization(headers, verb, path)
             LOG.debug(_('user.secret: %s'), user.secret)
             LOG.debug(_('expected_signature: %s'), expected_signature)
@@ -315,10 +382,9 @@ class AuthManager(object):
                 raise exception.InvalidSignature(signature=signature,
                                                  user=user)
         elif check_type == 'ec2':
-            # NOTE(vish): hmac can't handle unicode, so encode ensures that
-            #             secret isn't unicode
-            expected_signature = signer.Signer(user.secret.encode()).generate(
-                    params, verb, server_string, path)
+            sign = self._get_signer(user.secret)
+            expected_signature = sign.generate(params, verb, server_string,
+                                               path)
             LOG.debug(_('user.secret: %s'), user.secret)
             LOG.debug(_('expected_signature: %s'), expected_signature)
             LOG.debug(_('signature: %s'), signature)
@@ -326,9 +392,8 @@ class AuthManager(object):
                 (addr_str, port_str) = utils.parse_server_string(server_string)
                 # If the given server_string contains port num, try without it.
                 if port_str != '':
-                    host_only_signature = signer.Signer(
-                        user.secret.encode()).generate(params, verb,
-                                                       addr_str, path)
+                    host_only_signature = sign.generate(params, verb,
+                                                        addr_str, path)
                     LOG.debug(_('host_only_signature: %s'),
                               host_only_signature)
                     if signature == host_only_signature:
@@ -338,6 +403,31 @@ class AuthManager(object):
                                                  user=user)
         return (user, project)
 
+    def _get_signer(self, secret):
+        """Return a signer for secret, reusing the keyed hmacs."""
+        sign = self.signers.get(secret)
+        if sign is None:
+            if len(self.signers) >= FLAGS.auth_cache_size:
+                self.signers.clear()
+            # NOTE(vish): hmac can't handle unicode, so encode ensures that
+            #             secret isn't unicode
+            sign = signer.Signer(secret.encode())
+            self.signers[secret] = sign
+        return sign
+
+    def _invalidate_user(self, uid, user_dict):
+        """Drop the cached lookups of a user that has changed.
+
+        user_dict is the user as it was before the change, so the entry
+        under its old access key goes too.
+        """
+        if user_dict:
+            self.cache.invalidate('access-%s' % user_dict['access'])
+        self.cache.invalidate('admin-%s' % uid)
+
+    def _invalidate_project(self, pid):
+        self.cache.invalidate('project-%s' % pid)
+
     def get_access_key(self, user, project):
         """Get an access key that includes user and project"""
         if not isinstance(user, User):
@@ -371,13 +461,20 @@ class AuthManager(object):
         @rtype: bool
         @return: True for admin.
         """
+        cache_key = 'admin-%s' % User.safe_id(user)
+        admin = self.cache.get(cache_key)
+        if admin is not None:
+            return admin
         if not isinstance(user, User):
             user = self.get_user(user)
-        if self.is_superuser(user):
-            return True
-        for role in FLAGS.global_roles:
-            if self.has_role(user, role):
-                return True
+        admin = bool(self.is_superuser(user))
+        if not admin:
+            for role in FLAGS.global_roles:
+                if self.has_role(user, role):
+                    admin = True
+                    break
+        self.cache.set(cache_key, admin)
+        return admin
 
     def _build_mc_key(self, user, role, project=None):
         key_parts = ['rolecache', User.safe_id(user), str(role)]
@@ -474,6 +571,7 @@ class AuthManager(object):
         with self.driver() as drv:
             self._clear_mc_key(uid, role, pid)
             drv.add_role(uid, role, pid)
+        self.cache.invalidate('admin-%s' % uid)
 
     def remove_role(self, user, role, project=None):
         """Removes role for user
@@ -503,6 +601,7 @@ class AuthManager(object):
         with self.driver() as drv:
             self._clear_mc_key(uid, role, pid)
             drv.remove_role(uid, role, pid)
+        self.cache.invalidate('admin-%s' % uid)
 
     @staticmethod
     def get_roles(project_roles=True):
@@ -528,10 +627,15 @@ class AuthManager(object):
 
     def get_project(self, pid):
         """Get project object by id"""
-        with self.driver() as drv:
-            project_dict = drv.get_project(pid)
+        cache_key = 'project-%s' % pid
+        project_dict = self.cache.get(cache_key)
+        if project_dict is None:
+            with self.driver() as drv:
+                project_dict = drv.get_project(pid)
             if project_dict:
-                return Project(**project_dict)
+                self.cache.set(cache_key, project_dict)
+        if project_dict:
+            return Project(**project_dict)
 
     def get_projects(self, user=None):
         """Retrieves list of projects, optionally filtered by user"""
@@ -596,6 +700,7 @@ class AuthManager(object):
             drv.modify_project(Project.safe_id(project),
                                manager_user,
                                description)
+        self._invalidate_project(Project.safe_id(project))
 
     def add_to_project(self, user, project):
         """Add user to project"""
@@ -603,8 +708,10 @@ class AuthManager(object):
         pid = Project.safe_id(project)
         LOG.audit(_("Adding user %(uid)s to project %(pid)s") % locals())
         with self.driver() as drv:
-            return drv.add_to_project(User.safe_id(user),
-                                      Project.safe_id(project))
+            result = drv.add_to_project(User.safe_id(user),
+                                        Project.safe_id(project))
+        self._invalidate_project(pid)
+        return result
 
     def is_project_manager(self, user, project):
         """Checks if user is project manager"""
@@ -624,7 +731,9 @@ class AuthManager(object):
         pid = Project.safe_id(project)
         LOG.audit(_("Remove user %(uid)s from project %(pid)s") % locals())
         with self.driver() as drv:
-            return drv.remove_from_project(uid, pid)
+            result = drv.remove_from_project(uid, pid)
+        self._invalidate_project(pid)
+        return result
 
     @staticmethod
     def get_project_vpn_data(project):
@@ -655,6 +764,7 @@ class AuthManager(object):
         LOG.audit(_("Deleting project %s"), Project.safe_id(project))
         with self.driver() as drv:
             drv.delete_project(Project.safe_id(project))
+        self._invalidate_project(Project.safe_id(project))
 
     def get_user(self, uid):
         """Retrieves a user by id"""
@@ -665,10 +775,16 @@ class AuthManager(object):
 
     def get_user_from_access_key(self, access_key):
         """Retrieves a user by access key"""
-        with self.driver() as drv:
-            user_dict = drv.get_user_from_access_key(access_key)
+        cache_key = 'access-%s' % access_key
+        user_dict = self.cache.get(cache_key)
+        if user_dict is None:
+            with self.driver() as drv:
+                user_dict = drv.get_user_from_access_key(access_key)
             if user_dict:
-                return User(**user_dict)
+                # NOTE: the user holds its secret key, keep it off memcache
+                self.cache.set(cache_key, user_dict, shared=False)
+        if user_dict:
+            return User(**user_dict)
 
     def get_users(self):
         """Retrieves a list of all users"""
@@ -723,7 +839,9 @@ class AuthManager(object):
         db.key_pair_destroy_all_by_user(context.get_admin_context(),
                                         uid)
         with self.driver() as drv:
+            user_dict = drv.get_user(uid)
             drv.delete_user(uid)
+        self._invalidate_user(uid, user_dict)
 
     def modify_user(self, user, access_key=None, secret_key=None, admin=None):
         """Modify credentials for a user"""
@@ -736,7 +854,9 @@ class AuthManager(object):
             LOG.audit(_("Admin status set to %(admin)r"
                     " for user %(uid)s") % locals())
         with self.driver() as drv:
+            user_dict = drv.get_user(uid)
             drv.modify_user(uid, access_key, secret_key, admin)
+        self._invalidate_user(uid, user_dict)
 
     def get_credentials(self, user, project=None, use_dmz=True):
         """Get credential zip for user in project"""
@@ -653,10 +653,12 @@ class API(base.Base):
         # ...and finally we tell these nodes to refresh their view of this
         # particular security group.
         for host in hosts:
-            rpc.cast(context,
-                     self.db.queue_get_for(context, FLAGS.compute_topic, host),
-                     {"method": "refresh_security_group_members",
-                      "args": {"security_group_id": group_id}})
+            for group_id in group_ids:
+                rpc.cast(context,
+                         self.db.queue_get_for(context, FLAGS.compute_topic,
+                                               host),
+                         {"method": "refresh_security_group_members",
+                          "args": {"security_group_id": group_id}})
 
     def trigger_provider_fw_rules_refresh(self, context):
         """Called when a rule is added to or removed from a security_group"""
@@ -924,7 +926,7 @@ class API(base.Base):
         """
         return self.get(context, instance_id)
 
-    def get_all(self, context, search_opts=None):
+    def get_all(self, context, search_opts=None, limit=None, marker=None):
         """Get all instances filtered by one of the given parameters.
 
         If there is no filter and the context is an admin, it will retreive
@@ -932,6 +934,9 @@ class API(base.Base):
 
         Deleted instances will be returned by default, unless there is a
         search option that says otherwise.
+
+        limit and marker page through the instances, newest first; marker
+        is the id of the last instance of the previous page.
         """
 
         if search_opts is None:
@@ -980,17 +985,24 @@ class API(base.Base):
                     remap_object(value)
 
         local_zone_only = search_opts.get('local_zone_only', False)
+        zones = None
+        if not local_zone_only:
+            zones = self.db.zone_get_all(context.elevated())
 
-        instances = self._get_instances_by_filters(context, filters)
+        if not zones:
+            return self._get_instances_by_filters(context, filters,
+                                                  limit=limit, marker=marker)
 
-        if local_zone_only:
-            return instances
+        # NOTE: the marker may be the id of an instance in a child zone and
+        #       the children don't page, so the combined listing is sliced
+        instances = self._get_instances_by_filters(context, filters)
 
         # Recurse zones. Send along the un-modified search options we received.
         children = scheduler_api.call_zone_method(context,
                 "list",
                 errors_to_ignore=[novaclient.exceptions.NotFound],
                 novaclient_collection_name="servers",
+                zones=zones,
                 search_opts=search_opts)
 
         for zone, servers in children:
@@ -1002,9 +1014,25 @@ class API(base.Base):
                 server._info['_is_precooked'] = True
                 instances.append(server._info)
 
+        return self._limited_by_marker(instances, limit, marker)
+
+    @staticmethod
+    def _limited_by_marker(instances, limit, marker):
+        """Return the instances after the one with id marker, at most
+        limit of them."""
+        if marker is not None:
+            for i, instance in enumerate(instances):
+                if instance['id'] == marker:
+                    instances = instances[i + 1:]
+                    break
+            else:
+                raise exception.MarkerNotFound(marker=marker)
+        if limit is not None:
+            instances = instances[:limit]
         return instances
 
-    def _get_instances_by_filters(self, context, filters):
+    def _get_instances_by_filters(self, context, filters, limit=None,
+                                  marker=None):
         ids = None
         if 'ip6' in filters or 'ip' in filters:
             res = self.network_api.get_instance_uuids_by_ip_filter(context,
@@ -1014,7 +1042,8 @@ class API(base.Base):
             uuids = set([r['instance_uuid'] for r in res])
             filters['uuid'] = uuids
 
-        return self.db.instance_get_all_by_filters(context, filters)
+        return self.db.instance_get_all_by_filters(context, filters,
+                                                   limit=limit, marker=marker)
 
     def _cast_compute_message(self, method, context, instance_id, host=None,
                               params=None):
@@ -1340,6 +1369,12 @@ class API(base.Base):
         return self._call_compute_message_for_host("host_power_action",
                 context, host=host, params={"action": action})
 
+    def prefetch_images(self, context, host, image_ids):
+        """Have host fetch images into its image cache ahead of a launch."""
+        queue = self.db.queue_get_for(context, FLAGS.compute_topic, host)
+        rpc.cast(context, queue, {'method': 'prefetch_images',
+                                  'args': {'image_ids': image_ids}})
+
     @scheduler_api.reroute_compute("diagnostics")
     def get_diagnostics(self, context, instance_id):
         """Retrieve diagnostics for the given instance."""
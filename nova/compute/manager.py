@@ -153,6 +153,23 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.driver.init_host(host=self.host)
         context = nova.context.get_admin_context()
         instances = self.db.instance_get_all_by_host(context, self.host)
+        # NOTE: Firewall rules for all the instances are written out in
+        #       one go once they have all been set up. Guests are only
+        #       started after that so none of them runs without its rules.
+        self.driver.filter_defer_apply_on()
+        try:
+            to_reboot = self._init_instances(context, instances)
+        finally:
+            self.driver.filter_defer_apply_off()
+        for instance in to_reboot:
+            LOG.info(_('Rebooting instance %s after nova-compute restart.'),
+                     instance['name'])
+            self.reboot_instance(context, instance['id'])
+
+    def _init_instances(self, context, instances):
+        """Restore the firewall rules of this host's running instances on
+        startup and return the instances that need to be rebooted."""
+        to_reboot = []
         for instance in instances:
             inst_name = instance['name']
             db_state = instance['power_state']
@@ -166,9 +183,7 @@ class ComputeManager(manager.SchedulerDependentManager):
 
             if (expect_running and FLAGS.resume_guests_state_on_host_boot)\
                or FLAGS.start_guests_on_host_boot:
-                LOG.info(_('Rebooting instance %(inst_name)s after '
-                            'nova-compute restart.'), locals())
-                self.reboot_instance(context, instance['id'])
+                to_reboot.append(instance)
             elif drv_state == power_state.RUNNING:
                 # Hyper-V and VMWareAPI drivers will raise an exception
                 try:
@@ -178,6 +193,7 @@ class ComputeManager(manager.SchedulerDependentManager):
                 except NotImplementedError:
                     LOG.warning(_('Hypervisor driver does not '
                             'support firewall rules'))
+        return to_reboot
 
     def _get_power_state(self, context, instance):
         """Retrieve the power state for the given instance."""
@@ -1196,6 +1212,11 @@ class ComputeManager(manager.SchedulerDependentManager):
         """Sets the specified host's ability to accept new instances."""
         return self.driver.set_host_enabled(host, enabled)
 
+    @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
+    def prefetch_images(self, context, image_ids):
+        """Fetch images into this host's image cache."""
+        self.driver.prefetch_images(context, image_ids)
+
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     def get_diagnostics(self, context, instance_id):
         """Retrieve diagnostics for an instance on this host."""
@@ -1792,13 +1813,31 @@ class ComputeManager(manager.SchedulerDependentManager):
             error_list.append(ex)
 
         try:
-            self._sync_power_states(context)
+            self.driver.manage_image_cache(context)
+        except Exception as ex:
+            LOG.warning(_("Error during manage_image_cache: %s"),
+                        unicode(ex))
+            error_list.append(ex)
+
+        # NOTE: One snapshot of this host's instances is shared by the
+        #       tasks below instead of each of them fetching its own.
+        try:
+            db_instances = self.db.instance_get_all_by_host(context,
+                                                            self.host)
+        except Exception as ex:
+            LOG.warning(_("Error fetching instances for periodic tasks: %s"),
+                        unicode(ex))
+            error_list.append(ex)
+            return error_list
+
+        try:
+            self._sync_power_states(context, db_instances)
         except Exception as ex:
             LOG.warning(_("Error during power_state sync: %s"), unicode(ex))
             error_list.append(ex)
 
         try:
-            self._reclaim_queued_deletes(context)
+            self._reclaim_queued_deletes(context, db_instances)
         except Exception as ex:
             LOG.warning(_("Error during reclamation of queued deletes: %s"),
                         unicode(ex))
@@ -1816,19 +1855,21 @@ class ComputeManager(manager.SchedulerDependentManager):
             self.update_service_capabilities(
                 self.driver.get_host_stats(refresh=True))
 
-    def _sync_power_states(self, context):
+    def _sync_power_states(self, context, db_instances=None):
         """Align power states between the database and the hypervisor.
 
         The hypervisor is authoritative for the power_state data, so we
         simply loop over all known instances for this host and update the
         power_state according to the hypervisor. If the instance is not found
         then it will be set to power_state.NOSTATE, because it doesn't exist
-        on the hypervisor.
+        on the hypervisor. All the changes are written in one batch.
 
         """
         vm_instances = self.driver.list_instances_detail()
         vm_instances = dict((vm.name, vm) for vm in vm_instances)
-        db_instances = self.db.instance_get_all_by_host(context, self.host)
+        if db_instances is None:
+            db_instances = self.db.instance_get_all_by_host(context,
+                                                            self.host)
 
         num_vm_instances = len(vm_instances)
         num_db_instances = len(db_instances)
@@ -1837,6 +1878,7 @@ class ComputeManager(manager.SchedulerDependentManager):
             LOG.info(_("Found %(num_db_instances)s in the database and "
                        "%(num_vm_instances)s on the hypervisor.") % locals())
 
+        power_states = {}
         for db_instance in db_instances:
             name = db_instance["name"]
             db_power_state = db_instance['power_state']
@@ -1850,14 +1892,16 @@ class ComputeManager(manager.SchedulerDependentManager):
             if vm_power_state == db_power_state:
                 continue
 
-            self._instance_update(context,
-                                  db_instance["id"],
-                                  power_state=vm_power_state)
+            power_states[db_instance["id"]] = vm_power_state
 
-    def _reclaim_queued_deletes(self, context):
+        if power_states:
+            self.db.instance_update_power_states(context, power_states)
+
+    def _reclaim_queued_deletes(self, context, instances=None):
         """Reclaim instances that are queued for deletion."""
 
-        instances = self.db.instance_get_all_by_host(context, self.host)
+        if instances is None:
+            instances = self.db.instance_get_all_by_host(context, self.host)
 
         queue_time = datetime.timedelta(
                          seconds=FLAGS.reclaim_instance_interval)
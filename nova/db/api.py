@@ -342,14 +342,28 @@ def fixed_ip_associate(context, address, instance_id, network_id=None,
                                    reserved)
 
 
-def fixed_ip_associate_pool(context, network_id, instance_id=None, host=None):
+def fixed_ip_associate_pool(context, network_id, instance_id=None, host=None,
+                            address=None):
     """Find free ip in network and associate it to instance or host.
 
+    If address is given, only that ip is considered.
     Raises if one is not available.
 
     """
     return IMPL.fixed_ip_associate_pool(context, network_id,
-                                        instance_id, host)
+                                        instance_id, host, address)
+
+
+def fixed_ip_associate_addresses(context, network_id, instance_ids,
+                                 addresses):
+    """Associate free ips among addresses to instances in one transaction.
+
+    Addresses that are not free any more are skipped, so fewer instances
+    than given may get one.  Returns a dict of instance id to address.
+
+    """
+    return IMPL.fixed_ip_associate_addresses(context, network_id,
+                                             instance_ids, addresses)
 
 
 def fixed_ip_create(context, values):
@@ -357,6 +371,11 @@ def fixed_ip_create(context, values):
     return IMPL.fixed_ip_create(context, values)
 
 
+def fixed_ip_bulk_create(context, ips):
+    """Create fixed ips from a list of values dictionaries."""
+    return IMPL.fixed_ip_bulk_create(context, ips)
+
+
 def fixed_ip_disassociate(context, address):
     """Disassociate a fixed ip from an instance by address."""
     return IMPL.fixed_ip_disassociate(context, address)
@@ -367,6 +386,11 @@ def fixed_ip_disassociate_all_by_timeout(context, host, time):
     return IMPL.fixed_ip_disassociate_all_by_timeout(context, host, time)
 
 
+def fixed_ip_get_free_by_network(context, network_id):
+    """Get the addresses of the unassociated fixed ips of a network."""
+    return IMPL.fixed_ip_get_free_by_network(context, network_id)
+
+
 def fixed_ip_get(context, id):
     """Get fixed ip by id or raise if it does not exist."""
     return IMPL.fixed_ip_get(context, id)
@@ -449,6 +473,12 @@ def virtual_interface_get_by_instance(context, instance_id):
     return IMPL.virtual_interface_get_by_instance(context, instance_id)
 
 
+def virtual_interface_get_first_network_ids(context, instance_ids):
+    """Gets a dict of instance id to the network id of its first vif."""
+    return IMPL.virtual_interface_get_first_network_ids(context,
+                                                        instance_ids)
+
+
 def virtual_interface_get_by_instance_and_network(context, instance_id,
                                                            network_id):
     """Gets all virtual interfaces for instance."""
@@ -477,6 +507,15 @@ def virtual_interface_get_all(context):
     return IMPL.virtual_interface_get_all(context)
 
 
+def virtual_interface_get_by_ip_filter(context, fixed_ip=None, ip=None):
+    """Gets the vifs that may have an ip matching the filters.
+
+    Returns None if the filters can't be narrowed in the database.
+
+    """
+    return IMPL.virtual_interface_get_by_ip_filter(context, fixed_ip, ip)
+
+
 ####################
 
 
@@ -515,9 +554,18 @@ def instance_get_all(context):
     return IMPL.instance_get_all(context)
 
 
-def instance_get_all_by_filters(context, filters):
-    """Get all instances that match all filters."""
-    return IMPL.instance_get_all_by_filters(context, filters)
+def instance_get_all_by_filters(context, filters, sort_key='created_at',
+                                sort_dir='desc', limit=None, marker=None):
+    """Get all instances that match all filters.
+
+    Results are ordered by sort_key then id.  If marker (an instance id) is
+    given only instances sorting after it are returned, and at most limit
+    instances are returned.
+    """
+    return IMPL.instance_get_all_by_filters(context, filters,
+                                            sort_key=sort_key,
+                                            sort_dir=sort_dir,
+                                            limit=limit, marker=marker)
 
 
 def instance_get_active_by_window(context, begin, end=None, project_id=None):
@@ -599,6 +647,15 @@ def instance_update(context, instance_id, values):
     return IMPL.instance_update(context, instance_id, values)
 
 
+def instance_update_power_states(context, power_states):
+    """Set the power_state of many instances at once.
+
+    power_states maps instance ids to their new power state.
+
+    """
+    return IMPL.instance_update_power_states(context, power_states)
+
+
 def instance_add_security_group(context, instance_id, security_group_id):
     """Associate the given security group with the given instance."""
     return IMPL.instance_add_security_group(context, instance_id,
@@ -734,9 +791,14 @@ def network_get_all_by_uuids(context, network_uuids, project_id=None):
 # pylint: disable=C0103
 
 
-def network_get_associated_fixed_ips(context, network_id):
-    """Get all network's ips that have been associated."""
-    return IMPL.network_get_associated_fixed_ips(context, network_id)
+def network_get_associated_fixed_ips(context, network_id, addresses=None):
+    """Get all network's ips that have been associated.
+
+    If addresses is given, only the ips among them are returned.
+
+    """
+    return IMPL.network_get_associated_fixed_ips(context, network_id,
+                                                 addresses)
 
 
 def network_get_by_bridge(context, bridge):
@@ -851,6 +913,16 @@ def auth_token_create(context, token):
 ###################
 
 
+def quota_usage_get_all_by_project(context, project_id, max_age):
+    """Retrieve the usage counters of a project.
+
+    Counters not recomputed from the instances and volumes of the project
+    in the last max_age seconds are recomputed first.
+
+    """
+    return IMPL.quota_usage_get_all_by_project(context, project_id, max_age)
+
+
 def quota_create(context, project_id, resource, limit):
     """Create a quota for the given project and resource."""
     return IMPL.quota_create(context, project_id, resource, limit)
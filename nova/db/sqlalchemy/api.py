@@ -32,13 +32,17 @@ from nova import log as logging
 from nova.compute import vm_states
 from nova.db.sqlalchemy import models
 from nova.db.sqlalchemy.session import get_session
+from sqlalchemy import and_
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import joinedload_all
 from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import asc
 from sqlalchemy.sql.expression import desc
+from sqlalchemy.sql.expression import exists
 from sqlalchemy.sql.expression import literal_column
+from sqlalchemy.types import String
 
 FLAGS = flags.FLAGS
 LOG = logging.getLogger("nova.db.sqlalchemy")
@@ -506,6 +510,7 @@ def floating_ip_allocate_address(context, project_id):
             raise exception.NoMoreFloatingIps()
         floating_ip_ref['project_id'] = project_id
         session.add(floating_ip_ref)
+        _floating_ip_quota_usage_add(session, None, floating_ip_ref)
     return floating_ip_ref['address']
 
 
@@ -513,10 +518,29 @@ def floating_ip_allocate_address(context, project_id):
 def floating_ip_create(context, values):
     floating_ip_ref = models.FloatingIp()
     floating_ip_ref.update(values)
-    floating_ip_ref.save()
+    session = get_session()
+    with session.begin():
+        floating_ip_ref.save(session=session)
+        _floating_ip_quota_usage_add(session, None, floating_ip_ref)
     return floating_ip_ref['address']
 
 
+def _floating_ip_quota_project(floating_ip_ref):
+    """Return the project whose floating_ips usage counts the ip, if any."""
+    if floating_ip_ref['deleted'] or floating_ip_ref['auto_assigned']:
+        return None
+    return floating_ip_ref['project_id']
+
+
+def _floating_ip_quota_usage_add(session, counted_by, floating_ip_ref):
+    """Move the ip in the floating_ips usage counters from the project
+    that counted it before, if any, to the one that counts it now."""
+    project_id = _floating_ip_quota_project(floating_ip_ref)
+    if project_id != counted_by:
+        _quota_usage_add(session, counted_by, floating_ips=-1)
+        _quota_usage_add(session, project_id, floating_ips=1)
+
+
 @require_context
 def floating_ip_count_by_project(context, project_id):
     authorize_project_context(context, project_id)
@@ -552,10 +576,12 @@ def floating_ip_deallocate(context, address):
         floating_ip_ref = floating_ip_get_by_address(context,
                                                      address,
                                                      session=session)
+        counted_by = _floating_ip_quota_project(floating_ip_ref)
         floating_ip_ref['project_id'] = None
         floating_ip_ref['host'] = None
         floating_ip_ref['auto_assigned'] = False
         floating_ip_ref.save(session=session)
+        _floating_ip_quota_usage_add(session, counted_by, floating_ip_ref)
 
 
 @require_context
@@ -565,7 +591,9 @@ def floating_ip_destroy(context, address):
         floating_ip_ref = floating_ip_get_by_address(context,
                                                      address,
                                                      session=session)
+        counted_by = _floating_ip_quota_project(floating_ip_ref)
         floating_ip_ref.delete(session=session)
+        _floating_ip_quota_usage_add(session, counted_by, floating_ip_ref)
 
 
 @require_context
@@ -593,8 +621,10 @@ def floating_ip_set_auto_assigned(context, address):
         floating_ip_ref = floating_ip_get_by_address(context,
                                                      address,
                                                      session=session)
+        counted_by = _floating_ip_quota_project(floating_ip_ref)
         floating_ip_ref.auto_assigned = True
         floating_ip_ref.save(session=session)
+        _floating_ip_quota_usage_add(session, counted_by, floating_ip_ref)
 
 
 @require_admin_context
@@ -682,9 +712,11 @@ def floating_ip_update(context, address, values):
     session = get_session()
     with session.begin():
         floating_ip_ref = floating_ip_get_by_address(context, address, session)
+        counted_by = _floating_ip_quota_project(floating_ip_ref)
         for (key, value) in values.iteritems():
             floating_ip_ref[key] = value
         floating_ip_ref.save(session=session)
+        _floating_ip_quota_usage_add(session, counted_by, floating_ip_ref)
 
 
 ###################
@@ -728,19 +760,21 @@ def fixed_ip_associate(context, address, instance_id, network_id=None,
 
 
 @require_admin_context
-def fixed_ip_associate_pool(context, network_id, instance_id=None, host=None):
+def fixed_ip_associate_pool(context, network_id, instance_id=None, host=None,
+                            address=None):
     session = get_session()
     with session.begin():
         network_or_none = or_(models.FixedIp.network_id == network_id,
                               models.FixedIp.network_id == None)
-        fixed_ip_ref = session.query(models.FixedIp).\
-                               filter(network_or_none).\
-                               filter_by(reserved=False).\
-                               filter_by(deleted=False).\
-                               filter_by(instance=None).\
-                               filter_by(host=None).\
-                               with_lockmode('update').\
-                               first()
+        query = session.query(models.FixedIp).\
+                        filter(network_or_none).\
+                        filter_by(reserved=False).\
+                        filter_by(deleted=False).\
+                        filter_by(instance=None).\
+                        filter_by(host=None)
+        if address:
+            query = query.filter_by(address=address)
+        fixed_ip_ref = query.with_lockmode('update').first()
         # NOTE(vish): if with_lockmode isn't supported, as in sqlite,
         #             then this has concurrency issues
         if not fixed_ip_ref:
@@ -759,6 +793,31 @@ def fixed_ip_associate_pool(context, network_id, instance_id=None, host=None):
     return fixed_ip_ref['address']
 
 
+@require_admin_context
+def fixed_ip_associate_addresses(context, network_id, instance_ids,
+                                 addresses):
+    session = get_session()
+    with session.begin():
+        network_or_none = or_(models.FixedIp.network_id == network_id,
+                              models.FixedIp.network_id == None)
+        fixed_ip_refs = session.query(models.FixedIp).\
+                                filter(network_or_none).\
+                                filter(models.FixedIp.address.in_(addresses)).\
+                                filter_by(reserved=False).\
+                                filter_by(deleted=False).\
+                                filter_by(instance_id=None).\
+                                filter_by(host=None).\
+                                with_lockmode('update').\
+                                all()
+        associated = {}
+        for instance_id, fixed_ip_ref in zip(instance_ids, fixed_ip_refs):
+            fixed_ip_ref.network_id = network_id
+            fixed_ip_ref.instance_id = instance_id
+            session.add(fixed_ip_ref)
+            associated[instance_id] = fixed_ip_ref['address']
+    return associated
+
+
 @require_context
 def fixed_ip_create(_context, values):
     fixed_ip_ref = models.FixedIp()
@@ -767,6 +826,13 @@ def fixed_ip_create(_context, values):
     return fixed_ip_ref['address']
 
 
+@require_context
+def fixed_ip_bulk_create(_context, ips):
+    session = get_session()
+    with session.begin():
+        session.execute(models.FixedIp.__table__.insert(), ips)
+
+
 @require_context
 def fixed_ip_disassociate(context, address):
     session = get_session()
@@ -796,6 +862,19 @@ def fixed_ip_disassociate_all_by_timeout(_context, host, time):
     return result
 
 
+@require_admin_context
+def fixed_ip_get_free_by_network(context, network_id):
+    session = get_session()
+    rows = session.query(models.FixedIp.address).\
+                   filter_by(network_id=network_id).\
+                   filter_by(reserved=False).\
+                   filter_by(deleted=False).\
+                   filter_by(instance_id=None).\
+                   filter_by(host=None).\
+                   all()
+    return [row[0] for row in rows]
+
+
 @require_context
 def fixed_ip_get(context, id, session=None):
     if not session:
@@ -1034,6 +1113,26 @@ def virtual_interface_get_by_instance(context, instance_id):
     return vif_refs
 
 
+@require_context
+def virtual_interface_get_first_network_ids(context, instance_ids):
+    """Gets the network id of the first vif of each instance.
+
+    :param instance_ids: = ids of the instances to look at
+    """
+    if not instance_ids:
+        return {}
+    session = get_session()
+    first_vif_ids = session.query(func.min(models.VirtualInterface.id)).\
+            filter(models.VirtualInterface.instance_id.in_(instance_ids)).\
+            group_by(models.VirtualInterface.instance_id).\
+            subquery()
+    rows = session.query(models.VirtualInterface.instance_id,
+                         models.VirtualInterface.network_id).\
+                   filter(models.VirtualInterface.id.in_(first_vif_ids)).\
+                   all()
+    return dict(rows)
+
+
 @require_context
 def virtual_interface_get_by_instance_and_network(context, instance_id,
                                                            network_id):
@@ -1098,6 +1197,49 @@ def virtual_interface_get_all(context):
     return vif_refs
 
 
+@require_context
+def virtual_interface_get_by_ip_filter(context, fixed_ip=None, ip=None):
+    """Get the vifs of instances that may have a fixed ip equal to fixed_ip,
+    or a fixed or floating ip that re.match()es ip.
+
+    Returns None if the ip regexp can't be expressed in SQL or is empty,
+    as an empty regexp matches every address.  The regexp may be matched
+    case insensitively, so callers still need to check the results in
+    python.
+    """
+    if ip == '':
+        return None
+    session = get_session()
+    clauses = []
+    if fixed_ip:
+        clauses.append(models.FixedIp.address == fixed_ip)
+    if ip:
+        fixed_clause = _regexp_filter_clause(session,
+                                             models.FixedIp.address, ip)
+        floating_clause = _regexp_filter_clause(session,
+                                                models.FloatingIp.address, ip)
+        if fixed_clause is None or floating_clause is None:
+            return None
+        clauses.extend([fixed_clause, floating_clause])
+    if not clauses:
+        return []
+    floating_join = and_(models.FloatingIp.fixed_ip_id == models.FixedIp.id,
+                         models.FloatingIp.deleted == False)
+    vif_ids = session.query(models.FixedIp.virtual_interface_id).\
+                      outerjoin((models.FloatingIp, floating_join)).\
+                      filter(models.FixedIp.deleted == False).\
+                      filter(models.FixedIp.virtual_interface_id != None).\
+                      filter(or_(*clauses)).\
+                      subquery()
+    vif_refs = session.query(models.VirtualInterface).\
+                       filter(models.VirtualInterface.id.in_(vif_ids)).\
+                       filter(models.VirtualInterface.instance_id != None).\
+                       options(joinedload('network')).\
+                       options(joinedload_all('fixed_ips.floating_ips')).\
+                       all()
+    return vif_refs
+
+
 ###################
 
 
@@ -1129,12 +1271,17 @@ def instance_create(context, values):
     session = get_session()
     with session.begin():
         instance_ref.save(session=session)
+        _quota_usage_add(session, instance_ref['project_id'],
+                         instances=1,
+                         cores=instance_ref['vcpus'] or 0,
+                         ram=instance_ref['memory_mb'] or 0)
     return instance_ref
 
 
 @require_admin_context
-def instance_data_get_for_project(context, project_id):
-    session = get_session()
+def instance_data_get_for_project(context, project_id, session=None):
+    if not session:
+        session = get_session()
     result = session.query(func.count(models.Instance.id),
                            func.sum(models.Instance.vcpus),
                            func.sum(models.Instance.memory_mb)).\
@@ -1149,6 +1296,18 @@ def instance_data_get_for_project(context, project_id):
 def instance_destroy(context, instance_id):
     session = get_session()
     with session.begin():
+        usage = session.query(models.Instance.project_id,
+                              models.Instance.vcpus,
+                              models.Instance.memory_mb).\
+                        filter_by(id=instance_id).\
+                        filter_by(deleted=False).\
+                        first()
+        if usage:
+            project_id, vcpus, memory_mb = usage
+            _quota_usage_add(session, project_id,
+                             instances=-1,
+                             cores=-(vcpus or 0),
+                             ram=-(memory_mb or 0))
         session.query(models.Instance).\
                 filter_by(id=instance_id).\
                 update({'deleted': True,
@@ -1245,23 +1404,128 @@ def instance_get_all(context):
                    all()
 
 
+# Characters that make a regexp more than a plain literal
+_REGEXP_SPECIAL_CHARS = '.^$*+?{}[]\\|()'
+
+# Constructs that POSIX regexps (MySQL REGEXP, PostgreSQL ~) don't share
+# with python's re module
+_REGEXP_NON_POSIX = re.compile(r'\\[A-Za-z0-9]|\(\?|[*+?}]\?')
+
+_REGEXP_OPERATORS = {'mysql': 'REGEXP',
+                     'postgresql': '~'}
+
+
+def _regexp_to_like(pattern):
+    """Translate a regexp meant for re.match() into a LIKE pattern.
+
+    Only literals, escaped punctuation, '.', '.*' and the '^'/'$' anchors
+    can be translated.  Returns None if the regexp uses anything else.
+    """
+    like = []
+    length = len(pattern)
+    i = 0
+    if pattern.startswith('^'):
+        i = 1
+    while i < length:
+        char = pattern[i]
+        if char == '.':
+            if pattern[i + 1:i + 2] == '*':
+                like.append('%')
+                i += 2
+            else:
+                like.append('_')
+                i += 1
+            continue
+        if char == '\\':
+            if i + 1 == length or pattern[i + 1].isalnum():
+                return None
+            i += 1
+            char = pattern[i]
+        elif char == '$' and i + 1 == length:
+            return ''.join(like)
+        elif char in _REGEXP_SPECIAL_CHARS:
+            return None
+        if char in '%_\\':
+            char = '\\' + char
+        like.append(char)
+        i += 1
+    # re.match() is only anchored at the start of the string
+    if not like or like[-1] != '%':
+        like.append('%')
+    return ''.join(like)
+
+
+def _regexp_filter_clause(session, column, pattern):
+    """Build a SQL predicate that selects at least every row whose column
+    value re.match()es pattern.  Returns None if the regexp can't be
+    expressed for the current backend.
+
+    LIKE and REGEXP are case insensitive with some backends/collations,
+    so callers still need to check the narrowed results in python.
+    """
+    like = _regexp_to_like(pattern)
+    if like is not None:
+        return column.like(like, escape='\\')
+    operator = _REGEXP_OPERATORS.get(session.bind.dialect.name)
+    if operator is None or _REGEXP_NON_POSIX.search(pattern):
+        return None
+    return column.op(operator)('^(%s)' % pattern)
+
+
+def _metadata_filter_items(meta):
+    """Return the (key, value) pairs a metadata filter requires.  Returns
+    None if the filter can never match."""
+    if isinstance(meta, dict):
+        return meta.items()
+    items = []
+    if isinstance(meta, list):
+        for node in meta:
+            if not isinstance(node, dict) or len(node) != 1:
+                return None
+            items.extend(node.items())
+    return items
+
+
+# Instance columns that can be used for keyset pagination; they must never
+# be NULL or rows would silently drop out of the listing
+_INSTANCE_SORT_KEYS = ('created_at', 'id')
+
+
+def _instance_keyset_clause(sort_key, sort_dir, marker):
+    """Return a WHERE clause selecting instances that sort after marker when
+    ordering by (sort_key, id).  This is the expanded form of
+    (sort_key, id) < (marker.sort_key, marker.id) for descending order."""
+    sort_column = getattr(models.Instance, sort_key)
+    sort_value = marker[sort_key]
+    id_column = models.Instance.id
+    if sort_dir == 'desc':
+        if sort_key == 'id':
+            return id_column < marker.id
+        return or_(sort_column < sort_value,
+                   and_(sort_column == sort_value, id_column < marker.id))
+    if sort_key == 'id':
+        return id_column > marker.id
+    return or_(sort_column > sort_value,
+               and_(sort_column == sort_value, id_column > marker.id))
+
+
 @require_context
-def instance_get_all_by_filters(context, filters):
+def instance_get_all_by_filters(context, filters, sort_key='created_at',
+                                sort_dir='desc', limit=None, marker=None):
     """Return instances that match all filters.  Deleted instances
     will be returned by default, unless there's a filter that says
-    otherwise"""
-
-    def _regexp_filter_by_metadata(instance, meta):
-        inst_metadata = [{node['key']: node['value']} \
-                         for node in instance['metadata']]
-        if isinstance(meta, list):
-            for node in meta:
-                if node not in inst_metadata:
-                    return False
-        elif isinstance(meta, dict):
-            for k, v in meta.iteritems():
-                if {k: v} not in inst_metadata:
-                    return False
+    otherwise.
+
+    Instances are ordered by (sort_key, id), which lets callers page with
+    marker and limit without the query cost growing with the page number.
+    """
+
+    def _regexp_filter_by_metadata(instance, meta_items):
+        inst_metadata = set([(node['key'], node['value'])
+                             for node in instance['metadata']])
+        for item in meta_items:
+            if item not in inst_metadata:
+                return False
         return True
 
     def _regexp_filter_by_column(instance, filter_name, filter_re):
@@ -1285,12 +1549,28 @@ def instance_get_all_by_filters(context, filters):
             filter_dict[column] = value
             return query.filter_by(**filter_dict)
 
+    def _metadata_exists(key, value):
+        return exists().where(and_(
+                models.InstanceMetadata.instance_id == models.Instance.id,
+                models.InstanceMetadata.key == key,
+                models.InstanceMetadata.value == value,
+                models.InstanceMetadata.deleted == False))
+
+    if sort_key not in _INSTANCE_SORT_KEYS:
+        raise exception.InvalidInput(
+                reason=_("Can't sort instances by %s") % sort_key)
+    if sort_dir not in ('asc', 'desc'):
+        raise exception.InvalidInput(
+                reason=_("Unknown sort direction %s") % sort_dir)
+    sort_order = desc if sort_dir == 'desc' else asc
+
     session = get_session()
     query_prefix = session.query(models.Instance).\
                    options(joinedload('security_groups')).\
                    options(joinedload('metadata')).\
                    options(joinedload('instance_type')).\
-                   order_by(desc(models.Instance.created_at))
+                   order_by(sort_order(getattr(models.Instance, sort_key))).\
+                   order_by(sort_order(models.Instance.id))
 
     # Make a copy of the filters dictionary to use going forward, as we'll
     # be modifying it and we shouldn't affect the caller's use of it.
@@ -1334,31 +1614,76 @@ def instance_get_all_by_filters(context, filters):
         query_prefix = _exact_match_filter(query_prefix, filter_name,
                 filters.pop(filter_name))
 
-    instances = query_prefix.all()
-    if not instances:
-        return []
-
-    # Now filter on everything else for regexp matching..
-    # For filters not in the list, we'll attempt to use the filter_name
-    # as a column name in Instance..
-    regexp_filter_funcs = {}
-
-    for filter_name in filters.iterkeys():
-        filter_func = regexp_filter_funcs.get(filter_name, None)
-        filter_re = re.compile(str(filters[filter_name]))
-        if filter_func:
-            filter_l = lambda instance: filter_func(instance, filter_re)
-        elif filter_name == 'metadata':
-            filter_l = lambda instance: _regexp_filter_by_metadata(instance,
-                    filters[filter_name])
-        else:
-            filter_l = lambda instance: _regexp_filter_by_column(instance,
-                    filter_name, filter_re)
-        instances = filter(filter_l, instances)
-        if not instances:
+    # Now narrow the query down with everything else we can express in
+    # SQL.  Regexps become LIKE (or REGEXP) predicates on string columns
+    # and metadata becomes EXISTS subqueries on instance_metadata.  What's
+    # left over, like 'name' which is built from instance_name_template,
+    # is only checked in python below.
+    string_columns = [column.name
+                      for column in models.Instance.__table__.columns
+                      if isinstance(column.type, String)]
+    regexp_filters = []
+    meta_items = None
+
+    for filter_name, value in filters.iteritems():
+        if filter_name == 'metadata':
+            meta_items = _metadata_filter_items(value)
+            if meta_items is None:
+                return []
+            for key, meta_value in meta_items:
+                query_prefix = query_prefix.filter(
+                        _metadata_exists(key, meta_value))
+            continue
+        if not hasattr(models.Instance, filter_name):
+            # Same as the python regexp filter: unknown attributes
+            # don't filter anything out
+            continue
+        pattern = str(value)
+        if filter_name in string_columns:
+            column = getattr(models.Instance, filter_name)
+            clause = _regexp_filter_clause(session, column, pattern)
+            if clause is not None:
+                query_prefix = query_prefix.filter(clause)
+        regexp_filters.append((filter_name, re.compile(pattern)))
+
+    if marker is not None:
+        # The marker has to pass the same filters as the listing itself,
+        # other projects' or filtered out instances are not valid markers
+        marker_ref = query_prefix.filter_by(id=marker).first()
+        if not marker_ref:
+            raise exception.MarkerNotFound(marker=marker)
+        query_prefix = query_prefix.filter(
+                _instance_keyset_clause(sort_key, sort_dir, marker_ref))
+
+    def _python_filter(instances):
+        # SQL narrowed things down, but LIKE/REGEXP/= may be case
+        # insensitive depending on the backend, so check the exact
+        # semantics on what's left
+        if meta_items:
+            instances = [instance for instance in instances
+                         if _regexp_filter_by_metadata(instance, meta_items)]
+
+        for filter_name, filter_re in regexp_filters:
+            instances = [instance for instance in instances
+                         if _regexp_filter_by_column(instance, filter_name,
+                                                     filter_re)]
+        return instances
+
+    if limit is None:
+        return _python_filter(query_prefix.all())
+
+    # The python filters can drop rows from a page, so keep fetching the
+    # next page from where the last one ended until the limit is filled.
+    instances = []
+    query = query_prefix
+    while True:
+        batch = query.limit(limit).all()
+        instances.extend(_python_filter(batch))
+        if len(batch) < limit or len(instances) >= limit:
             break
-
-    return instances
+        query = query_prefix.filter(
+                _instance_keyset_clause(sort_key, sort_dir, batch[-1]))
+    return instances[:limit]
 
 
 @require_context
@@ -1544,11 +1869,44 @@ def instance_update(context, instance_id, values):
                                                 session=session)
         else:
             instance_ref = instance_get(context, instance_id, session=session)
+        if not instance_ref['deleted']:
+            # NOTE: resizes change the cores and ram of the instance
+            deltas = {}
+            if 'vcpus' in values:
+                deltas['cores'] = ((values['vcpus'] or 0) -
+                                   (instance_ref['vcpus'] or 0))
+            if 'memory_mb' in values:
+                deltas['ram'] = ((values['memory_mb'] or 0) -
+                                 (instance_ref['memory_mb'] or 0))
+            if [delta for delta in deltas.values() if delta]:
+                _quota_usage_add(session, instance_ref['project_id'],
+                                 **deltas)
         instance_ref.update(values)
         instance_ref.save(session=session)
         return instance_ref
 
 
+@require_admin_context
+def instance_update_power_states(context, power_states):
+    """Set the power_state of many instances in one transaction.
+
+    Instances moving to the same state are updated by a single statement,
+    so the number of statements is bounded by the number of power states
+    rather than the number of instances.
+    """
+    by_state = {}
+    for instance_id, state in power_states.iteritems():
+        by_state.setdefault(state, []).append(instance_id)
+    session = get_session()
+    with session.begin():
+        for state, instance_ids in by_state.iteritems():
+            session.query(models.Instance).\
+                    filter(models.Instance.id.in_(instance_ids)).\
+                    update({'power_state': state,
+                            'updated_at': utils.utcnow()},
+                           synchronize_session=False)
+
+
 def instance_add_security_group(context, instance_id, security_group_id):
     """Associate the given security group with the given instance"""
     session = get_session()
@@ -1867,15 +2225,18 @@ def network_get_all_by_uuids(context, network_uuids, project_id=None):
 
 
 @require_admin_context
-def network_get_associated_fixed_ips(context, network_id):
-    session = get_session()
-    return session.query(models.FixedIp).\
-                   options(joinedload_all('instance')).\
-                   filter_by(network_id=network_id).\
-                   filter(models.FixedIp.instance_id != None).\
-                   filter(models.FixedIp.virtual_interface_id != None).\
-                   filter_by(deleted=False).\
-                   all()
+def network_get_associated_fixed_ips(context, network_id, addresses=None):
+    session = get_session()
+    query = session.query(models.FixedIp).\
+                    options(joinedload_all('instance')).\
+                    options(joinedload('virtual_interface')).\
+                    filter_by(network_id=network_id).\
+                    filter(models.FixedIp.instance_id != None).\
+                    filter(models.FixedIp.virtual_interface_id != None).\
+                    filter_by(deleted=False)
+    if addresses is not None:
+        query = query.filter(models.FixedIp.address.in_(addresses))
+    return query.all()
 
 
 @require_admin_context
@@ -2100,6 +2461,94 @@ def quota_get_all_by_project(context, project_id):
     return result
 
 
+_QUOTA_USAGE_RESOURCES = ('instances', 'cores', 'ram',
+                          'volumes', 'gigabytes', 'floating_ips')
+
+
+def _quota_usage_add(session, project_id, **deltas):
+    """Adjust the usage counters of a project in session's transaction.
+
+    Counters that don't exist yet are left alone, they are computed from
+    scratch on the next read.
+    """
+    if not project_id:
+        return
+    rows = session.query(models.QuotaUsage).\
+                   filter_by(project_id=project_id).\
+                   filter(models.QuotaUsage.resource.in_(deltas.keys())).\
+                   with_lockmode('update').\
+                   all()
+    for row in rows:
+        row.in_use += deltas[row.resource]
+        session.add(row)
+
+
+def _quota_usage_refresh(context, session, project_id):
+    """Recompute the usage counters of a project from its instances,
+    volumes and floating ips."""
+    instances, cores, ram = instance_data_get_for_project(context,
+                                                          project_id,
+                                                          session=session)
+    volumes, gigabytes = volume_data_get_for_project(context, project_id,
+                                                     session=session)
+    floating_ips = session.query(models.FloatingIp).\
+                           filter_by(project_id=project_id).\
+                           filter_by(auto_assigned=False).\
+                           filter_by(deleted=False).\
+                           count()
+    usages = {'instances': instances,
+              'cores': cores,
+              'ram': ram,
+              'volumes': volumes,
+              'gigabytes': gigabytes,
+              'floating_ips': floating_ips}
+    rows = session.query(models.QuotaUsage).\
+                   filter_by(project_id=project_id).\
+                   with_lockmode('update').\
+                   all()
+    rows = dict((row.resource, row) for row in rows)
+    now = utils.utcnow()
+    for resource, in_use in usages.iteritems():
+        row = rows.get(resource)
+        if row is None:
+            row = models.QuotaUsage()
+            row.project_id = project_id
+            row.resource = resource
+        row.in_use = in_use
+        row.refreshed_at = now
+        session.add(row)
+    return usages
+
+
+@require_admin_context
+def quota_usage_get_all_by_project(context, project_id, max_age):
+    session = get_session()
+    try:
+        with session.begin():
+            rows = session.query(models.QuotaUsage).\
+                           filter_by(project_id=project_id).\
+                           filter_by(deleted=False).\
+                           all()
+            usages = dict((row.resource, row.in_use) for row in rows)
+            oldest = utils.utcnow() - datetime.timedelta(seconds=max_age)
+            if (set(usages.keys()) != set(_QUOTA_USAGE_RESOURCES) or
+                [row for row in rows
+                 if not row.refreshed_at or row.refreshed_at < oldest]):
+                usages = _quota_usage_refresh(context, session, project_id)
+    except (IntegrityError, exception.DBError), e:
+        # session.flush wraps errors in DBError
+        if not isinstance(getattr(e, 'inner_exception', e), IntegrityError):
+            raise
+        # Another worker created the missing counters at the same time,
+        # they were computed from the same data so use theirs.
+        rows = session.query(models.QuotaUsage).\
+                       filter_by(project_id=project_id).\
+                       filter_by(deleted=False).\
+                       all()
+        usages = dict((row.resource, row.in_use) for row in rows)
+    return usages
+
+
 @require_admin_context
 def quota_create(context, project_id, resource, limit):
     quota_ref = models.Quota()
@@ -2184,12 +2633,16 @@ def volume_create(context, values):
     session = get_session()
     with session.begin():
         volume_ref.save(session=session)
+        _quota_usage_add(session, volume_ref['project_id'],
+                         volumes=1,
+                         gigabytes=volume_ref['size'] or 0)
     return volume_ref
 
 
 @require_admin_context
-def volume_data_get_for_project(context, project_id):
-    session = get_session()
+def volume_data_get_for_project(context, project_id, session=None):
+    if not session:
+        session = get_session()
     result = session.query(func.count(models.Volume.id),
                            func.sum(models.Volume.size)).\
                      filter_by(project_id=project_id).\
@@ -2203,6 +2656,16 @@ def volume_data_get_for_project(context, project_id):
 def volume_destroy(context, volume_id):
     session = get_session()
     with session.begin():
+        usage = session.query(models.Volume.project_id,
+                              models.Volume.size).\
+                        filter_by(id=volume_id).\
+                        filter_by(deleted=False).\
+                        first()
+        if usage:
+            project_id, size = usage
+            _quota_usage_add(session, project_id,
+                             volumes=-1,
+                             gigabytes=-(size or 0))
         session.query(models.Volume).\
                 filter_by(id=volume_id).\
                 update({'deleted': True,
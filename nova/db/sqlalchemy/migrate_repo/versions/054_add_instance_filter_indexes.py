@@ -0,0 +1,55 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Index, MetaData, Table
+
+meta = MetaData()
+
+
+# Indexes used by instance_get_all_by_filters().  Composites are kept to a
+# single String(255) column so they stay under MySQL's InnoDB key length
+# limit with utf8.
+INDEXES = [
+    ('instances', 'instances_project_id_deleted_idx',
+     ('project_id', 'deleted')),
+    ('instances', 'instances_host_deleted_idx', ('host', 'deleted')),
+    ('instances', 'instances_uuid_idx', ('uuid',)),
+    ('instances', 'instances_display_name_idx', ('display_name',)),
+    ('instance_metadata', 'instance_metadata_instance_id_deleted_idx',
+     ('instance_id', 'deleted')),
+    ]
+
+
+def _indexes():
+    tables = {}
+    for table_name, index_name, column_names in INDEXES:
+        if table_name not in tables:
+            tables[table_name] = Table(table_name, meta, autoload=True)
+        table = tables[table_name]
+        columns = [table.c[column_name] for column_name in column_names]
+        yield Index(index_name, *columns)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.drop(migrate_engine)
@@ -0,0 +1,61 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, String
+from sqlalchemy import Table, UniqueConstraint
+
+from nova import log as logging
+
+meta = MetaData()
+
+#
+# New Tables
+#
+
+quota_usages = Table('quota_usages', meta,
+       Column('created_at', DateTime(timezone=False)),
+       Column('updated_at', DateTime(timezone=False)),
+       Column('deleted_at', DateTime(timezone=False)),
+       Column('deleted', Boolean(create_constraint=True, name=None)),
+       Column('id', Integer(), primary_key=True, nullable=False),
+       Column('project_id',
+              String(length=255, convert_unicode=False, assert_unicode=None,
+                     unicode_error=None, _warn_on_bytestring=False),
+              index=True),
+       Column('resource',
+              String(length=255, convert_unicode=False, assert_unicode=None,
+                     unicode_error=None, _warn_on_bytestring=False)),
+       Column('in_use', Integer(), nullable=False),
+       Column('refreshed_at', DateTime(timezone=False)),
+       UniqueConstraint('project_id', 'resource', 'deleted'),
+       )
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+
+    try:
+        quota_usages.create()
+    except Exception:
+        logging.info(repr(quota_usages))
+        logging.exception('Exception while creating table')
+        raise
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+
+    quota_usages.drop()
@@ -421,6 +421,27 @@ class Quota(BASE, NovaBase):
     hard_limit = Column(Integer, nullable=True)
 
 
+class QuotaUsage(BASE, NovaBase):
+    """Represents how much of a resource a project is using.
+
+    The counters are kept up to date as instances and volumes are created
+    and destroyed, and recomputed from those tables once refreshed_at
+    gets too old.
+    """
+
+    __tablename__ = 'quota_usages'
+    __table_args__ = (schema.UniqueConstraint("project_id", "resource",
+                                              "deleted"),
+                      {'mysql_engine': 'InnoDB'})
+    id = Column(Integer, primary_key=True)
+
+    project_id = Column(String(255), index=True)
+
+    resource = Column(String(255))
+    in_use = Column(Integer, nullable=False, default=0)
+    refreshed_at = Column(DateTime)
+
+
 class Snapshot(BASE, NovaBase):
     """Represents a block storage device that can be attached to a vm."""
     __tablename__ = 'snapshots'
@@ -419,6 +419,10 @@ class ImageNotFound(NotFound):
     message = _("Image %(image_id)s could not be found.")
 
 
+class MarkerNotFound(NotFound):
+    message = _("Marker %(marker)s could not be found.")
+
+
 class KernelNotFoundForImage(ImageNotFound):
     message = _("Kernel not found for image %(image_id)s.")
 
@@ -853,3 +857,7 @@ class InstanceTypeDiskTooSmall(NovaException):
 
 class InsufficientFreeMemory(NovaException):
     message = _("Insufficient free memory on compute node to start %(uuid)s.")
+
+
+class RpcQueueFull(NovaException):
+    message = _("rpc queue is full, dropped %(method)s.")
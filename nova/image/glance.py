@@ -21,10 +21,16 @@ from __future__ import absolute_import
 
 import copy
 import datetime
+import httplib
 import json
+import os
 import random
+import re
+import sys
 from urlparse import urlparse
 
+from eventlet import greenpool
+from eventlet import pools
 from glance.common import exception as glance_exception
 
 from nova import exception
@@ -37,6 +43,26 @@ LOG = logging.getLogger('nova.image.glance')
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('glance_download_segments', 0,
+                     'download images from glance in this many parallel '
+                     'ranged requests, resuming partial downloads. '
+                     '0 streams them in a single request')
+flags.DEFINE_integer('glance_download_segment_mb', 64,
+                     'size in megabytes of the ranges images are '
+                     'downloaded in')
+flags.DEFINE_integer('glance_download_retries', 3,
+                     'times a failed range of an image download is retried')
+flags.DEFINE_integer('glance_connection_pool_size', 8,
+                     'http connections kept open to each glance api server')
+flags.DEFINE_integer('glance_page_size', 0,
+                     'images asked from glance per page when listing them, '
+                     '0 leaves the page size to glance')
+flags.DEFINE_integer('glance_image_cache_ttl', 0,
+                     'seconds to cache image metadata from glance by id and '
+                     'name, 0 disables the cache')
+flags.DEFINE_integer('glance_image_cache_size', 1024,
+                     'number of image ids and of image names kept in the '
+                     'image metadata cache')
 
 
 GlanceClient = utils.import_class('glance.client.Client')
@@ -109,10 +135,105 @@ def get_glance_client(context, image_href):
         (image_id, host, port) = _parse_image_ref(image_href)
     except ValueError:
         raise exception.InvalidImageRef(image_href=image_href)
-    glance_client = _create_glance_client(context, glance_host, glance_port)
+    glance_client = _create_glance_client(context, host, port)
     return (glance_client, image_id)
 
 
+class _ConnectionPool(pools.Pool):
+    """Pool of http connections to one glance api server."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        super(_ConnectionPool, self).__init__(
+                max_size=FLAGS.glance_connection_pool_size,
+                order_as_stack=True)
+
+    def create(self):
+        return httplib.HTTPConnection(self.host, self.port)
+
+
+# { (host, port) : _ConnectionPool }
+_connection_pools = {}
+
+
+def _get_connection_pool(host, port):
+    """Return the connection pool of the glance api server host:port."""
+    try:
+        return _connection_pools[(host, port)]
+    except KeyError:
+        pool = _connection_pools[(host, port)] = _ConnectionPool(host, port)
+        return pool
+
+
+class _RangeNotSupported(Exception):
+    """The glance api server answered a ranged request with all the data."""
+    pass
+
+
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+# bytes read from a response at a time
+_READ_CHUNK_SIZE = 64 * 1024
+
+
+class ImageMetaCache(object):
+    """Image metadata from glance, kept for FLAGS.glance_image_cache_ttl.
+
+    Every GlanceImageService of a process shares it, so the compute api and
+    the ec2 and openstack image controllers look an image up in glance once
+    per ttl.  Only images shown by id or name are kept, at most
+    FLAGS.glance_image_cache_size of each, so listing a large catalogue
+    does not fill it.
+
+    Glance decides which images a context with an auth token may see, and
+    _is_image_available lets those through, so what glance returned for a
+    token is only handed out again to that token.  Contexts without one
+    share their entries, as _is_image_available still checks them."""
+
+    def __init__(self):
+        # { (<token>, <image id>) : <image meta> }
+        self.by_id = utils.TTLCache(FLAGS['glance_image_cache_ttl'],
+                                    FLAGS['glance_image_cache_size'])
+        # { (<token>, <image name>) : [<image meta>, ...] }
+        self.by_name = utils.TTLCache(FLAGS['glance_image_cache_ttl'],
+                                      FLAGS['glance_image_cache_size'])
+
+    @staticmethod
+    def _scope(context):
+        return getattr(context, 'auth_token', None) or None
+
+    def get(self, context, image_id):
+        return self.by_id.get((self._scope(context), str(image_id)))
+
+    def get_by_name(self, context, name):
+        return self.by_name.get((self._scope(context), name))
+
+    def set(self, context, image_meta):
+        if 'id' in image_meta:
+            self.by_id.set((self._scope(context), str(image_meta['id'])),
+                           image_meta)
+
+    def set_by_name(self, context, name, image_metas):
+        self.by_name.set((self._scope(context), name), image_metas)
+
+    def invalidate(self, image_id=None):
+        """Drop the cached metadata of an image, or of all of them.
+
+        Names are looked up again either way, as any change can add an
+        image to or remove one from the images of a name."""
+        if image_id is None:
+            self.by_id.invalidate()
+        else:
+            for key, image_meta in self.by_id.items():
+                if key[1] == str(image_id):
+                    self.by_id.invalidate(key)
+        self.by_name.invalidate()
+
+
+image_meta_cache = ImageMetaCache()
+
+
 class GlanceImageService(object):
     """Provides storage and retrieval of disk image objects within Glance."""
 
@@ -177,40 +298,55 @@ class GlanceImageService(object):
         return self._fetch_images(client.get_images_detailed, **kwargs)
 
     def _fetch_images(self, fetch_func, **kwargs):
-        """Paginate through results from glance server"""
-        images = fetch_func(**kwargs)
+        """Paginate through results from glance server
 
-        if not images:
-            # break out of recursive loop to end pagination
-            return
+        Pages are asked for one at a time, glance_page_size images each
+        when it is set, and only the current page is held in memory.
 
-        for image in images:
-            yield image
+        """
+        limit = kwargs.get('limit')
+        page_size = FLAGS.glance_page_size
+        while True:
+            if page_size > 0:
+                kwargs['limit'] = page_size
+                if limit is not None:
+                    kwargs['limit'] = min(limit, page_size)
+
+            images = fetch_func(**kwargs)
+            if not images:
+                return
 
-        try:
-            # attempt to advance the marker in order to fetch next page
-            kwargs['marker'] = images[-1]['id']
-        except KeyError:
-            raise exception.ImagePaginationFailed()
+            for image in images:
+                yield image
 
-        try:
-            kwargs['limit'] = kwargs['limit'] - len(images)
-            # break if we have reached a provided limit
-            if kwargs['limit'] <= 0:
-                return
-        except KeyError:
-            # ignore missing limit, just proceed without it
-            pass
+            try:
+                # attempt to advance the marker in order to fetch next page
+                kwargs['marker'] = images[-1]['id']
+            except KeyError:
+                raise exception.ImagePaginationFailed()
 
-        for image in self._fetch_images(fetch_func, **kwargs):
-            yield image
+            if limit is not None:
+                limit -= len(images)
+                # break if we have reached a provided limit
+                if limit <= 0:
+                    return
+                kwargs['limit'] = limit
 
     def show(self, context, image_id):
         """Returns a dict with image data for the given opaque image id."""
-        try:
-            image_meta = self._get_client(context).get_image_meta(image_id)
-        except glance_exception.NotFound:
-            raise exception.ImageNotFound(image_id=image_id)
+        # NOTE: images from a glance server named in an image href are not
+        #       cached, their ids may be those of other images here
+        image_meta = None
+        if self._client is None:
+            image_meta = image_meta_cache.get(context, image_id)
+        if image_meta is None:
+            try:
+                image_meta = self._get_client(context).get_image_meta(
+                        image_id)
+            except glance_exception.NotFound:
+                raise exception.ImageNotFound(image_id=image_id)
+            if self._client is None:
+                image_meta_cache.set(context, image_meta)
 
         if not self._is_image_available(context, image_meta):
             raise exception.ImageNotFound(image_id=image_id)
@@ -220,12 +356,19 @@ class GlanceImageService(object):
 
     def show_by_name(self, context, name):
         """Returns a dict containing image data for the given name."""
-        # TODO(vish): replace this with more efficient call when glance
-        #             supports it.
-        image_metas = self.detail(context)
+        image_metas = None
+        if self._client is None:
+            image_metas = image_meta_cache.get_by_name(context, name)
+        if image_metas is None:
+            image_metas = [image_meta for image_meta in
+                           self._get_images(context, filters={'name': name})
+                           if image_meta.get('name') == name]
+            if self._client is None:
+                image_meta_cache.set_by_name(context, name, image_metas)
+
         for image_meta in image_metas:
-            if name == image_meta.get('name'):
-                return image_meta
+            if self._is_image_available(context, image_meta):
+                return self._translate_from_glance(image_meta)
         raise exception.ImageNotFound(image_id=name)
 
     def get(self, context, image_id, data):
@@ -242,6 +385,158 @@ class GlanceImageService(object):
         base_image_meta = self._translate_from_glance(image_meta)
         return base_image_meta
 
+    def download(self, context, image_id, path):
+        """Download the data of an image to path in parallel ranges.
+
+        The file is sized to the image first and every range is written at
+        its offset as it arrives, glance_download_segments at a time.  The
+        ranges that are done are recorded in path.ranges, so calling this
+        again after a failure only fetches what is missing.  Images served
+        without Range support are streamed in one request instead.
+
+        """
+        image_meta = self.show(context, image_id)
+        size = image_meta.get('size')
+        if not size:
+            return self._stream(context, image_id, path)
+
+        segment = max(FLAGS.glance_download_segment_mb, 1) * 1024 * 1024
+        state_path = '%s.ranges' % path
+        state = {'image_id': str(image_id),
+                 'size': size,
+                 'checksum': image_meta.get('checksum'),
+                 'segment': segment}
+        done = self._load_download_state(state_path, path, state)
+        if done is None:
+            done = []
+            with open(path, 'wb') as image_file:
+                image_file.truncate(size)
+
+        ranges = [(start, min(start + segment, size))
+                  for start in xrange(0, size, segment)
+                  if start not in done]
+        if done:
+            LOG.info(_('Resuming download of image %(image_id)s, '
+                       '%(count)d of %(total)d ranges left')
+                     % {'image_id': image_id, 'count': len(ranges),
+                        'total': len(ranges) + len(done)})
+
+        # NOTE: ranges come from the server the service's client talks to,
+        #       the image may only exist there
+        if getattr(self._client, 'host', None):
+            host, port = self._client.host, self._client.port
+        else:
+            host, port = pick_glance_api_server()
+        connections = _get_connection_pool(host, port)
+
+        def fetch(start, end):
+            for attempt in xrange(FLAGS.glance_download_retries + 1):
+                try:
+                    self._fetch_range(context, connections, image_id,
+                                      path, start, end)
+                    break
+                except (_RangeNotSupported, exception.ImageNotFound):
+                    raise
+                except Exception, e:
+                    if attempt == FLAGS.glance_download_retries:
+                        raise
+                    LOG.warn(_('Retrying bytes %(start)d-%(end)d of image '
+                               '%(image_id)s: %(e)s') % locals())
+            done.append(start)
+            state['done'] = done
+            with open(state_path, 'w') as state_file:
+                json.dump(state, state_file)
+
+        # NOTE: a failed range does not stop the others, they are all
+        #       waited for so the ranges that did arrive are recorded
+        pool = greenpool.GreenPool(max(FLAGS.glance_download_segments, 1))
+        fetches = [pool.spawn(fetch, start, end) for start, end in ranges]
+        failure = None
+        for fetched in fetches:
+            try:
+                fetched.wait()
+            except Exception:
+                failure = failure or sys.exc_info()
+        if failure:
+            if failure[0] is not _RangeNotSupported:
+                raise failure[0], failure[1], failure[2]
+            LOG.info(_('Glance api server %(host)s:%(port)d does not '
+                       'support ranges, streaming image %(image_id)s')
+                     % locals())
+            image_meta = self._stream(context, image_id, path)
+
+        if os.path.exists(state_path):
+            os.unlink(state_path)
+        return image_meta
+
+    def _stream(self, context, image_id, path):
+        with open(path, 'wb') as image_file:
+            return self.get(context, image_id, image_file)
+
+    @staticmethod
+    def _load_download_state(state_path, path, state):
+        """Return the ranges already in path, or None to start over."""
+        if not os.path.exists(state_path) or not os.path.exists(path):
+            return None
+        try:
+            with open(state_path) as state_file:
+                saved = json.load(state_file)
+        except ValueError:
+            return None
+        for key, value in state.iteritems():
+            if saved.get(key) != value:
+                return None
+        if os.path.getsize(path) != state['size']:
+            return None
+        return saved.get('done', [])
+
+    @staticmethod
+    def _fetch_range(context, connections, image_id, path, start, end):
+        """Write bytes start to end of an image at their offset in path."""
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        if getattr(context, 'auth_token', None):
+            headers['x-auth-token'] = context.auth_token
+        conn = connections.get()
+        try:
+            conn.request('GET', '/v1/images/%s' % image_id,
+                         headers=headers)
+            response = conn.getresponse()
+            if response.status == httplib.NOT_FOUND:
+                raise exception.ImageNotFound(image_id=image_id)
+            if response.status == httplib.OK:
+                raise _RangeNotSupported()
+            if response.status != httplib.PARTIAL_CONTENT:
+                raise exception.Error(_('Glance returned %(status)d '
+                                        'for image %(image_id)s')
+                                      % {'status': response.status,
+                                         'image_id': image_id})
+            match = _CONTENT_RANGE_RE.match(
+                    response.getheader('content-range', ''))
+            if (not match or int(match.group(1)) != start or
+                int(match.group(2)) != end - 1):
+                raise exception.Error(_('Glance returned the wrong '
+                                        'range of image %s') % image_id)
+
+            with open(path, 'r+b') as image_file:
+                image_file.seek(start)
+                remaining = end - start
+                while remaining:
+                    chunk = response.read(min(remaining,
+                                              _READ_CHUNK_SIZE))
+                    if not chunk:
+                        raise exception.Error(_('Glance closed the '
+                                                'download of image %s')
+                                              % image_id)
+                    image_file.write(chunk)
+                    remaining -= len(chunk)
+        except Exception:
+            # NOTE: the connection may be half way through a response,
+            #       httplib opens a new one the next time it is used
+            conn.close()
+            raise
+        finally:
+            connections.put(conn)
+
     def create(self, context, image_meta, data=None):
         """Store the image data and return the new image id.
 
@@ -257,6 +552,7 @@ class GlanceImageService(object):
 
         recv_service_image_meta = self._get_client(context).add_image(
             sent_service_image_meta, data)
+        image_meta_cache.invalidate(recv_service_image_meta.get('id'))
 
         # Translate Service -> Base
         base_image_meta = self._translate_from_glance(recv_service_image_meta)
@@ -278,6 +574,8 @@ class GlanceImageService(object):
             image_meta = client.update_image(image_id, image_meta, data)
         except glance_exception.NotFound:
             raise exception.ImageNotFound(image_id=image_id)
+        finally:
+            image_meta_cache.invalidate(image_id)
 
         base_image_meta = self._translate_from_glance(image_meta)
         return base_image_meta
@@ -294,6 +592,8 @@ class GlanceImageService(object):
             result = self._get_client(context).delete_image(image_id)
         except glance_exception.NotFound:
             raise exception.ImageNotFound(image_id=image_id)
+        finally:
+            image_meta_cache.invalidate(image_id)
         return result
 
     def delete_all(self):
@@ -23,6 +23,8 @@ import inspect
 import netaddr
 import os
 
+import eventlet
+
 from nova import db
 from nova import exception
 from nova import flags
@@ -70,6 +72,9 @@ flags.DEFINE_bool('send_arp_for_ha', False,
 flags.DEFINE_bool('use_single_default_gateway',
                    False, 'Use single default gateway. Only first nic of vm'
                           ' will get default gateway from dhcp server')
+flags.DEFINE_float('dhcp_update_delay', 0,
+                   'Seconds to wait for more changes to a network before '
+                   'rewriting its dnsmasq files. 0 updates them at once.')
 binary_name = os.path.basename(inspect.stack()[-1][1])
 
 
@@ -105,12 +110,34 @@ class IptablesRule(object):
 
 
 class IptablesTable(object):
-    """An iptables table."""
+    """An iptables table.
+
+    Rules are kept in lists per chain, and rules that jump to a chain are
+    indexed by their target, so adding and removing chains and rules does
+    not have to scan the whole table. Any change marks the table dirty so
+    IptablesManager only saves and restores tables that changed.
+
+    """
 
     def __init__(self):
-        self.rules = []
         self.chains = set()
         self.unwrapped_chains = set()
+        self.dirty = True
+        # { (<chain>, <wrap>) : [IptablesRule, ...] }, plus the order in
+        # which those chains got their first rule.
+        self.chain_rules = {}
+        self.chain_order = []
+        # { <target chain, as written in the rule> :
+        #   { id(IptablesRule) : IptablesRule } }
+        self.jump_rules = {}
+
+    @property
+    def rules(self):
+        """All rules of the table, grouped by chain."""
+        rules = []
+        for key in self.chain_order:
+            rules.extend(self.chain_rules[key])
+        return rules
 
     def add_chain(self, name, wrap=True):
         """Adds a named chain to the table.
@@ -125,9 +152,12 @@ class IptablesTable(object):
 
         """
         if wrap:
-            self.chains.add(name)
+            chain_set = self.chains
         else:
-            self.unwrapped_chains.add(name)
+            chain_set = self.unwrapped_chains
+        if name not in chain_set:
+            chain_set.add(name)
+            self.dirty = True
 
     def remove_chain(self, name, wrap=True):
         """Remove named chain.
@@ -149,14 +179,17 @@ class IptablesTable(object):
             return
 
         chain_set.remove(name)
-        self.rules = filter(lambda r: r.chain != name, self.rules)
+        self.dirty = True
+        for rule in list(self.chain_rules.get((name, wrap), [])):
+            self._remove(rule)
 
         if wrap:
-            jump_snippet = '-j %s-%s' % (binary_name, name)
+            target = '%s-%s' % (binary_name, name)
         else:
-            jump_snippet = '-j %s' % (name,)
+            target = name
 
-        self.rules = filter(lambda r: jump_snippet not in r.rule, self.rules)
+        for rule in self.jump_rules.get(target, {}).values():
+            self._remove(rule)
 
     def add_rule(self, chain, rule, wrap=True, top=False):
         """Add a rule to the table.
@@ -175,13 +208,48 @@ class IptablesTable(object):
         if '$' in rule:
             rule = ' '.join(map(self._wrap_target_chain, rule.split(' ')))
 
-        self.rules.append(IptablesRule(chain, rule, wrap, top))
+        rule = IptablesRule(chain, rule, wrap, top)
+        key = (chain, wrap)
+        if key not in self.chain_rules:
+            self.chain_rules[key] = []
+            self.chain_order.append(key)
+        self.chain_rules[key].append(rule)
+        target = self._jump_target(rule)
+        if target:
+            self.jump_rules.setdefault(target, {})[id(rule)] = rule
+        self.dirty = True
 
     def _wrap_target_chain(self, s):
         if s.startswith('$'):
             return '%s-%s' % (binary_name, s[1:])
         return s
 
+    def _jump_target(self, rule):
+        """Returns the chain a rule jumps to, if any."""
+        args = rule.rule.split()
+        if '-j' in args[:-1]:
+            return args[args.index('-j') + 1]
+        return None
+
+    def _remove(self, rule):
+        """Drop a rule (compared by identity) from the indexes."""
+        key = (rule.chain, rule.wrap)
+        chain_rules = self.chain_rules[key]
+        for idx, other in enumerate(chain_rules):
+            if other is rule:
+                del chain_rules[idx]
+                break
+        if not chain_rules:
+            del self.chain_rules[key]
+            self.chain_order.remove(key)
+
+        target = self._jump_target(rule)
+        if target:
+            jump_rules = self.jump_rules[target]
+            del jump_rules[id(rule)]
+            if not jump_rules:
+                del self.jump_rules[target]
+
     def remove_rule(self, chain, rule, wrap=True, top=False):
         """Remove a rule from a chain.
 
@@ -190,20 +258,22 @@ class IptablesTable(object):
         CLI tool.
 
         """
-        try:
-            self.rules.remove(IptablesRule(chain, rule, wrap, top))
-        except ValueError:
-            LOG.debug(_('Tried to remove rule that was not there:'
-                        ' %(chain)r %(rule)r %(wrap)r %(top)r'),
-                      {'chain': chain, 'rule': rule,
-                       'top': top, 'wrap': wrap})
+        wanted = IptablesRule(chain, rule, wrap, top)
+        for existing in self.chain_rules.get((chain, wrap), []):
+            if existing == wanted:
+                self._remove(existing)
+                self.dirty = True
+                return
+        LOG.debug(_('Tried to remove rule that was not there:'
+                    ' %(chain)r %(rule)r %(wrap)r %(top)r'),
+                  {'chain': chain, 'rule': rule,
+                   'top': top, 'wrap': wrap})
 
     def empty_chain(self, chain, wrap=True):
         """Remove all rules from a chain."""
-        chained_rules = [rule for rule in self.rules
-                              if rule.chain == chain and rule.wrap == wrap]
-        for rule in chained_rules:
-            self.rules.remove(rule)
+        for rule in list(self.chain_rules.get((chain, wrap), [])):
+            self._remove(rule)
+            self.dirty = True
 
 
 class IptablesManager(object):
@@ -227,6 +297,10 @@ class IptablesManager(object):
     wrapped in the same was as the builtin filter chains. Additionally, there's
     a snat chain that is applied after the POSTROUTING chain.
 
+    Callers about to make a burst of changes, each of which would call
+    apply(), can wrap them in defer_apply_on() and defer_apply_off() to
+    have them written out by a single iptables-restore per table.
+
     """
 
     def __init__(self, execute=None):
@@ -235,6 +309,8 @@ class IptablesManager(object):
         else:
             self.execute = execute
 
+        self.apply_deferred = 0
+
         self.ipv4 = {'filter': IptablesTable(),
                      'nat': IptablesTable()}
         self.ipv6 = {'filter': IptablesTable()}
@@ -288,14 +364,33 @@ class IptablesManager(object):
         self.ipv4['nat'].add_chain('floating-snat')
         self.ipv4['nat'].add_rule('snat', '-j $floating-snat')
 
-    @utils.synchronized('iptables', external=True)
+    def defer_apply_on(self):
+        """Hold back apply() until the matching defer_apply_off()."""
+        self.apply_deferred += 1
+
+    def defer_apply_off(self):
+        """Apply everything changed since defer_apply_on()."""
+        self.apply_deferred = max(self.apply_deferred - 1, 0)
+        self.apply()
+
     def apply(self):
+        """Apply the current in-memory set of iptables rules, unless
+        applying is being deferred."""
+        if self.apply_deferred:
+            return
+        self._apply()
+
+    @utils.synchronized('iptables', external=True)
+    def _apply(self):
         """Apply the current in-memory set of iptables rules.
 
         This will blow away any rules left over from previous runs of the
         same component of Nova, and replace them with our current set of
         rules. This happens atomically, thanks to iptables-restore.
 
+        Tables that have not changed since they were last applied are
+        left alone.
+
         """
         s = [('iptables', self.ipv4)]
         if FLAGS.use_ipv6:
@@ -303,16 +398,25 @@ class IptablesManager(object):
 
         for cmd, tables in s:
             for table in tables:
+                if not tables[table].dirty:
+                    continue
                 current_table, _ = self.execute('%s-save' % (cmd,),
                                                 '-t', '%s' % (table,),
                                                 run_as_root=True,
                                                 attempts=5)
                 current_lines = current_table.split('\n')
+                # NOTE: Cleared before reading the rules, so changes made
+                #       while we are restoring get applied next time.
+                tables[table].dirty = False
                 new_filter = self._modify_rules(current_lines,
                                                 tables[table])
-                self.execute('%s-restore' % (cmd,), run_as_root=True,
-                             process_input='\n'.join(new_filter),
-                             attempts=5)
+                try:
+                    self.execute('%s-restore' % (cmd,), run_as_root=True,
+                                 process_input='\n'.join(new_filter),
+                                 attempts=5)
+                except Exception:
+                    tables[table].dirty = True
+                    raise
 
     def _modify_rules(self, current_lines, table, binary=None):
         unwrapped_chains = table.unwrapped_chains
@@ -334,16 +438,20 @@ class IptablesManager(object):
                     break
 
         our_rules = []
+        top_rules = set()
         for rule in rules:
             rule_str = str(rule)
             if rule.top:
-                # rule.top == True means we want this rule to be at the top.
-                # Further down, we weed out duplicates from the bottom of the
-                # list, so here we remove the dupes ahead of time.
-                new_filter = filter(lambda s: s.strip() != rule_str.strip(),
-                                    new_filter)
+                top_rules.add(rule_str.strip())
             our_rules += [rule_str]
 
+        if top_rules:
+            # rule.top == True means we want this rule to be at the top.
+            # Further down, we weed out duplicates from the bottom of the
+            # list, so here we remove the dupes ahead of time.
+            new_filter = [line for line in new_filter
+                          if line.strip() not in top_rules]
+
         new_filter[rules_index:rules_index] = our_rules
 
         new_filter[rules_index:rules_index] = [':%s - [0:0]' % \
@@ -543,9 +651,14 @@ def get_dhcp_leases(context, network_ref):
 
 def get_dhcp_hosts(context, network_ref):
     """Get network's hosts config in dhcp-host format."""
+    fixed_ips = db.network_get_associated_fixed_ips(context,
+                                                    network_ref['id'])
+    return _dhcp_hosts(network_ref, fixed_ips)
+
+
+def _dhcp_hosts(network_ref, fixed_ips):
     hosts = []
-    for fixed_ref in db.network_get_associated_fixed_ips(context,
-                                                         network_ref['id']):
+    for fixed_ref in fixed_ips:
         host = fixed_ref['instance']['host']
         if network_ref['multi_host'] and FLAGS.host != host:
             continue
@@ -567,21 +680,23 @@ def _add_dnsmasq_accept_rules(dev):
 
 def get_dhcp_opts(context, network_ref):
     """Get network's hosts config in dhcp-opts format."""
-    hosts = []
-    ips_ref = db.network_get_associated_fixed_ips(context, network_ref['id'])
+    fixed_ips = db.network_get_associated_fixed_ips(context,
+                                                    network_ref['id'])
+    return _dhcp_opts(context, fixed_ips)
+
 
-    if ips_ref:
+def _dhcp_opts(context, fixed_ips):
+    hosts = []
+    if fixed_ips:
         #set of instance ids
-        instance_set = set([fixed_ip_ref['instance_id']
-                            for fixed_ip_ref in ips_ref])
-        default_gw_network_node = {}
-        for instance_id in instance_set:
-            vifs = db.virtual_interface_get_by_instance(context, instance_id)
-            if vifs:
-                #offer a default gateway to the first virtual interface
-                default_gw_network_node[instance_id] = vifs[0]['network_id']
-
-        for fixed_ip_ref in ips_ref:
+        instance_ids = set([fixed_ip_ref['instance_id']
+                            for fixed_ip_ref in fixed_ips])
+        #offer a default gateway to the first virtual interface
+        default_gw_network_node = \
+                db.virtual_interface_get_first_network_ids(context,
+                                                           instance_ids)
+
+        for fixed_ip_ref in fixed_ips:
             instance_id = fixed_ip_ref['instance_id']
             if instance_id in default_gw_network_node:
                 target_network_id = default_gw_network_node[instance_id]
@@ -595,29 +710,135 @@ def release_dhcp(dev, address, mac_address):
     utils.execute('dhcp_release', dev, address, mac_address, run_as_root=True)
 
 
+# { <dev> : (<hosts file>, <opts file>) } as last written by this process
+_dhcp_files = {}
+# { <dev> : {<address> : (<dhcp-host line>, <dhcp-opts line>)} }
+_dhcp_tables = {}
+# { <dev> : (<context>, <network_ref>, <addresses>) } waiting for a
+# delayed update, addresses is None if the whole network is reloaded
+_dhcp_pending = {}
+
+
+def update_dhcp(context, dev, network_ref, address=None):
+    """(Re)starts a dnsmasq server for a given network.
+
+    If address is given, only the dnsmasq entries of that fixed ip are
+    refreshed, otherwise those of the whole network are reloaded.
+
+    If dhcp_update_delay is set, the update happens that many seconds
+    later, and all the calls for the same device made in the meantime
+    are handled by that one update.
+
+    """
+    addresses = None
+    if address:
+        addresses = set([address])
+    if FLAGS.dhcp_update_delay <= 0:
+        _update_dhcp(context, dev, network_ref, addresses)
+        return
+    if dev not in _dhcp_pending:
+        eventlet.spawn_after(FLAGS.dhcp_update_delay,
+                             _delayed_update_dhcp, dev)
+    else:
+        pending = _dhcp_pending[dev][2]
+        if pending is None or addresses is None:
+            addresses = None
+        else:
+            addresses |= pending
+    _dhcp_pending[dev] = (context, network_ref, addresses)
+
+
+def _delayed_update_dhcp(dev):
+    context, network_ref, addresses = _dhcp_pending.pop(dev)
+    try:
+        _update_dhcp(context, dev, network_ref, addresses)
+    except Exception:  # pylint: disable=W0703
+        LOG.exception(_('Failed to update dnsmasq for %s'), dev)
+
+
+def _dhcp_entries(context, network_ref, fixed_ips):
+    """Return the dnsmasq host and opts lines of fixed_ips by address."""
+    default_gw_network_node = {}
+    if FLAGS.use_single_default_gateway and fixed_ips:
+        instance_ids = set([fixed_ip_ref['instance_id']
+                            for fixed_ip_ref in fixed_ips])
+        default_gw_network_node = \
+                db.virtual_interface_get_first_network_ids(context,
+                                                           instance_ids)
+    entries = {}
+    for fixed_ip_ref in fixed_ips:
+        host = None
+        if (not network_ref['multi_host'] or
+            FLAGS.host == fixed_ip_ref['instance']['host']):
+            host = _host_dhcp(fixed_ip_ref)
+        opts = None
+        instance_id = fixed_ip_ref['instance_id']
+        if instance_id in default_gw_network_node:
+            target_network_id = default_gw_network_node[instance_id]
+            # we don't want default gateway for this fixed ip
+            if target_network_id != fixed_ip_ref['network_id']:
+                opts = _host_dhcp_opts(fixed_ip_ref)
+        entries[fixed_ip_ref['address']] = (host, opts)
+    return entries
+
+
+def _dhcp_table_files(table):
+    """Return the hosts and opts files of a table of dnsmasq entries."""
+    addresses = sorted(table, key=lambda address: netaddr.IPAddress(address))
+    hosts = [table[address][0] for address in addresses]
+    opts = [table[address][1] for address in addresses]
+    hosts = '\n'.join([host for host in hosts if host])
+    opts = '\n'.join([opt for opt in opts if opt])
+    if not FLAGS.use_single_default_gateway:
+        opts = None
+    return hosts, opts
+
+
 # NOTE(ja): Sending a HUP only reloads the hostfile, so any
 #           configuration options (like dchp-range, vlan, ...)
 #           aren't reloaded.
 @utils.synchronized('dnsmasq_start')
-def update_dhcp(context, dev, network_ref):
-    """(Re)starts a dnsmasq server for a given network.
-
-    If a dnsmasq instance is already running then send a HUP
+def _update_dhcp(context, dev, network_ref, addresses=None):
+    """If a dnsmasq instance is already running then send a HUP
     signal causing it to reload, otherwise spawn a new instance.
 
+    The entries of the network are kept per device, so when addresses
+    are given only their fixed ips are looked up.  The files are only
+    rewritten, and dnsmasq only HUPed, if the hosts or opts changed
+    since the last update.
+
     """
+    table = _dhcp_tables.get(dev)
+    if table is None or addresses is None:
+        fixed_ips = db.network_get_associated_fixed_ips(context,
+                                                        network_ref['id'])
+        table = _dhcp_entries(context, network_ref, fixed_ips)
+    else:
+        table = dict(table)
+        for address in addresses:
+            table.pop(address, None)
+        fixed_ips = db.network_get_associated_fixed_ips(context,
+                                                        network_ref['id'],
+                                                        addresses)
+        table.update(_dhcp_entries(context, network_ref, fixed_ips))
+    _dhcp_tables[dev] = table
+    hosts, opts = _dhcp_table_files(table)
+
     conffile = _dhcp_file(dev, 'conf')
-    with open(conffile, 'w') as f:
-        f.write(get_dhcp_hosts(context, network_ref))
+    changed = _dhcp_files.get(dev) != (hosts, opts)
+    if changed:
+        with open(conffile, 'w') as f:
+            f.write(hosts)
 
-    if FLAGS.use_single_default_gateway:
-        optsfile = _dhcp_file(dev, 'opts')
-        with open(optsfile, 'w') as f:
-            f.write(get_dhcp_opts(context, network_ref))
-        os.chmod(optsfile, 0644)
+        if FLAGS.use_single_default_gateway:
+            optsfile = _dhcp_file(dev, 'opts')
+            with open(optsfile, 'w') as f:
+                f.write(opts)
+            os.chmod(optsfile, 0644)
 
-    # Make sure dnsmasq can actually read it (it setuid()s to "nobody")
-    os.chmod(conffile, 0644)
+        # Make sure dnsmasq can actually read it (it setuid()s to "nobody")
+        os.chmod(conffile, 0644)
+        _dhcp_files[dev] = (hosts, opts)
 
     pid = _dnsmasq_pid_for(dev)
 
@@ -626,6 +847,8 @@ def update_dhcp(context, dev, network_ref):
         out, _err = _execute('cat', '/proc/%d/cmdline' % pid,
                              check_exit_code=False)
         if conffile in out:
+            if not changed:
+                return
             try:
                 _execute('kill', '-HUP', pid, run_as_root=True)
                 return
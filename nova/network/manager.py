@@ -50,7 +50,10 @@ import math
 import netaddr
 import re
 import socket
+import sys
+from eventlet import event
 from eventlet import greenpool
+from eventlet import greenthread
 
 from nova import context
 from nova import db
@@ -436,6 +439,43 @@ class FloatingIP(object):
         return [floating_ip['address'] for floating_ip in floating_ips]
 
 
+class FreeAddressMap(object):
+    """Free fixed ips of one network, kept as a bitmap over its cidr.
+
+    This is only a hint of which addresses to try: another network host
+    may have taken an address since the map was built, so the database
+    still decides.  Addresses are handed out round robin from a cursor,
+    so a released address is not reused straight away.
+    """
+
+    def __init__(self, cidr, addresses):
+        self.cidr = netaddr.IPNetwork(cidr)
+        self.bitmap = bytearray(self.cidr.size)
+        self.cursor = 0
+        for address in addresses:
+            self.release(address)
+
+    def __len__(self):
+        return self.bitmap.count('\x01')
+
+    def take(self):
+        """Return a free address and mark it used, or None."""
+        index = self.bitmap.find('\x01', self.cursor)
+        if index == -1:
+            index = self.bitmap.find('\x01')
+            if index == -1:
+                return None
+        self.bitmap[index] = 0
+        self.cursor = index + 1
+        return str(self.cidr[index])
+
+    def release(self, address):
+        """Mark address free again."""
+        address = netaddr.IPAddress(address)
+        if address in self.cidr:
+            self.bitmap[int(address) - self.cidr.first] = 1
+
+
 class NetworkManager(manager.SchedulerDependentManager):
     """Implements common network manager functionality.
 
@@ -463,6 +503,10 @@ class NetworkManager(manager.SchedulerDependentManager):
         self.driver = utils.import_object(network_driver)
         self.network_api = network_api.API()
         self.compute_api = compute_api.API()
+        # { <network_id> : <FreeAddressMap> }
+        self.free_addresses = {}
+        # { <network_id> : [(<instance_id>, <event>), ...] }
+        self.pending_addresses = {}
         super(NetworkManager, self).__init__(service_name='network',
                                                 *args, **kwargs)
 
@@ -509,6 +553,86 @@ class NetworkManager(manager.SchedulerDependentManager):
                                                                time)
             if num:
                 LOG.debug(_('Dissassociated %s stale fixed ip(s)'), num)
+                # NOTE: the freed addresses are not known here, so the
+                #       free address maps are rebuilt on next allocation
+                self.free_addresses.clear()
+
+    def _associate_pool_address(self, context, network, instance_id):
+        """Associate a free fixed ip of network with the instance.
+
+        Requests for the same network that arrive together, as those of
+        a multi-instance boot do, are queued and the first of them
+        associates addresses for the whole queue in one transaction.
+        """
+        waiter = event.Event()
+        pending = self.pending_addresses.setdefault(network['id'], [])
+        pending.append((instance_id, waiter))
+        if len(pending) == 1:
+            # NOTE: let the requests already received join this batch
+            greenthread.sleep(0)
+            batch = self.pending_addresses.pop(network['id'])
+            try:
+                associated = self._associate_pool_addresses(
+                        context, network, [i for i, _waiter in batch])
+            except Exception:
+                exc_info = sys.exc_info()
+                for _instance_id, batch_waiter in batch:
+                    batch_waiter.send_exception(*exc_info)
+            else:
+                for batch_instance_id, batch_waiter in batch:
+                    if batch_instance_id in associated:
+                        batch_waiter.send(associated[batch_instance_id])
+                    else:
+                        batch_waiter.send_exception(
+                                exception.NoMoreFixedIps())
+        return waiter.wait()
+
+    def _associate_pool_addresses(self, context, network, instance_ids):
+        """Associate a free fixed ip of network with each of instance_ids.
+
+        Candidates are taken from the free address map of the network, so
+        a batch costs a lookup by address instead of a scan for free rows.
+        Candidates taken by another host since the map was built are
+        replaced by the next ones.  When the map runs out, the database
+        picks the rest and the map is rebuilt on the next allocation.
+        Returns a dict of instance id to address.
+        """
+        elevated = context.elevated()
+        free = self.free_addresses.get(network['id'])
+        if free is None:
+            addresses = self.db.fixed_ip_get_free_by_network(elevated,
+                                                             network['id'])
+            free = FreeAddressMap(network['cidr'], addresses)
+            self.free_addresses[network['id']] = free
+        associated = {}
+        wanted = list(instance_ids)
+        while wanted:
+            candidates = []
+            while len(candidates) < len(wanted):
+                address = free.take()
+                if not address:
+                    break
+                candidates.append(address)
+            if not candidates:
+                break
+            associated.update(self.db.fixed_ip_associate_addresses(
+                    elevated, network['id'], wanted, candidates))
+            wanted = [i for i in wanted if i not in associated]
+        if wanted:
+            self.free_addresses.pop(network['id'], None)
+        for instance_id in wanted:
+            try:
+                associated[instance_id] = self.db.fixed_ip_associate_pool(
+                        elevated, network['id'], instance_id)
+            except exception.NoMoreFixedIps:
+                break
+        return associated
+
+    def _release_pool_address(self, network_id, address):
+        """Return a disassociated fixed ip to the free address map."""
+        free = self.free_addresses.get(network_id)
+        if free is not None:
+            free.release(address)
 
     def set_network_host(self, context, network_ref):
         """Safely sets the host of the network."""
@@ -540,8 +664,14 @@ class NetworkManager(manager.SchedulerDependentManager):
         # NOTE(jkoelker) Should probably figure out a better way to do
         #                this. But for now it "works", this could suck on
         #                large installs.
-
-        vifs = self.db.virtual_interface_get_all(context)
+        vifs = None
+        if 'ip6' not in filters:
+            # NOTE: let the database narrow the vifs down by address,
+            #       the loop below still checks every match
+            vifs = self.db.virtual_interface_get_by_ip_filter(context,
+                    fixed_ip=fixed_ip_filter, ip=filters.get('ip'))
+        if vifs is None:
+            vifs = self.db.virtual_interface_get_all(context)
         results = []
 
         for vif in vifs:
@@ -788,9 +918,8 @@ class NetworkManager(manager.SchedulerDependentManager):
                                                      address, instance_id,
                                                      network['id'])
             else:
-                address = self.db.fixed_ip_associate_pool(context.elevated(),
-                                                          network['id'],
-                                                          instance_id)
+                address = self._associate_pool_address(context, network,
+                                                       instance_id)
             self._do_trigger_security_group_members_refresh_for_instance(
                                                                    instance_id)
             get_vif = self.db.virtual_interface_get_by_instance_and_network
@@ -799,7 +928,7 @@ class NetworkManager(manager.SchedulerDependentManager):
                       'virtual_interface_id': vif['id']}
             self.db.fixed_ip_update(context, address, values)
 
-        self._setup_network(context, network)
+        self._setup_network(context, network, address)
         return address
 
     def deallocate_fixed_ip(self, context, address, **kwargs):
@@ -851,12 +980,13 @@ class NetworkManager(manager.SchedulerDependentManager):
                                 {'leased': False})
         if not fixed_ip['allocated']:
             self.db.fixed_ip_disassociate(context, address)
+            self._release_pool_address(fixed_ip['network_id'], address)
             # NOTE(vish): dhcp server isn't updated until next setup, this
             #             means there will stale entries in the conf file
             #             the code below will update the file if necessary
             if FLAGS.update_dhcp_on_disassociate:
                 network_ref = self.db.fixed_ip_get_network(context, address)
-                self._setup_network(context, network_ref)
+                self._setup_network(context, network_ref, address)
 
     def create_networks(self, context, label, cidr, multi_host, num_networks,
                         network_size, cidr_v6, gateway_v6, bridge,
@@ -1011,23 +1141,28 @@ class NetworkManager(manager.SchedulerDependentManager):
         top_reserved = self._top_reserved_ips
         project_net = netaddr.IPNetwork(network['cidr'])
         num_ips = len(project_net)
+        ips = []
         for index in range(num_ips):
             address = str(project_net[index])
             if index < bottom_reserved or num_ips - index < top_reserved:
                 reserved = True
             else:
                 reserved = False
-            self.db.fixed_ip_create(context, {'network_id': network_id,
-                                              'address': address,
-                                              'reserved': reserved})
+            ips.append({'network_id': network_id,
+                        'address': address,
+                        'reserved': reserved})
+        self.db.fixed_ip_bulk_create(context, ips)
 
     def _allocate_fixed_ips(self, context, instance_id, host, networks,
                             **kwargs):
         """Calls allocate_fixed_ip once for each network."""
         raise NotImplementedError()
 
-    def _setup_network(self, context, network_ref):
-        """Sets up network on this host."""
+    def _setup_network(self, context, network_ref, address=None):
+        """Sets up network on this host.
+
+        If address is given, it is the only fixed ip that changed.
+        """
         raise NotImplementedError()
 
     def validate_networks(self, context, networks):
@@ -1113,9 +1248,11 @@ class FlatManager(NetworkManager):
         """Returns a fixed ip to the pool."""
         super(FlatManager, self).deallocate_fixed_ip(context, address,
                                                      **kwargs)
+        fixed_ip_ref = self.db.fixed_ip_get_by_address(context, address)
         self.db.fixed_ip_disassociate(context, address)
+        self._release_pool_address(fixed_ip_ref['network_id'], address)
 
-    def _setup_network(self, context, network_ref):
+    def _setup_network(self, context, network_ref, address=None):
         """Setup Network on this host."""
         net = {}
         net['injected'] = FLAGS.flat_injected
@@ -1145,7 +1282,7 @@ class FlatDHCPManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
 
         self.driver.metadata_forward()
 
-    def _setup_network(self, context, network_ref):
+    def _setup_network(self, context, network_ref, address=None):
         """Sets up network on this host."""
         network_ref['dhcp_server'] = self._get_dhcp_ip(context, network_ref)
 
@@ -1154,7 +1291,7 @@ class FlatDHCPManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
         self.driver.initialize_gateway_device(dev, network_ref)
 
         if not FLAGS.fake_network:
-            self.driver.update_dhcp(context, dev, network_ref)
+            self.driver.update_dhcp(context, dev, network_ref, address)
             if(FLAGS.use_ipv6):
                 self.driver.update_ra(context, dev, network_ref)
                 gateway = utils.get_my_linklocal(dev)
@@ -1208,9 +1345,8 @@ class VlanManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
                                                      instance_id,
                                                      network['id'])
             else:
-                address = self.db.fixed_ip_associate_pool(context,
-                                                          network['id'],
-                                                          instance_id)
+                address = self._associate_pool_address(context, network,
+                                                       instance_id)
             self._do_trigger_security_group_members_refresh_for_instance(
                                                                    instance_id)
         vif = self.db.virtual_interface_get_by_instance_and_network(context,
@@ -1219,7 +1355,7 @@ class VlanManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
         values = {'allocated': True,
                   'virtual_interface_id': vif['id']}
         self.db.fixed_ip_update(context, address, values)
-        self._setup_network(context, network)
+        self._setup_network(context, network, address)
         return address
 
     def add_network_to_project(self, context, project_id):
@@ -1256,7 +1392,7 @@ class VlanManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
 
         NetworkManager.create_networks(self, context, vpn=True, **kwargs)
 
-    def _setup_network(self, context, network_ref):
+    def _setup_network(self, context, network_ref, address=None):
         """Sets up network on this host."""
         if not network_ref['vpn_public_address']:
             net = {}
@@ -1279,7 +1415,7 @@ class VlanManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
                                             network_ref['vpn_public_port'],
                                             network_ref['vpn_private_address'])
         if not FLAGS.fake_network:
-            self.driver.update_dhcp(context, dev, network_ref)
+            self.driver.update_dhcp(context, dev, network_ref, address)
             if(FLAGS.use_ipv6):
                 self.driver.update_ra(context, dev, network_ref)
                 gateway = utils.get_my_linklocal(dev)
@@ -39,6 +39,8 @@ import datetime
 import hashlib
 import os
 import os.path
+import re
+import tempfile
 import urllib
 
 import routes
@@ -53,6 +55,14 @@ from nova import wsgi
 FLAGS = flags.FLAGS
 flags.DEFINE_string('buckets_path', '$state_path/buckets',
                     'path to s3 buckets')
+flags.DEFINE_integer('s3_chunk_size', 64 * 1024,
+                     'bytes read or written at a time when streaming objects')
+
+# uploads are written to a temporary file next to the object and renamed
+# into place once complete
+_UPLOAD_PREFIX = '.nova-upload-'
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
 
 
 def get_wsgi_server():
@@ -85,6 +95,9 @@ class S3Application(wsgi.Router):
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
         self.bucket_depth = bucket_depth
+        # { <bucket name> : <sorted list of object names> }, built the first
+        # time a bucket is listed and kept up to date by puts and deletes
+        self.key_indexes = {}
         super(S3Application, self).__init__(mapper)
 
 
@@ -194,6 +207,41 @@ class BaseRequestHandler(object):
             path = os.path.join(path, hash[:2 * (i + 1)])
         return os.path.join(path, object_name)
 
+    def _key_index(self, bucket_name, path):
+        """Return the sorted object names of a bucket."""
+        index = self.application.key_indexes.get(bucket_name)
+        if index is not None:
+            return index
+        object_names = []
+        for root, dirs, files in os.walk(path):
+            for file_name in files:
+                if file_name.startswith(_UPLOAD_PREFIX):
+                    continue
+                object_names.append(os.path.join(root, file_name))
+        skip = len(path) + 1
+        for i in range(self.application.bucket_depth):
+            skip += 2 * (i + 1) + 1
+        index = [n[skip:] for n in object_names]
+        index.sort()
+        self.application.key_indexes[bucket_name] = index
+        return index
+
+    def _index_add(self, bucket_name, object_name):
+        index = self.application.key_indexes.get(bucket_name)
+        if index is None:
+            return
+        pos = bisect.bisect_left(index, object_name)
+        if pos == len(index) or index[pos] != object_name:
+            index.insert(pos, object_name)
+
+    def _index_remove(self, bucket_name, object_name):
+        index = self.application.key_indexes.get(bucket_name)
+        if index is None:
+            return
+        pos = bisect.bisect_left(index, object_name)
+        if pos < len(index) and index[pos] == object_name:
+            del index[pos]
+
 
 class RootHandler(BaseRequestHandler):
     def get(self):
@@ -224,15 +272,7 @@ class BucketHandler(BaseRequestHandler):
            not os.path.isdir(path):
             self.set_status(404)
             return
-        object_names = []
-        for root, dirs, files in os.walk(path):
-            for file_name in files:
-                object_names.append(os.path.join(root, file_name))
-        skip = len(path) + 1
-        for i in range(self.application.bucket_depth):
-            skip += 2 * (i + 1) + 1
-        object_names = [n[skip:] for n in object_names]
-        object_names.sort()
+        object_names = self._key_index(bucket_name, path)
         contents = []
 
         start_pos = 0
@@ -242,7 +282,7 @@ class BucketHandler(BaseRequestHandler):
             start_pos = bisect.bisect_left(object_names, prefix, start_pos)
 
         truncated = False
-        for object_name in object_names[start_pos:]:
+        for object_name in object_names[start_pos:start_pos + max_keys + 1]:
             if not object_name.startswith(prefix):
                 break
             if len(contents) >= max_keys:
@@ -276,6 +316,7 @@ class BucketHandler(BaseRequestHandler):
             self.set_status(403)
             return
         os.makedirs(path)
+        self.application.key_indexes[bucket_name] = []
         self.finish()
 
     def delete(self, bucket_name):
@@ -289,10 +330,53 @@ class BucketHandler(BaseRequestHandler):
             self.set_status(403)
             return
         os.rmdir(path)
+        self.application.key_indexes.pop(bucket_name, None)
         self.set_status(204)
         self.finish()
 
 
+def _parse_range(header, size):
+    """Return the (first, last) bytes asked for by a Range header.
+
+    Returns None when the whole object should be sent and raises ValueError
+    when the range can not be satisfied.
+
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        # multiple ranges or other units, send everything
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # suffix range, the last n bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = int(last) if last else size - 1
+    if first >= size or last < first:
+        raise ValueError(header)
+    return first, min(last, size - 1)
+
+
+def _file_iter(path, offset, length, chunk_size):
+    """Yield length bytes of the file at path starting at offset."""
+    object_file = open(path, 'rb')
+    try:
+        object_file.seek(offset)
+        while length > 0:
+            chunk = object_file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        object_file.close()
+
+
 class ObjectHandler(BaseRequestHandler):
     def get(self, bucket, object_name):
         object_name = urllib.unquote(object_name)
@@ -305,11 +389,26 @@ class ObjectHandler(BaseRequestHandler):
         self.set_header("Content-Type", "application/unknown")
         self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(
             info.st_mtime))
-        object_file = open(path, "r")
-        try:
-            self.finish(object_file.read())
-        finally:
-            object_file.close()
+        self.set_header("Accept-Ranges", "bytes")
+        size = info.st_size
+        first, last = 0, size - 1
+        range_header = self.request.headers.get('Range')
+        if range_header:
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % size)
+                return
+            if byte_range:
+                first, last = byte_range
+                self.set_status(206)
+                self.set_header("Content-Range",
+                                "bytes %d-%d/%d" % (first, last, size))
+        length = last - first + 1
+        self.response.app_iter = _file_iter(path, first, length,
+                                            FLAGS.s3_chunk_size)
+        self.response.content_length = length
 
     def put(self, bucket, object_name):
         object_name = urllib.unquote(object_name)
@@ -326,11 +425,40 @@ class ObjectHandler(BaseRequestHandler):
         directory = os.path.dirname(path)
         if not os.path.exists(directory):
             os.makedirs(directory)
-        object_file = open(path, "w")
-        object_file.write(self.request.body)
-        object_file.close()
-        self.set_header('ETag',
-                        '"%s"' % hashlib.md5(self.request.body).hexdigest())
+        body = self.request.environ['wsgi.input']
+        remaining = self.request.content_length
+        md5 = hashlib.md5()
+        fd, tmp_path = tempfile.mkstemp(prefix=_UPLOAD_PREFIX, dir=directory)
+        try:
+            object_file = os.fdopen(fd, 'wb')
+            try:
+                while remaining is None or remaining > 0:
+                    chunk_size = FLAGS.s3_chunk_size
+                    if remaining is not None:
+                        chunk_size = min(chunk_size, remaining)
+                    chunk = body.read(chunk_size)
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    md5.update(chunk)
+                    object_file.write(chunk)
+            finally:
+                object_file.close()
+            if remaining:
+                # the client went away before sending the whole body
+                os.unlink(tmp_path)
+                self.set_status(400)
+                return
+            # mkstemp only gives the owner access
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._index_add(bucket, object_name)
+        self.set_header('ETag', '"%s"' % md5.hexdigest())
         self.finish()
 
     def delete(self, bucket, object_name):
@@ -341,5 +469,6 @@ class ObjectHandler(BaseRequestHandler):
             self.set_status(404)
             return
         os.unlink(path)
+        self._index_remove(bucket, object_name)
         self.set_status(204)
         self.finish()
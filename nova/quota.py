@@ -21,6 +21,7 @@
 from nova import db
 from nova import exception
 from nova import flags
+from nova import utils
 
 
 FLAGS = flags.FLAGS
@@ -44,6 +45,23 @@ flags.DEFINE_integer('quota_max_injected_file_content_bytes', 10 * 1024,
                      'number of bytes allowed per injected file')
 flags.DEFINE_integer('quota_max_injected_file_path_bytes', 255,
                      'number of bytes allowed per injected file path')
+flags.DEFINE_integer('quota_cache_ttl', 0,
+                     'seconds to cache the quotas of a project, 0 disables '
+                     'the cache')
+flags.DEFINE_integer('quota_usage_max_age', 300,
+                     'seconds before the usage counters of a project are '
+                     'recomputed from its instances and volumes')
+
+
+# Quota overrides by project.  Quotas rarely change but are read on every
+# create, so this saves a query per quota check.  Only the overrides from
+# the database are kept, the defaults still come from the flags.
+quota_cache = utils.TTLCache(FLAGS['quota_cache_ttl'])
+
+
+def invalidate_project_quotas(project_id=None):
+    """Forget cached quotas after they were changed in the database."""
+    quota_cache.invalidate(project_id)
 
 
 def _get_default_quotas():
@@ -68,7 +86,10 @@ def _get_default_quotas():
 
 def get_project_quotas(context, project_id):
     rval = _get_default_quotas()
-    quota = db.quota_get_all_by_project(context, project_id)
+    quota = quota_cache.get(project_id)
+    if quota is None:
+        quota = db.quota_get_all_by_project(context, project_id)
+        quota_cache.set(project_id, quota)
     for key in rval.keys():
         if key in quota:
             rval[key] = quota[key]
@@ -87,8 +108,11 @@ def allowed_instances(context, requested_instances, instance_type):
     context = context.elevated()
     requested_cores = requested_instances * instance_type['vcpus']
     requested_ram = requested_instances * instance_type['memory_mb']
-    usage = db.instance_data_get_for_project(context, project_id)
-    used_instances, used_cores, used_ram = usage
+    usage = db.quota_usage_get_all_by_project(context, project_id,
+                                              FLAGS.quota_usage_max_age)
+    used_instances = usage['instances']
+    used_cores = usage['cores']
+    used_ram = usage['ram']
     quota = get_project_quotas(context, project_id)
     allowed_instances = _get_request_allotment(requested_instances,
                                                used_instances,
@@ -108,8 +132,10 @@ def allowed_volumes(context, requested_volumes, size):
     context = context.elevated()
     size = int(size)
     requested_gigabytes = requested_volumes * size
-    used_volumes, used_gigabytes = db.volume_data_get_for_project(context,
-                                                                  project_id)
+    usage = db.quota_usage_get_all_by_project(context, project_id,
+                                              FLAGS.quota_usage_max_age)
+    used_volumes = usage['volumes']
+    used_gigabytes = usage['gigabytes']
     quota = get_project_quotas(context, project_id)
     allowed_volumes = _get_request_allotment(requested_volumes, used_volumes,
                                              quota['volumes'])
@@ -126,7 +152,9 @@ def allowed_floating_ips(context, requested_floating_ips):
     """Check quota and return min(requested, allowed) floating ips."""
     project_id = context.project_id
     context = context.elevated()
-    used_floating_ips = db.floating_ip_count_by_project(context, project_id)
+    usage = db.quota_usage_get_all_by_project(context, project_id,
+                                              FLAGS.quota_usage_max_age)
+    used_floating_ips = usage['floating_ips']
     quota = get_project_quotas(context, project_id)
     allowed_floating_ips = _get_request_allotment(requested_floating_ips,
                                                   used_floating_ips,
@@ -0,0 +1,130 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2011 OpenStack LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Versioned envelope for rpc messages.
+
+When rpc_envelope is set, the body of every message is serialized once by
+the rpc_serializer class and, above rpc_compress_threshold bytes, zlib
+compressed.  The broker then only carries a small dict of strings:
+
+    {'nova_envelope': 1,
+     'nova_encoding': 'zlib',
+     'nova_message': '<base64 of the compressed body>'}
+
+Messages without the 'nova_envelope' key are passed through untouched, so
+services can be switched over one at a time.
+
+"""
+
+import base64
+import datetime
+import json
+import zlib
+
+from nova import exception
+from nova import flags
+from nova import utils
+
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean('rpc_envelope', False,
+                     'Send rpc messages in a versioned envelope. '
+                     'Requires all services to understand envelopes.')
+flags.DEFINE_string('rpc_serializer',
+                    'nova.rpc.envelope.JsonSerializer',
+                    'Class used to serialize the body of rpc envelopes')
+flags.DEFINE_integer('rpc_compress_threshold', 4096,
+                     'Compress rpc envelopes larger than this many bytes. '
+                     'Set to 0 to never compress.')
+
+ENVELOPE_VERSION = 1
+
+_VERSION_KEY = 'nova_envelope'
+_ENCODING_KEY = 'nova_encoding'
+_MESSAGE_KEY = 'nova_message'
+
+
+def to_primitive(value):
+    """Convert one object that json can not handle into primitives.
+
+    Meant to be used as the json 'default' hook, so it is only called for
+    the objects json does not know, instead of walking the whole message
+    the way utils.to_primitive does.  Models and other dict-like objects
+    are returned as dicts, and json calls back in for their values.
+
+    """
+    if isinstance(value, datetime.datetime):
+        return str(value)
+    if hasattr(value, 'iteritems'):
+        return dict(value.iteritems())
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    rval = utils.to_primitive(value)
+    if rval is value:
+        return unicode(value)
+    return rval
+
+
+class JsonSerializer(object):
+    """Serializes envelope bodies as json."""
+
+    def dumps(self, value):
+        return json.dumps(value, default=to_primitive)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+_serializer = None  # (<rpc_serializer flag>, <serializer>)
+
+
+def _get_serializer():
+    global _serializer
+    if _serializer is None or _serializer[0] != FLAGS.rpc_serializer:
+        _serializer = (FLAGS.rpc_serializer,
+                       utils.import_object(FLAGS.rpc_serializer))
+    return _serializer[1]
+
+
+def serialize(msg):
+    """Wrap msg into an envelope."""
+    data = _get_serializer().dumps(msg)
+    threshold = FLAGS.rpc_compress_threshold
+    if threshold > 0 and len(data) > threshold:
+        return {_VERSION_KEY: ENVELOPE_VERSION,
+                _ENCODING_KEY: 'zlib',
+                _MESSAGE_KEY: base64.b64encode(zlib.compress(data))}
+    return {_VERSION_KEY: ENVELOPE_VERSION,
+            _ENCODING_KEY: None,
+            _MESSAGE_KEY: data}
+
+
+def deserialize(msg):
+    """Unwrap msg if it is an envelope, otherwise return it untouched."""
+    if not isinstance(msg, dict) or _VERSION_KEY not in msg:
+        return msg
+    version = msg[_VERSION_KEY]
+    if version != ENVELOPE_VERSION:
+        raise exception.Error(_('Unsupported rpc envelope version: %s')
+                              % version)
+    data = msg[_MESSAGE_KEY]
+    encoding = msg.get(_ENCODING_KEY)
+    if encoding == 'zlib':
+        data = zlib.decompress(base64.b64decode(data))
+    elif encoding is not None:
+        raise exception.Error(_('Unsupported rpc envelope encoding: %s')
+                              % encoding)
+    return _get_serializer().loads(data)
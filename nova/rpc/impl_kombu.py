@@ -18,6 +18,7 @@ import kombu
 import kombu.entity
 import kombu.messaging
 import kombu.connection
+import collections
 import itertools
 import sys
 import time
@@ -28,17 +29,44 @@ import uuid
 import eventlet
 from eventlet import greenpool
 from eventlet import pools
+from eventlet import queue
+from eventlet import semaphore
 import greenlet
 
 from nova import context
 from nova import exception
 from nova import flags
+from nova.rpc import envelope
 from nova.rpc.common import RemoteError, LOG
 
 # Needed for tests
 eventlet.monkey_patch()
 
 FLAGS = flags.FLAGS
+flags.DEFINE_boolean('rpc_reply_proxy', False,
+                     'Receive the replies to rpc calls on one queue per '
+                     'process, instead of declaring a queue per call. '
+                     'Requires all services to understand reply queues.')
+flags.DEFINE_integer('rpc_queue_max_depth', 64,
+                     'Number of rpc messages queued for a busy thread pool '
+                     'before the consumer stops taking more from the broker')
+flags.DEFINE_list('rpc_high_priority_methods',
+                  ['run_instance', 'terminate_instance'],
+                  'rpc methods processed before all others')
+flags.DEFINE_list('rpc_low_priority_methods',
+                  ['refresh_security_group_rules',
+                   'refresh_security_group_members',
+                   'refresh_provider_fw_rules',
+                   'update_service_capabilities'],
+                  'rpc methods processed after all others')
+flags.DEFINE_boolean('rpc_shed_low_priority', False,
+                     'Drop low priority rpc messages instead of waiting '
+                     'when the rpc queue is full')
+
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
 
 
 class ConsumerBase(object):
@@ -80,7 +108,8 @@ class ConsumerBase(object):
         a message is read.
 
         Messages will automatically be acked if the callback doesn't
-        raise an exception
+        raise an exception.  Callbacks with a true acks_messages attribute
+        are passed the message's ack function and ack it themselves.
         """
 
         options = {'consumer_tag': self.tag}
@@ -91,7 +120,11 @@ class ConsumerBase(object):
 
         def _callback(raw_message):
             message = self.channel.message_to_python(raw_message)
-            callback(message.payload)
+            if getattr(callback, 'acks_messages', False):
+                callback(envelope.deserialize(message.payload),
+                         ack=message.ack)
+                return
+            callback(envelope.deserialize(message.payload))
             message.ack()
 
         self.queue.consume(*args, callback=_callback, **options)
@@ -231,6 +264,8 @@ class Publisher(object):
 
     def send(self, msg):
         """Send a message"""
+        if FLAGS.rpc_envelope:
+            msg = envelope.serialize(msg)
         self.producer.publish(msg)
 
 
@@ -295,6 +330,8 @@ class Connection(object):
     def __init__(self):
         self.consumers = []
         self.consumer_thread = None
+        self.proxy_callbacks = {}
+        self.prefetch_count = 0
         self.max_retries = FLAGS.rabbit_max_retries
         # Try forever?
         if self.max_retries <= 0:
@@ -352,6 +389,8 @@ class Connection(object):
         # work around 'memory' transport bug in 1.1.3
         if self.memory_transport:
             self.channel._new_queue('ae.undeliver')
+        if self.prefetch_count:
+            self.channel.basic_qos(0, self.prefetch_count, False)
         for consumer in self.consumers:
             consumer.reconnect(self.channel)
         if self.consumers:
@@ -385,6 +424,8 @@ class Connection(object):
         if self.memory_transport:
             self.channel._new_queue('ae.undeliver')
         self.consumers = []
+        self.proxy_callbacks = {}
+        self.prefetch_count = 0
 
     def declare_consumer(self, consumer_cls, topic, callback):
         """Create a Consumer using the class that was passed in and
@@ -488,12 +529,31 @@ class Connection(object):
             self.consumer_thread = eventlet.spawn(_consumer_thread)
         return self.consumer_thread
 
+    def set_prefetch_count(self, prefetch_count):
+        """Limit the unacked messages the broker sends to this channel"""
+        self.prefetch_count = prefetch_count
+        self.channel.basic_qos(0, prefetch_count, False)
+
+    def get_proxy_stats(self, proxy):
+        """Return the queue counters of the consumers calling proxy"""
+        return self.proxy_callbacks[proxy].get_stats()
+
     def create_consumer(self, topic, proxy, fanout=False):
-        """Create a consumer that calls a method in a proxy object"""
+        """Create a consumer that calls a method in a proxy object.
+
+        All the consumers of one proxy share a ProxyCallback, so that
+        their messages are prioritised against each other.
+        """
+        callback = self.proxy_callbacks.get(proxy)
+        if callback is None:
+            callback = ProxyCallback(proxy)
+            self.proxy_callbacks[proxy] = callback
+            self.set_prefetch_count(max(self.prefetch_count,
+                                        callback.prefetch_count))
         if fanout:
-            self.declare_fanout_consumer(topic, ProxyCallback(proxy))
+            self.declare_fanout_consumer(topic, callback)
         else:
-            self.declare_topic_consumer(topic, ProxyCallback(proxy))
+            self.declare_topic_consumer(topic, callback)
 
 
 class Pool(pools.Pool):
@@ -578,17 +638,64 @@ class ConnectionContext(object):
 
 
 class ProxyCallback(object):
-    """Calls methods on a proxy object based on method and args."""
+    """Calls methods on a proxy object based on method and args.
+
+    Incoming messages are queued by the priority of their method and
+    handed to the thread pool highest priority first.  A message is only
+    acked once it has been processed, so the channel prefetch bounds the
+    messages held by this process and the rest wait on the broker.  Once
+    the pool and rpc_queue_max_depth queued messages are in use, the
+    consumer also blocks.
+
+    """
+
+    acks_messages = True
 
     def __init__(self, proxy):
         self.proxy = proxy
-        self.pool = greenpool.GreenPool(FLAGS.rpc_thread_pool_size)
+        self.pool_size = FLAGS.rpc_thread_pool_size
+        self.pool = greenpool.GreenPool(self.pool_size)
+        self.max_depth = FLAGS.rpc_queue_max_depth
+        self.slots = semaphore.Semaphore(self.pool_size + self.max_depth)
+        self.priorities = {}
+        for method in FLAGS.rpc_low_priority_methods:
+            self.priorities[method] = PRIORITY_LOW
+        for method in FLAGS.rpc_high_priority_methods:
+            self.priorities[method] = PRIORITY_HIGH
+        self.queues = dict((priority, collections.deque())
+                           for priority in PRIORITIES)
+        self.stats = {'processed': 0,
+                      'shed': 0,
+                      'wait_time': 0.0,
+                      'max_wait_time': 0.0}
+
+    @property
+    def prefetch_count(self):
+        """How many unacked messages the broker should hand us at once."""
+        return self.pool_size + self.max_depth
+
+    def get_stats(self):
+        """Return queue depth and latency counters."""
+        stats = dict(self.stats)
+        stats['running'] = self.pool.running()
+        for priority in PRIORITIES:
+            stats['queued_%s' % priority] = len(self.queues[priority])
+        stats['queued'] = self.queue_depth()
+        if stats['processed']:
+            stats['avg_wait_time'] = stats['wait_time'] / stats['processed']
+        else:
+            stats['avg_wait_time'] = 0.0
+        return stats
 
-    def __call__(self, message_data):
+    def queue_depth(self):
+        return sum(len(q) for q in self.queues.itervalues())
+
+    def __call__(self, message_data, ack=None):
         """Consumer callback to call a method on a proxy object.
 
-        Parses the message for validity and fires off a thread to call the
-        proxy object method.
+        Parses the message for validity and queues it for a thread to
+        call the proxy object method.  ack, if given, is called once the
+        message has been dealt with.
 
         Message data should be a dictionary with two keys:
             method: string representing the method to call
@@ -604,8 +711,65 @@ class ProxyCallback(object):
         if not method:
             LOG.warn(_('no method for message: %s') % message_data)
             ctxt.reply(_('No method for message: %s') % message_data)
+            self._ack(ack)
             return
-        self.pool.spawn_n(self._process_data, ctxt, method, args)
+        priority = self.priorities.get(method, PRIORITY_NORMAL)
+        if self.slots.locked():
+            if priority == PRIORITY_LOW and FLAGS.rpc_shed_low_priority:
+                self._shed(ctxt, method)
+                self._ack(ack)
+                return
+            LOG.warn(_('rpc queue is full, waiting to accept %s'), method)
+        self.slots.acquire()
+        self.queues[priority].append((ctxt, method, args, time.time(), ack))
+        if self.pool.free():
+            self.pool.spawn_n(self._worker)
+
+    @staticmethod
+    def _ack(ack):
+        if ack is None:
+            return
+        try:
+            ack()
+        except Exception:
+            # NOTE: the connection was lost since the message arrived, the
+            #       broker hands it out again
+            LOG.exception(_('Failed to ack rpc message'))
+
+    def _shed(self, ctxt, method):
+        """Drop a low priority message because the queue is full."""
+        LOG.warn(_('rpc queue is full, dropping %s'), method)
+        self.stats['shed'] += 1
+        try:
+            raise exception.RpcQueueFull(method=method)
+        except exception.RpcQueueFull:
+            ctxt.reply(None, sys.exc_info())
+
+    def _next_message(self):
+        for priority in PRIORITIES:
+            if self.queues[priority]:
+                return self.queues[priority].popleft()
+        return None
+
+    def _worker(self):
+        """Process queued messages until there are none left."""
+        while True:
+            item = self._next_message()
+            if item is None:
+                return
+            ctxt, method, args, queued_at, ack = item
+            wait_time = time.time() - queued_at
+            self.stats['wait_time'] += wait_time
+            self.stats['max_wait_time'] = max(self.stats['max_wait_time'],
+                                              wait_time)
+            try:
+                self._process_data(ctxt, method, args)
+            except Exception:
+                LOG.exception(_('Failed to process message %s'), method)
+            finally:
+                self.stats['processed'] += 1
+                self.slots.release()
+                self._ack(ack)
 
     @exception.wrap_exception()
     def _process_data(self, ctxt, method, args):
@@ -632,9 +796,58 @@ class ProxyCallback(object):
         return
 
 
+class ReplyProxy(object):
+    """Receives the replies to all the calls made by a process on one
+    long-lived queue, and hands each of them to the waiter of its call.
+    """
+
+    def __init__(self):
+        self.reply_q = 'reply_%s' % uuid.uuid4().hex
+        # { <msg_id> : <queue of replies> }
+        self.waiters = {}
+        self.connection = Connection()
+        self.connection.declare_direct_consumer(self.reply_q, self)
+        self.connection.consume_in_thread()
+
+    def __call__(self, message_data):
+        """The consume() callback will call this."""
+        msg_id = message_data.pop('_msg_id', None)
+        waiter = self.waiters.get(msg_id)
+        if waiter is None:
+            LOG.warn(_('No calling threads waiting for msg_id %s'), msg_id)
+            return
+        waiter.put(message_data)
+
+    def add_waiter(self, msg_id):
+        waiter = queue.LightQueue()
+        self.waiters[msg_id] = waiter
+        return waiter
+
+    def remove_waiter(self, msg_id):
+        self.waiters.pop(msg_id, None)
+
+    def close(self):
+        self.connection.close()
+        self.waiters = {}
+
+
+_reply_proxy = None
+_reply_proxy_lock = semaphore.Semaphore()
+
+
+def _get_reply_proxy():
+    """Returns the reply proxy of this process, creating it if needed."""
+    global _reply_proxy
+    with _reply_proxy_lock:
+        if _reply_proxy is None:
+            _reply_proxy = ReplyProxy()
+    return _reply_proxy
+
+
 def _unpack_context(msg):
     """Unpack context from msg."""
-    context_dict = {}
+    context_dict = dict((str(key), value)
+                        for key, value in msg.pop('_context', {}).iteritems())
     for key in list(msg.keys()):
         # NOTE(vish): Some versions of python don't like unicode keys
         #             in kwargs.
@@ -643,6 +856,7 @@ def _unpack_context(msg):
             value = msg.pop(key)
             context_dict[key[9:]] = value
     context_dict['msg_id'] = msg.pop('_msg_id', None)
+    context_dict['reply_q'] = msg.pop('_reply_q', None)
     LOG.debug(_('unpacked context: %s'), context_dict)
     return RpcContext.from_dict(context_dict)
 
@@ -655,7 +869,13 @@ def _pack_context(msg, context):
     more arguments in rabbit messages, we may want to do the same
     for args at some point.
 
+    Inside an rpc envelope the size limit does not apply, so the context
+    is sent as one nested object instead.
+
     """
+    if FLAGS.rpc_envelope:
+        msg['_context'] = context.to_dict()
+        return
     context_d = dict([('_context_%s' % key, value)
                       for (key, value) in context.to_dict().iteritems()])
     msg.update(context_d)
@@ -666,10 +886,12 @@ class RpcContext(context.RequestContext):
     def __init__(self, *args, **kwargs):
         msg_id = kwargs.pop('msg_id', None)
         self.msg_id = msg_id
+        self.reply_q = kwargs.pop('reply_q', None)
         super(RpcContext, self).__init__(*args, **kwargs)
 
     def reply(self, *args, **kwargs):
         if self.msg_id:
+            kwargs['reply_q'] = self.reply_q
             msg_reply(self.msg_id, *args, **kwargs)
 
 
@@ -707,6 +929,42 @@ class MulticallWaiter(object):
             yield result
 
 
+class ProxyWaiter(object):
+    """Waits for the replies to one call on the shared reply queue."""
+
+    def __init__(self, reply_proxy, msg_id):
+        self._reply_proxy = reply_proxy
+        self._msg_id = msg_id
+        self._queue = reply_proxy.add_waiter(msg_id)
+        self._done = False
+
+    def done(self):
+        self._done = True
+        self._reply_proxy.remove_waiter(self._msg_id)
+
+    def __del__(self):
+        # NOTE: a caller that never reads the final reply must not leave
+        #       its queue registered with the reply proxy forever
+        if not self._done:
+            self.done()
+
+    def __iter__(self):
+        """Return a result until we get a 'None' response"""
+        if self._done:
+            raise StopIteration
+        try:
+            while True:
+                data = self._queue.get()
+                if data['failure']:
+                    raise RemoteError(*data['failure'])
+                result = data['result']
+                if result == None:
+                    return
+                yield result
+        finally:
+            self.done()
+
+
 def create_connection(new=True):
     """Create a connection"""
     return ConnectionContext(pooled=not new)
@@ -724,6 +982,19 @@ def multicall(context, topic, msg):
     LOG.debug(_('MSG_ID is %s') % (msg_id))
     _pack_context(msg, context)
 
+    if FLAGS.rpc_reply_proxy:
+        reply_proxy = _get_reply_proxy()
+        msg.update({'_reply_q': reply_proxy.reply_q})
+        # NOTE: the waiter has to be in place before the request goes out
+        wait_msg = ProxyWaiter(reply_proxy, msg_id)
+        try:
+            with ConnectionContext() as conn:
+                conn.topic_send(topic, msg)
+        except Exception:
+            wait_msg.done()
+            raise
+        return wait_msg
+
     conn = ConnectionContext()
     wait_msg = MulticallWaiter(conn)
     conn.declare_direct_consumer(msg_id, wait_msg)
@@ -757,10 +1028,12 @@ def fanout_cast(context, topic, msg):
         conn.fanout_send(topic, msg)
 
 
-def msg_reply(msg_id, reply=None, failure=None):
+def msg_reply(msg_id, reply=None, failure=None, reply_q=None):
     """Sends a reply or an error on the channel signified by msg_id.
 
-    Failure should be a sys.exc_info() tuple.
+    Failure should be a sys.exc_info() tuple.  If the caller is waiting
+    on a shared reply queue, reply_q names it and the reply carries
+    msg_id so it can be told apart from the others.
 
     """
     with ConnectionContext() as conn:
@@ -777,4 +1050,8 @@ def msg_reply(msg_id, reply=None, failure=None):
             msg = {'result': dict((k, repr(v))
                             for k, v in reply.__dict__.iteritems()),
                     'failure': failure}
-        conn.direct_send(msg_id, msg)
+        if reply_q:
+            msg['_msg_id'] = msg_id
+            conn.direct_send(reply_q, msg)
+        else:
+            conn.direct_send(msg_id, msg)
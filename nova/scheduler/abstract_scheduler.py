@@ -63,8 +63,25 @@ class AbstractScheduler(driver.Scheduler):
         instance = self.create_instance_db_entry(context, request_spec)
         driver.cast_to_compute_host(context, host,
                 'run_instance', instance_id=instance['id'], **kwargs)
+        self._consume_host_resources(host, request_spec)
         return driver.encode_instance(instance, local=True)
 
+    def _consume_host_resources(self, host, request_spec):
+        """Debit the instance from the host's cached capabilities so the
+        rest of a multi-instance request (and any request arriving before
+        the host reports in again) sees the memory and disk as used.
+        """
+        if not self.zone_manager:
+            return
+        instance_type = request_spec.get('instance_type') or {}
+        resources = {
+            'host_memory_free':
+                instance_type.get('memory_mb', 0) * 1024 * 1024,
+            'disk_available':
+                instance_type.get('local_gb', 0) * 1024 * 1024 * 1024}
+        self.zone_manager.consume_service_capabilities('compute', host,
+                resources)
+
     def _decrypt_blob(self, blob):
         """Returns the decrypted blob or None if invalid. Broken out
         for testing.
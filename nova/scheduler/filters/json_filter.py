@@ -21,6 +21,12 @@ import nova.scheduler
 from nova.scheduler.filters import abstract_filter
 
 
+# Compiled queries keyed by filter class and JSON text. Schedulers send the
+# same few queries (usually one per instance type) over and over.
+_compiled_queries = {}
+_MAX_COMPILED_QUERIES = 100
+
+
 class JsonFilter(abstract_filter.AbstractHostFilter):
     """Host Filter to allow simple JSON-based grammar for
     selecting hosts.
@@ -75,6 +81,16 @@ class JsonFilter(abstract_filter.AbstractHostFilter):
         """True if all args are True."""
         return all(args)
 
+    # Commands that compare the first term with the others, and how.
+    comparisons = {
+        _equals: operator.eq,
+        _less_than: operator.lt,
+        _greater_than: operator.gt,
+        _in: operator.contains,
+        _less_than_equal: operator.le,
+        _greater_than_equal: operator.ge,
+    }
+
     commands = {
         '=': _equals,
         '<': _less_than,
@@ -129,11 +145,109 @@ class JsonFilter(abstract_filter.AbstractHostFilter):
         result = method(self, cooked_args)
         return result
 
+    def _compile_arg(self, arg):
+        """Return (lookup, value) for a query argument. lookup is a
+        function resolving the argument against a host's capabilities,
+        or None when the argument is the same for every host and value
+        holds it instead.
+        """
+        if isinstance(arg, list):
+            return self._compile_filter(arg), None
+        if not isinstance(arg, basestring) or not arg.startswith("$"):
+            if isinstance(arg, basestring):
+                arg = self._parse_string(arg, None, None)
+            return None, arg
+
+        path = arg[1:].split(".")
+
+        def lookup(services):
+            for item in path:
+                services = services.get(item, None)
+                if not services:
+                    return None
+            return services
+        return lookup, None
+
+    def _compile_filter(self, query):
+        """Compile the query structure into a tree of closures taking a
+        host's capabilities, so evaluating it per host does no parsing.
+        Evaluates exactly like _process_filter().
+        """
+        if not query:
+            return lambda services: True
+        method = self.commands[query[0]]
+        args = [self._compile_arg(arg) for arg in query[1:]]
+        op = self.comparisons.get(method)
+        if op is not None and args and not [lookup
+                for lookup, value in args[1:] if lookup is not None]:
+            # The common case: one capability compared to constants.
+            return self._compile_comparison(method, op, args[0][0],
+                    [value for lookup, value in args if value is not None])
+
+        def evaluate(services):
+            cooked_args = []
+            for lookup, value in args:
+                if lookup is not None:
+                    value = lookup(services)
+                if value is not None:
+                    cooked_args.append(value)
+            return method(self, cooked_args)
+        return evaluate
+
+    def _compile_comparison(self, method, op, lookup, values):
+        """Specialize a comparison of at most one looked up value (which
+        comes first) against constant values."""
+        if lookup is None:
+            result = method(self, values)
+            return lambda services: result
+        # What the host is compared against if the lookup finds nothing.
+        missing = method(self, values)
+        if op is operator.contains:
+            def contains(services):
+                value = lookup(services)
+                if value is None:
+                    return missing
+                return value in values
+            return contains
+
+        if len(values) == 1:
+            other = values[0]
+
+            def compare_one(services):
+                value = lookup(services)
+                if value is None:
+                    return missing
+                return op(value, other)
+            return compare_one
+
+        def compare(services):
+            value = lookup(services)
+            if value is None:
+                return missing
+            if not values:
+                return False
+            for other in values:
+                if not op(value, other):
+                    return False
+            return True
+        return compare
+
+    def _get_compiled_filter(self, query):
+        """Return the compiled form of a JSON query string."""
+        key = (self.__class__, query)
+        compiled = _compiled_queries.get(key)
+        if compiled is None:
+            compiled = self._compile_filter(json.loads(query))
+            if len(_compiled_queries) >= _MAX_COMPILED_QUERIES:
+                _compiled_queries.clear()
+            _compiled_queries[key] = compiled
+        return compiled
+
     def filter_hosts(self, host_list, query):
         """Return a list of hosts that can fulfill the requirements
         specified in the query.
         """
-        expanded = json.loads(query)
+        compiled = self._get_compiled_filter(query)
         filtered_hosts = []
         for host, capabilities in host_list:
             if not capabilities:
@@ -141,7 +255,7 @@ class JsonFilter(abstract_filter.AbstractHostFilter):
             if not capabilities.get("enabled", True):
                 # Host is disabled
                 continue
-            result = self._process_filter(expanded, host, capabilities)
+            result = compiled(capabilities)
             if isinstance(result, list):
                 # If any succeeded, include the host
                 result = any(result)
@@ -23,7 +23,7 @@ is then selected for provisioning.
 """
 
 
-import collections
+import heapq
 
 from nova import flags
 from nova import log as logging
@@ -33,6 +33,11 @@ from nova import exception
 
 LOG = logging.getLogger('nova.scheduler.least_cost')
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 FLAGS = flags.FLAGS
 flags.DEFINE_list('least_cost_scheduler_cost_functions',
         ['nova.scheduler.least_cost.noop_cost_fn'],
@@ -61,6 +66,20 @@ def compute_fill_first_cost_fn(host):
     free_mem = caps.get("host_memory_free", 0)
     return free_mem
 
+# Cost functions that just return one capability of the host may say so,
+# letting weighted_sum() read the whole column at once instead of calling
+# the function per host.
+compute_fill_first_cost_fn.capability = ("compute", "host_memory_free")
+
+
+def _cost_column(fn, domain):
+    """Evaluate a cost function over every element of the domain."""
+    path = getattr(fn, "capability", None)
+    if path is None:
+        return [fn(elem) for elem in domain]
+    service, cap = path
+    return [elem[1].get(service, {}).get(cap, 0) for elem in domain]
+
 
 def normalize_list(L):
     """Normalize an array of numbers such that each element satisfies:
@@ -74,6 +93,27 @@ def normalize_list(L):
     return L
 
 
+def _weighted_costs(domain, weighted_fns, normalize=True):
+    """weighted_sum() returning a NumPy array when NumPy is available."""
+    if not domain or not weighted_fns:
+        return []
+    if numpy is None:
+        return weighted_sum(domain, weighted_fns, normalize)
+
+    # (functions x hosts) table of raw costs, normalized and weighted a
+    # row at a time, then summed down the columns.
+    table = numpy.array([_cost_column(fn, domain)
+                         for weight, fn in weighted_fns], dtype=float)
+    if normalize:
+        maxes = table.max(axis=1)
+        maxes[maxes <= 0] = 1
+        table /= maxes[:, numpy.newaxis]
+    costs = numpy.zeros(len(domain))
+    for row, (weight, fn) in zip(table, weighted_fns):
+        costs += row * weight
+    return costs
+
+
 def weighted_sum(domain, weighted_fns, normalize=True):
     """Use the weighted-sum method to compute a score for an array of objects.
     Normalize the results of the objective-functions so that the weights are
@@ -86,29 +126,34 @@ def weighted_sum(domain, weighted_fns, normalize=True):
     Returns an unsorted list of scores. To pair with hosts do:
         zip(scores, hosts)
     """
-    # Table of form:
-    #   { domain1: [score1, score2, ..., scoreM]
-    #     ...
-    #     domainN: [score1, score2, ..., scoreM] }
-    score_table = collections.defaultdict(list)
+    if not domain or not weighted_fns:
+        return []
+    if numpy is not None:
+        return _weighted_costs(domain, weighted_fns, normalize).tolist()
+
+    domain_scores = [0] * len(domain)
     for weight, fn in weighted_fns:
-        scores = [fn(elem) for elem in domain]
+        scores = _cost_column(fn, domain)
         if normalize:
-            norm_scores = normalize_list(scores)
-        else:
-            norm_scores = scores
-        for idx, score in enumerate(norm_scores):
-            weighted_score = score * weight
-            score_table[idx].append(weighted_score)
-
-    # Sum rows in table to compute score for each element in domain
-    domain_scores = []
-    for idx in sorted(score_table):
-        elem_score = sum(score_table[idx])
-        domain_scores.append(elem_score)
+            scores = normalize_list(scores)
+        for idx, score in enumerate(scores):
+            domain_scores[idx] += score * weight
     return domain_scores
 
 
+def least_cost_indices(costs, k):
+    """Return the indices of the k smallest costs, cheapest first."""
+    if k >= len(costs):
+        if numpy is not None and not isinstance(costs, list):
+            return numpy.argsort(costs, kind='mergesort').tolist()
+        return sorted(xrange(len(costs)), key=costs.__getitem__)
+    if numpy is not None and not isinstance(costs, list):
+        indices = numpy.argpartition(costs, k - 1)[:k]
+        order = numpy.argsort(costs[indices], kind='mergesort')
+        return indices[order].tolist()
+    return heapq.nsmallest(k, xrange(len(costs)), key=costs.__getitem__)
+
+
 class LeastCostScheduler(base_scheduler.BaseScheduler):
     def __init__(self, *args, **kwargs):
         self.cost_fns_cache = {}
@@ -157,13 +202,18 @@ class LeastCostScheduler(base_scheduler.BaseScheduler):
     def weigh_hosts(self, request_spec, hosts):
         """Returns a list of dictionaries of form:
            [ {weight: weight, hostname: hostname, capabilities: capabs} ]
+        cheapest first. When the request says how many instances it is
+        for, only that many hosts are returned: no others could be picked.
         """
         cost_fns = self.get_cost_fns()
-        costs = weighted_sum(domain=hosts, weighted_fns=cost_fns)
+        costs = _weighted_costs(domain=hosts, weighted_fns=cost_fns)
+        num_hosts = request_spec.get('num_instances', len(costs))
 
         weighted = []
         weight_log = []
-        for cost, (hostname, caps) in zip(costs, hosts):
+        for idx in least_cost_indices(costs, num_hosts):
+            cost = float(costs[idx])
+            hostname, caps = hosts[idx]
             weight_log.append("%s: %s" % (hostname, "%.2f" % cost))
             weight_dict = dict(weight=cost, hostname=hostname,
                     capabilities=caps)
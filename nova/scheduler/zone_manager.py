@@ -18,6 +18,7 @@ ZoneManager oversees all communications with child Zones.
 """
 
 import datetime
+import heapq
 import thread
 import traceback
 
@@ -91,6 +92,168 @@ class ZoneState(object):
                             "attempts. Marking inactive.") % locals())
 
 
+class ServiceState(object):
+    """Compact record of the last capability report for one host service."""
+    __slots__ = ('host', 'service', 'capabilities', 'timestamp')
+
+    def __init__(self, host, service, capabilities, timestamp):
+        self.host = host
+        self.service = service
+        self.capabilities = capabilities
+        self.timestamp = timestamp
+
+    def is_enabled(self):
+        return self.capabilities.get("enabled", True)
+
+
+class CapabilityAggregate(object):
+    """Running (min, max) of one capability across all hosts.
+
+    The bounds are adjusted in place as values come and go; only when a
+    value sitting on one of the bounds is replaced or removed do we have
+    to rescan the remaining values, and that is deferred until the bounds
+    are actually read."""
+    __slots__ = ('values', 'low', 'high', 'dirty')
+
+    def __init__(self):
+        self.values = {}  # { <host> : value }
+        self.low = None
+        self.high = None
+        self.dirty = False
+
+    def set(self, host, value):
+        old = self.values.get(host, self)
+        self.values[host] = value
+        if self.dirty:
+            return
+        if len(self.values) == 1:
+            self.low = self.high = value
+        elif old is not self and (old == self.low or old == self.high):
+            self.dirty = True
+        else:
+            self.low = min(self.low, value)
+            self.high = max(self.high, value)
+
+    def discard(self, host):
+        value = self.values.pop(host)
+        if value == self.low or value == self.high:
+            self.dirty = True
+
+    def bounds(self):
+        if self.dirty:
+            self.low = min(self.values.itervalues())
+            self.high = max(self.values.itervalues())
+            self.dirty = False
+        return (self.low, self.high)
+
+
+class HostStateCache(object):
+    """In-memory view of the capabilities reported by every host service.
+
+    Keeps the raw { <host> : { <service> : { cap k : v }}} mapping the
+    schedulers filter on, plus the per-capability aggregates and a heap
+    of report times ordered by age, so rolling up the zone capabilities
+    and expiring stale services no longer walk every host."""
+
+    def __init__(self, service_states=None):
+        self.service_states = {}  # { <host> : { <service> : { cap k : v }}}
+        self.records = {}  # { (<host>, <service>) : ServiceState }
+        self.aggregates = {}  # { <service>_<cap> : CapabilityAggregate }
+        self.expiry = []  # heap of (timestamp, host, service)
+        for host, services in (service_states or {}).iteritems():
+            for service_name, capabilities in services.iteritems():
+                timestamp = capabilities.get("timestamp") or utils.utcnow()
+                self.update(service_name, host, capabilities, timestamp)
+
+    def _aggregate(self, record, remove=False):
+        """Add (or remove) a service's capabilities to the aggregates."""
+        if not record.is_enabled():
+            return
+        for cap, value in record.capabilities.iteritems():
+            if cap == "timestamp":  # Timestamp is not needed
+                continue
+            key = "%s_%s" % (record.service, cap)
+            if remove:
+                aggregate = self.aggregates.get(key)
+                if aggregate is None or record.host not in aggregate.values:
+                    continue
+                aggregate.discard(record.host)
+                if not aggregate.values:
+                    del self.aggregates[key]
+            else:
+                aggregate = self.aggregates.get(key)
+                if aggregate is None:
+                    aggregate = self.aggregates[key] = CapabilityAggregate()
+                aggregate.set(record.host, value)
+
+    def update(self, service_name, host, capabilities, timestamp):
+        """Replace the capabilities reported by a host service."""
+        key = (host, service_name)
+        old = self.records.get(key)
+        if old is not None:
+            self._aggregate(old, remove=True)
+        record = ServiceState(host, service_name, capabilities, timestamp)
+        self.records[key] = record
+        self.service_states.setdefault(host, {})[service_name] = capabilities
+        self._aggregate(record)
+        heapq.heappush(self.expiry, (timestamp, host, service_name))
+        if len(self.expiry) > 2 * len(self.records):
+            # Every report pushes an entry and superseded ones are only
+            # skipped when they get popped, so drop them once they make
+            # up half of the heap.
+            self.expiry = [(live.timestamp, live.host, live.service)
+                           for live in self.records.itervalues()]
+            heapq.heapify(self.expiry)
+
+    def remove(self, service_name, host):
+        """Forget a host service, and the host once it has none left."""
+        record = self.records.pop((host, service_name), None)
+        if record is not None:
+            self._aggregate(record, remove=True)
+        services = self.service_states.get(host)
+        if services is None:
+            return
+        services.pop(service_name, None)
+        if not services:  # Delete host if no services
+            del self.service_states[host]
+
+    def consume(self, service_name, host, resources):
+        """Debit resources from a host service's last reported capabilities
+        until its next report replaces them. `resources` maps capability
+        names to the amount to subtract."""
+        record = self.records.get((host, service_name))
+        if record is None:
+            return
+        capabilities = record.capabilities
+        self._aggregate(record, remove=True)
+        for cap, amount in resources.iteritems():
+            if cap in capabilities:
+                capabilities[cap] -= amount
+        self._aggregate(record)
+
+    def is_stale(self, service_name, host, now, max_age):
+        record = self.records[(host, service_name)]
+        return now - record.timestamp > max_age
+
+    def expire(self, now, max_age):
+        """Drop every host service whose last report is older than max_age.
+        Heap entries superseded by a later report are skipped."""
+        expired = []
+        while self.expiry and now - self.expiry[0][0] > max_age:
+            timestamp, host, service_name = heapq.heappop(self.expiry)
+            record = self.records.get((host, service_name))
+            if record is None or record.timestamp != timestamp:
+                continue
+            self.remove(service_name, host)
+            expired.append((host, service_name))
+        return expired
+
+    def capabilities(self):
+        """Return { <service>_<cap> : (min, max) } for enabled services."""
+        return dict((key, aggregate.bounds())
+                    for key, aggregate in self.aggregates.iteritems())
+
+
 def _call_novaclient(zone):
     """Call novaclient. Broken out for testing purposes. Note that
     we have to use the admin credentials for this since there is no
@@ -116,9 +279,18 @@ class ZoneManager(object):
     def __init__(self):
         self.last_zone_db_check = datetime.datetime.min
         self.zone_states = {}  # { <zone_id> : ZoneState }
-        self.service_states = {}  # { <host> : { <service> : { cap k : v }}}
+        self.host_states = HostStateCache()
         self.green_pool = greenpool.GreenPool()
 
+    def _get_service_states(self):
+        return self.host_states.service_states
+
+    def _set_service_states(self, service_states):
+        self.host_states = HostStateCache(service_states)
+
+    # { <host> : { <service> : { cap k : v }}}
+    service_states = property(_get_service_states, _set_service_states)
+
     def get_zone_list(self):
         """Return the list of zones we know about."""
         return [zone.to_dict() for zone in self.zone_states.values()]
@@ -139,37 +311,8 @@ class ZoneManager(object):
         """Roll up all the individual host info to generic 'service'
            capabilities. Each capability is aggregated into
            <cap>_min and <cap>_max values."""
-        hosts_dict = self.service_states
-
-        # TODO(sandy) - be smarter about fabricating this structure.
-        # But it's likely to change once we understand what the Best-Match
-        # code will need better.
-        combined = {}  # { <service>_<cap> : (min, max), ... }
-        stale_host_services = {}  # { host1 : [svc1, svc2], host2 :[svc1]}
-        for host, host_dict in hosts_dict.iteritems():
-            for service_name, service_dict in host_dict.iteritems():
-                if not service_dict.get("enabled", True):
-                    # Service is disabled; do no include it
-                    continue
-
-                #Check if the service capabilities became stale
-                if self.host_service_caps_stale(host, service_name):
-                    if host not in stale_host_services:
-                        stale_host_services[host] = []  # Adding host key once
-                    stale_host_services[host].append(service_name)
-                    continue
-                for cap, value in service_dict.iteritems():
-                    if cap == "timestamp":  # Timestamp is not needed
-                        continue
-                    key = "%s_%s" % (service_name, cap)
-                    min_value, max_value = combined.get(key, (value, value))
-                    min_value = min(min_value, value)
-                    max_value = max(max_value, value)
-                    combined[key] = (min_value, max_value)
-
-        # Delete the expired host services
-        self.delete_expired_host_services(stale_host_services)
-        return combined
+        self.delete_expired_host_services()
+        return self.host_states.capabilities()
 
     def _refresh_from_db(self, context):
         """Make our zone state map match the db."""
@@ -206,25 +349,30 @@ class ZoneManager(object):
         """Update the per-service capabilities based on this notification."""
         logging.debug(_("Received %(service_name)s service update from "
                 "%(host)s.") % locals())
-        service_caps = self.service_states.get(host, {})
         capabilities["timestamp"] = utils.utcnow()  # Reported time
-        service_caps[service_name] = capabilities
-        self.service_states[host] = service_caps
+        self.host_states.update(service_name, host, capabilities,
+                                capabilities["timestamp"])
+
+    def consume_service_capabilities(self, service_name, host, resources):
+        """Debit resources handed out on a host service so later requests
+        see them as used before the host reports in again."""
+        self.host_states.consume(service_name, host, resources)
+
+    def _service_max_age(self):
+        return datetime.timedelta(seconds=FLAGS.periodic_interval * 3)
 
     def host_service_caps_stale(self, host, service):
         """Check if host service capabilites are not recent enough."""
-        allowed_time_diff = FLAGS.periodic_interval * 3
-        caps = self.service_states[host][service]
-        if (utils.utcnow() - caps["timestamp"]) <= \
-            datetime.timedelta(seconds=allowed_time_diff):
-            return False
-        return True
-
-    def delete_expired_host_services(self, host_services_dict):
-        """Delete all the inactive host services information."""
+        return self.host_states.is_stale(service, host, utils.utcnow(),
+                                         self._service_max_age())
+
+    def delete_expired_host_services(self, host_services_dict=None):
+        """Delete all the inactive host services information. With no
+        arguments, every service that has not reported recently enough
+        is deleted."""
+        if host_services_dict is None:
+            self.host_states.expire(utils.utcnow(), self._service_max_age())
+            return
         for host, services in host_services_dict.iteritems():
-            service_caps = self.service_states[host]
             for service in services:
-                del service_caps[service]
-                if len(service_caps) == 0:  # Delete host if no services
-                    del self.service_states[host]
+                self.host_states.remove(service, host)
@@ -199,6 +199,35 @@ class PaginationParamsTest(test.TestCase):
                          {'marker': 40, 'limit': 20})
 
 
+class LimitAndMarkerTest(test.TestCase):
+    """
+    Unit tests for the `nova.api.openstack.common.get_limit_and_marker`
+    method used for keyset pagination.
+    """
+
+    def test_no_params(self):
+        """ Test limit defaults to max_limit without a marker. """
+        req = Request.blank('/')
+        self.assertEqual(common.get_limit_and_marker(req), (1000, None))
+
+    def test_limit_zero(self):
+        """ Test limit of zero means max_limit. """
+        req = Request.blank('/?limit=0')
+        self.assertEqual(common.get_limit_and_marker(req), (1000, None))
+
+    def test_limit_over_max(self):
+        """ Test limit is capped at max_limit. """
+        req = Request.blank('/?limit=3000&marker=4')
+        self.assertEqual(common.get_limit_and_marker(req), (1000, 4))
+        self.assertEqual(common.get_limit_and_marker(req, max_limit=2000),
+                         (2000, 4))
+
+    def test_limit_and_marker(self):
+        """ Test valid limit and marker parameters. """
+        req = Request.blank('/?limit=20&marker=40')
+        self.assertEqual(common.get_limit_and_marker(req), (20, 40))
+
+
 class MiscFunctionsTest(test.TestCase):
 
     def test_remove_version_from_href(self):
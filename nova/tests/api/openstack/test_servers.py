@@ -93,7 +93,14 @@ def return_server_with_uuid_and_state(vm_state, task_state):
 
 
 def return_servers(context, *args, **kwargs):
-    return [stub_instance(i, 'fake', 'fake') for i in xrange(5)]
+    servers = [stub_instance(i, 'fake', 'fake') for i in xrange(5)]
+    marker = kwargs.get('marker')
+    if marker is not None:
+        servers = [server for server in servers if server['id'] > marker]
+    limit = kwargs.get('limit')
+    if limit is not None:
+        servers = servers[:limit]
+    return servers
 
 
 def return_servers_by_reservation(context, reservation_id=""):
@@ -1227,9 +1234,37 @@ class ServersTest(test.TestCase):
         self.assertEqual(res.status_int, 400)
         self.assertTrue(res.body.find('marker param') > -1)
 
+    def test_get_servers_with_marker_not_found(self):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
+            raise exception.MarkerNotFound(marker=marker)
+
+        self.stubs.Set(nova.compute.API, 'get_all', fake_get_all)
+
+        req = webob.Request.blank('/v1.1/fake/servers?limit=2&marker=42')
+        res = req.get_response(fakes.wsgi_app())
+        self.assertEqual(res.status_int, 400)
+        self.assertTrue(res.body.find('marker [42] not found') > -1)
+
+    def test_get_servers_passes_limit_and_marker_v1_1(self):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
+            self.assertEqual(limit, 2)
+            self.assertEqual(marker, 1)
+            return [stub_instance(2), stub_instance(3)]
+
+        self.stubs.Set(nova.compute.API, 'get_all', fake_get_all)
+
+        req = webob.Request.blank('/v1.1/fake/servers?limit=2&marker=1')
+        res = req.get_response(fakes.wsgi_app())
+        self.assertEqual(res.status_int, 200)
+        servers = json.loads(res.body)['servers']
+        self.assertEqual([s['id'] for s in servers], [2, 3])
+
     def test_get_servers_with_bad_option_v1_0(self):
         # 1.0 API ignores unknown options
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             return [stub_instance(100)]
 
         self.stubs.Set(nova.compute.API, 'get_all', fake_get_all)
@@ -1243,7 +1278,8 @@ class ServersTest(test.TestCase):
 
     def test_get_servers_with_bad_option_v1_1(self):
         # 1.1 API also ignores unknown options
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             return [stub_instance(100)]
 
         self.stubs.Set(nova.compute.API, 'get_all', fake_get_all)
@@ -1256,7 +1292,8 @@ class ServersTest(test.TestCase):
         self.assertEqual(servers[0]['id'], 100)
 
     def test_get_servers_allows_image_v1_1(self):
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('image' in search_opts)
             self.assertEqual(search_opts['image'], '12345')
@@ -1275,7 +1312,7 @@ class ServersTest(test.TestCase):
         self.assertEqual(servers[0]['id'], 100)
 
     def test_tenant_id_filter_converts_to_project_id_for_admin(self):
-        def fake_get_all(context, filters=None, instances=None):
+        def fake_get_all(context, filters=None, instances=None, **kwargs):
             self.assertNotEqual(filters, None)
             self.assertEqual(filters['project_id'], 'faketenant')
             self.assertFalse(filters.get('tenant_id'))
@@ -1295,7 +1332,8 @@ class ServersTest(test.TestCase):
         self.assertEqual(res.status_int, 200)
 
     def test_get_servers_allows_flavor_v1_1(self):
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('flavor' in search_opts)
             # flavor is an integer ID
@@ -1315,7 +1353,8 @@ class ServersTest(test.TestCase):
         self.assertEqual(servers[0]['id'], 100)
 
     def test_get_servers_allows_status_v1_1(self):
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('vm_state' in search_opts)
             self.assertEqual(search_opts['vm_state'], vm_states.ACTIVE)
@@ -1342,7 +1381,8 @@ class ServersTest(test.TestCase):
         self.assertTrue(res.body.find('Invalid server status') > -1)
 
     def test_get_servers_allows_name_v1_1(self):
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('name' in search_opts)
             self.assertEqual(search_opts['name'], 'whee.*')
@@ -1361,7 +1401,8 @@ class ServersTest(test.TestCase):
         self.assertEqual(servers[0]['id'], 100)
 
     def test_get_servers_allows_changes_since_v1_1(self):
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('changes-since' in search_opts)
             changes_since = datetime.datetime(2011, 1, 24, 17, 8, 1)
@@ -1394,7 +1435,8 @@ class ServersTest(test.TestCase):
 
         self.flags(allow_admin_api=False)
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             # Allowed by user
             self.assertTrue('name' in search_opts)
@@ -1428,7 +1470,8 @@ class ServersTest(test.TestCase):
 
         self.flags(allow_admin_api=True)
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             # Allowed by user
             self.assertTrue('name' in search_opts)
@@ -1461,7 +1504,8 @@ class ServersTest(test.TestCase):
 
         self.flags(allow_admin_api=True)
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             # Allowed by user
             self.assertTrue('name' in search_opts)
@@ -1492,7 +1536,8 @@ class ServersTest(test.TestCase):
         """
         self.flags(allow_admin_api=True)
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('ip' in search_opts)
             self.assertEqual(search_opts['ip'], '10\..*')
@@ -1518,7 +1563,8 @@ class ServersTest(test.TestCase):
         """
         self.flags(allow_admin_api=True)
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         limit=None, marker=None):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('ip6' in search_opts)
             self.assertEqual(search_opts['ip6'], 'ffff.*')
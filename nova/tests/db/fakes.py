@@ -169,10 +169,12 @@ def stub_out_db_network_api(stubs):
         ips[0]['instance'] = True
         ips[0]['instance_id'] = instance_id
 
-    def fake_fixed_ip_associate_pool(context, network_id, instance_id):
+    def fake_fixed_ip_associate_pool(context, network_id, instance_id,
+                                     host=None, address=None):
         ips = filter(lambda i: (i['network_id'] == network_id \
                              or i['network_id'] is None) \
-                            and not i['instance'],
+                            and not i['instance'] \
+                            and (not address or i['address'] == address),
                      fixed_ips)
         if not ips:
             raise exception.NoMoreFixedIps()
@@ -180,6 +182,20 @@ def stub_out_db_network_api(stubs):
         ips[0]['instance_id'] = instance_id
         return ips[0]['address']
 
+    def fake_fixed_ip_associate_addresses(context, network_id, instance_ids,
+                                          addresses):
+        ips = filter(lambda i: (i['network_id'] == network_id \
+                             or i['network_id'] is None) \
+                            and not i['instance'] \
+                            and i['address'] in addresses,
+                     fixed_ips)
+        associated = {}
+        for instance_id, ip in zip(instance_ids, ips):
+            ip['instance'] = True
+            ip['instance_id'] = instance_id
+            associated[instance_id] = ip['address']
+        return associated
+
     def fake_fixed_ip_create(context, values):
         ip = dict(fixed_ip_fields)
         ip['id'] = max([i['id'] for i in fixed_ips] or [-1]) + 1
@@ -187,6 +203,14 @@ def stub_out_db_network_api(stubs):
             ip[key] = values[key]
         return ip['address']
 
+    def fake_fixed_ip_bulk_create(context, ips):
+        for values in ips:
+            fake_fixed_ip_create(context, values)
+
+    def fake_fixed_ip_get_free_by_network(context, network_id):
+        return [i['address'] for i in fixed_ips
+                if i['network_id'] == network_id and not i['instance']]
+
     def fake_fixed_ip_disassociate(context, address):
         ips = filter(lambda i: i['address'] == address,
                      fixed_ips)
@@ -318,7 +342,10 @@ def stub_out_db_network_api(stubs):
              fake_floating_ip_set_auto_assigned,
              fake_fixed_ip_associate,
              fake_fixed_ip_associate_pool,
+             fake_fixed_ip_associate_addresses,
              fake_fixed_ip_create,
+             fake_fixed_ip_bulk_create,
+             fake_fixed_ip_get_free_by_network,
              fake_fixed_ip_disassociate,
              fake_fixed_ip_disassociate_all_by_timeout,
              fake_fixed_ip_get_by_instance,
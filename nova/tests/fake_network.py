@@ -105,6 +105,10 @@ class FakeNetworkManager(network_manager.NetworkManager):
                                     'floating_ips': [floats[2]]}]}]
             return vifs
 
+        def virtual_interface_get_by_ip_filter(self, context, fixed_ip=None,
+                                               ip=None):
+            return None
+
         def instance_get_id_to_uuid_mapping(self, context, ids):
             # NOTE(jkoelker): This is just here until we can rely on UUIDs
             mapping = {}
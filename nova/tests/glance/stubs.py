@@ -100,17 +100,22 @@ class StubGlanceClient(object):
                 return image
         raise exception.ImageNotFound(image_id=image_id)
 
-    #TODO(bcwaldon): implement filters
     def get_images_detailed(self, filters=None, marker=None, limit=3):
+        #TODO(bcwaldon): implement the filters other than name
+        images = self.images
+        if filters and 'name' in filters:
+            images = [image for image in images
+                      if image.get('name') == filters['name']]
+
         if marker is None:
             index = 0
         else:
-            for index, image in enumerate(self.images):
+            for index, image in enumerate(images):
                 if image['id'] == str(marker):
                     index += 1
                     break
 
-        return self.images[index:index + limit]
+        return images[index:index + limit]
 
     def get_image(self, image_id):
         return self.get_image_meta(image_id), []
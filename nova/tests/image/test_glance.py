@@ -16,8 +16,15 @@
 #    under the License.
 
 
+import BaseHTTPServer
 import datetime
+import os
+import re
+import shutil
+import SocketServer
 import stubout
+import tempfile
+import threading
 
 from nova.tests.api.openstack import fakes
 from nova import context
@@ -463,3 +470,289 @@ class TestGlanceImageService(test.TestCase):
         image_meta = self.service.get(self.context, image_id, writer)
         self.assertEqual(image_meta['created_at'], self.NOW_DATETIME)
         self.assertEqual(image_meta['updated_at'], self.NOW_DATETIME)
+
+    def test_fetch_images_does_not_recurse(self):
+        def fetch_func(marker=None, **kwargs):
+            marker = marker or 0
+            if marker == 5000:
+                return []
+            return [{'id': marker + 1}]
+
+        images = list(self.service._fetch_images(fetch_func))
+        self.assertEqual(len(images), 5000)
+
+    def test_detail_page_size(self):
+        self.flags(glance_page_size=2)
+        for i in range(5):
+            self.service.create(self.context, self._make_fixture(name=i))
+        limits = []
+        get_images_detailed = self.service._client.get_images_detailed
+
+        def fake_get_images_detailed(**kwargs):
+            limits.append(kwargs['limit'])
+            return get_images_detailed(**kwargs)
+
+        self.stubs.Set(self.service._client, 'get_images_detailed',
+                       fake_get_images_detailed)
+        self.assertEqual(len(self.service.detail(self.context)), 5)
+        self.assertEqual(limits, [2, 2, 2, 2])
+
+        limits[:] = []
+        self.assertEqual(len(self.service.detail(self.context, limit=3)), 3)
+        self.assertEqual(limits, [2, 1])
+
+    def test_show_by_name_filters_in_glance(self):
+        for name in ('a', 'b', 'c', 'd', 'e'):
+            self.service.create(self.context, self._make_fixture(name=name))
+        filters = []
+        get_images_detailed = self.service._client.get_images_detailed
+
+        def fake_get_images_detailed(**kwargs):
+            filters.append(dict(kwargs['filters']))
+            return get_images_detailed(**kwargs)
+
+        self.stubs.Set(self.service._client, 'get_images_detailed',
+                       fake_get_images_detailed)
+        image_meta = self.service.show_by_name(self.context, 'e')
+        self.assertEqual(image_meta['name'], 'e')
+        self.assertEqual(filters, [{'name': 'e', 'is_public': 'none'},
+                                   {'name': 'e', 'is_public': 'none'}])
+
+    def _cached_service(self):
+        self.flags(glance_image_cache_ttl=60)
+        self.stubs.Set(glance, 'image_meta_cache', glance.ImageMetaCache())
+        self.stubs.Set(glance, '_create_glance_client',
+                       lambda context, host, port: self.service._client)
+        return glance.GlanceImageService()
+
+    def test_show_uses_cache(self):
+        service = self._cached_service()
+        image_id = service.create(self.context,
+                                  self._make_fixture(name='cached'))['id']
+        calls = []
+        get_image_meta = self.service._client.get_image_meta
+
+        def fake_get_image_meta(image_id):
+            calls.append(image_id)
+            return get_image_meta(image_id)
+
+        self.stubs.Set(self.service._client, 'get_image_meta',
+                       fake_get_image_meta)
+        service.show(self.context, image_id)
+        service.show(self.context, image_id)
+        self.assertEqual(len(calls), 1)
+
+        service.update(self.context, image_id, {'name': 'renamed'})
+        image_meta = service.show(self.context, image_id)
+        self.assertEqual(image_meta['name'], 'renamed')
+
+    def test_show_checks_availability_of_cached_images(self):
+        service = self._cached_service()
+        image_id = service.create(self.context,
+                                  self._make_fixture(name='private',
+                                                     is_public=False))['id']
+        service.show(self.context, image_id)
+        other_context = context.RequestContext('other', 'other')
+        self.assertRaises(exception.ImageNotFound, service.show,
+                          other_context, image_id)
+
+    def test_cache_is_not_shared_between_tokens(self):
+        service = self._cached_service()
+        image_id = service.create(self.context,
+                                  self._make_fixture(name='private',
+                                                     is_public=False))['id']
+        # glance only shows the image to the first token
+        clients = {'token-a': self.service._client,
+                   'token-b': glance_stubs.StubGlanceClient()}
+        self.stubs.Set(glance, '_create_glance_client',
+                       lambda context, host, port:
+                           clients[context.auth_token])
+        context_a = context.RequestContext('a', 'a', auth_token='token-a')
+        context_b = context.RequestContext('b', 'b', auth_token='token-b')
+
+        service.show(context_a, image_id)
+        service.show_by_name(context_a, 'private')
+        self.assertRaises(exception.ImageNotFound, service.show,
+                          context_b, image_id)
+        self.assertRaises(exception.ImageNotFound, service.show_by_name,
+                          context_b, 'private')
+
+    def test_show_by_name_uses_cache(self):
+        service = self._cached_service()
+        service.create(self.context, self._make_fixture(name='cached'))
+        calls = []
+        get_images_detailed = self.service._client.get_images_detailed
+
+        def fake_get_images_detailed(**kwargs):
+            calls.append(kwargs)
+            return get_images_detailed(**kwargs)
+
+        self.stubs.Set(self.service._client, 'get_images_detailed',
+                       fake_get_images_detailed)
+        service.show_by_name(self.context, 'cached')
+        service.show_by_name(self.context, 'cached')
+        self.assertEqual(len(calls), 2)
+
+        service.create(self.context, self._make_fixture(name='cached'))
+        service.show_by_name(self.context, 'cached')
+        self.assertEqual(len(calls), 4)
+
+    def test_listing_does_not_fill_cache(self):
+        service = self._cached_service()
+        for name in ('a', 'b', 'c'):
+            service.create(self.context, self._make_fixture(name=name))
+        self.assertEqual(len(service.detail(self.context)), 3)
+        self.assertEqual(glance.image_meta_cache.by_id.items(), [])
+
+    def test_cache_size_is_bounded(self):
+        self.flags(glance_image_cache_size=4)
+        service = self._cached_service()
+        for i in xrange(10):
+            image_id = service.create(self.context,
+                                      self._make_fixture(name='i%d' % i))['id']
+            service.show(self.context, image_id)
+            service.show_by_name(self.context, 'i%d' % i)
+        self.assertTrue(len(glance.image_meta_cache.by_id.items()) <= 4)
+        self.assertTrue(len(glance.image_meta_cache.by_name.items()) <= 4)
+
+
+class FakeGlanceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the data of the fake glance server, honouring Range."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('range'))
+        if server.failures:
+            server.failures -= 1
+            self.send_response(500)
+            self.send_header('content-length', '0')
+            self.end_headers()
+            return
+        data = server.data
+        match = re.match(r'^bytes=(\d+)-(\d+)$',
+                         self.headers.get('range', ''))
+        if match and server.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('content-range',
+                             'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGlanceServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeGlanceHandler)
+        self.data = data
+        self.ranges = True
+        self.failures = 0
+        self.requests = []
+
+
+class TestGlanceDownload(test.TestCase):
+    """Tests ranged downloads against a local fake glance server."""
+
+    def setUp(self):
+        super(TestGlanceDownload, self).setUp()
+        self.data = os.urandom(3 * 1024 * 1024 + 100)
+        self.server = FakeGlanceServer(self.data)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.flags(glance_api_servers=['127.0.0.1:%d' %
+                                       self.server.server_address[1]],
+                   glance_download_segments=4,
+                   glance_download_segment_mb=1,
+                   glance_download_retries=0)
+        self.stubs.Set(glance, '_connection_pools', {})
+
+        self.client = glance_stubs.StubGlanceClient()
+        self.client.add_image({'id': '1', 'name': 'big', 'is_public': True,
+                               'size': len(self.data), 'properties': {}},
+                              None)
+        self.service = glance.GlanceImageService(client=self.client)
+        self.context = context.RequestContext('fake', 'fake',
+                                              auth_token='token')
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'image')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        super(TestGlanceDownload, self).tearDown()
+
+    def _downloaded(self):
+        with open(self.path, 'rb') as image_file:
+            return image_file.read()
+
+    def test_download_in_ranges(self):
+        image_meta = self.service.download(self.context, '1', self.path)
+        self.assertEqual(image_meta['size'], len(self.data))
+        self.assertEqual(self._downloaded(), self.data)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertTrue(all(self.server.requests))
+        self.assertFalse(os.path.exists(self.path + '.ranges'))
+
+    def test_download_retries_failed_range(self):
+        self.flags(glance_download_retries=3)
+        self.server.failures = 2
+        self.service.download(self.context, '1', self.path)
+        self.assertEqual(self._downloaded(), self.data)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_download_resumes(self):
+        self.server.failures = 1
+        self.assertRaises(exception.Error, self.service.download,
+                          self.context, '1', self.path)
+        self.assertTrue(os.path.exists(self.path + '.ranges'))
+
+        self.server.requests = []
+        self.service.download(self.context, '1', self.path)
+        self.assertEqual(self._downloaded(), self.data)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(os.path.exists(self.path + '.ranges'))
+
+    def test_download_restarts_when_segment_size_changes(self):
+        self.server.failures = 1
+        self.assertRaises(exception.Error, self.service.download,
+                          self.context, '1', self.path)
+
+        self.flags(glance_download_segment_mb=2)
+        self.server.requests = []
+        self.service.download(self.context, '1', self.path)
+        self.assertEqual(self._downloaded(), self.data)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_download_uses_server_of_client(self):
+        self.flags(glance_api_servers=['127.0.0.1:1'])
+        self.client.host = '127.0.0.1'
+        self.client.port = self.server.server_address[1]
+        self.service.download(self.context, '1', self.path)
+        self.assertEqual(self._downloaded(), self.data)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_download_without_range_support(self):
+        self.server.ranges = False
+
+        def fake_get_image(image_id):
+            return self.client.get_image_meta(image_id), [self.data]
+
+        self.stubs.Set(self.client, 'get_image', fake_get_image)
+        self.service.download(self.context, '1', self.path)
+        self.assertEqual(self._downloaded(), self.data)
+        self.assertFalse(os.path.exists(self.path + '.ranges'))
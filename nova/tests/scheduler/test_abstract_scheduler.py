@@ -435,6 +435,45 @@ class AbstractSchedulerTestCase(test.TestCase):
         self.assertFalse(instances[0].get('_is_precooked', False))
         nova.db.instance_destroy(fake_context, instances[0]['id'])
 
+    def test_run_instance_consumes_host_resources(self):
+        """Hosts picked for a multi-instance request are debited the
+        instance memory until they report their capabilities again."""
+        sched = FakeAbstractScheduler()
+
+        def fake_cast_to_compute_host(*args, **kwargs):
+            pass
+
+        self.stubs.Set(driver, 'cast_to_compute_host',
+                       fake_cast_to_compute_host)
+        self.stubs.Set(sched, '_call_zone_method', fake_call_zone_method)
+        self.stubs.Set(nova.db, 'zone_get_all', lambda context: [])
+
+        zm = FakeZoneManager()
+        sched.set_zone_manager(zm)
+
+        def total_memory_free():
+            return sum(services['compute']['host_memory_free']
+                       for services in zm.service_states.values())
+
+        fake_context = context.RequestContext('user', 'project')
+        request_spec = {
+                'image': {'properties': {}},
+                'security_group': [],
+                'instance_properties': {
+                        'project_id': fake_context.project_id,
+                        'user_id': fake_context.user_id},
+                'instance_type': {'memory_mb': 256},
+                'num_instances': 2,
+            }
+
+        before = total_memory_free()
+        instances = sched.schedule_run_instance(fake_context, request_spec)
+        self.assertEqual(len(instances), 2)
+        self.assertEqual(before - total_memory_free(),
+                         2 * 256 * 1024 * 1024)
+        for instance in instances:
+            nova.db.instance_destroy(fake_context, instance['id'])
+
 
 class BaseSchedulerTestCase(test.TestCase):
     """Test case for Base Scheduler."""
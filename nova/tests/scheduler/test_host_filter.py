@@ -235,3 +235,33 @@ class HostFilterTestCase(test.TestCase):
 
         self.assertFalse(hf.filter_hosts(all_hosts,
                 json.dumps(['=', {}, ['>', '$missing....foo']])))
+
+    def _interpreted_json_filter(self, hf, host_list, query):
+        """filter_hosts() as it was before queries were compiled."""
+        expanded = json.loads(query)
+        filtered_hosts = []
+        for host, capabilities in host_list:
+            if not capabilities:
+                continue
+            if not capabilities.get("enabled", True):
+                continue
+            result = hf._process_filter(expanded, host, capabilities)
+            if isinstance(result, list):
+                result = any(result)
+            if result:
+                filtered_hosts.append((host, capabilities))
+        return filtered_hosts
+
+    def test_json_filter_compiled_matches_interpreted(self):
+        hf = nova.scheduler.filters.JsonFilter()
+        all_hosts = self._get_all_hosts()
+        queries = [hf.instance_type_to_filter(self.instance_type),
+                   json.dumps(['not', ['=', '$compute.host_memory_free', 30]]),
+                   json.dumps(['in', '$compute.xpu_arch', 'fermi', 'x']),
+                   json.dumps(['or', ['=', '$compute.xpu_info', ''],
+                                     ['>', '$compute.disk_available', 700],
+                                     ['<', 0, None, 1]]),
+                   json.dumps(['and', True, ['not', False, False]])]
+        for query in queries:
+            self.assertEquals(hf.filter_hosts(all_hosts, query),
+                    self._interpreted_json_filter(hf, all_hosts, query))
@@ -61,6 +61,32 @@ class WeightedSumTestCase(test.TestCase):
         expected = [1.5, 2.5, 1.5]
         self.assertEqual(expected, costs)
 
+    def test_basic_costing_without_numpy(self):
+        self.stubs.Set(least_cost, 'numpy', None)
+        self.test_basic_costing()
+
+    def test_capability_cost_fn(self):
+        hosts = [('host%d' % x, {'compute': {'host_memory_free': x * MB}})
+                 for x in xrange(1, 5)]
+        hosts.append(('host5', {}))
+
+        def fill_first(host):
+            return least_cost.compute_fill_first_cost_fn(host)
+
+        # Read as a capability column, and called per host
+        costs = least_cost.weighted_sum(hosts,
+                [(2, least_cost.compute_fill_first_cost_fn)])
+        expected = least_cost.weighted_sum(hosts, [(2, fill_first)])
+        self.assertEqual(expected, costs)
+        self.assertEqual([0.5, 1.0, 1.5, 2.0, 0.0], costs)
+
+    def test_least_cost_indices(self):
+        costs = [3.0, 1.0, 2.0, 1.0, 0.5]
+        self.assertEqual([4, 1], least_cost.least_cost_indices(costs, 2))
+        self.assertEqual([4, 1, 3, 2, 0],
+                         least_cost.least_cost_indices(costs, 10))
+        self.assertEqual([], least_cost.least_cost_indices([], 1))
+
 
 class LeastCostSchedulerTestCase(test.TestCase):
     def setUp(self):
@@ -114,3 +140,20 @@ class LeastCostSchedulerTestCase(test.TestCase):
         expected = [{"hostname": hostname, "weight": 2, "capabilities": caps}
                 for hostname, caps in hosts]
         self.assertWeights(expected, num, request_spec, hosts)
+
+    def test_num_instances_limits_hosts(self):
+        self.flags(least_cost_scheduler_cost_functions=[
+                'nova.scheduler.least_cost.compute_fill_first_cost_fn'],
+                compute_fill_first_cost_fn_weight=1)
+        num = 3
+        request_spec = {'num_instances': num}
+        hosts = sorted(self.sched.zone_manager.service_states.items(),
+                       reverse=True)
+
+        # Free memory is 10 + 10 * N, so the first hosts are the fullest
+        expected = [{"hostname": "host%02d" % (x + 1),
+                     "weight": (10 + x * 10) / 100.0,
+                     "capabilities": {'compute': test_abstract_scheduler.
+                                      _host_caps(x)}}
+                    for x in xrange(num)]
+        self.assertWeights(expected, num, request_spec, hosts)
@@ -17,13 +17,22 @@
 #    under the License.
 
 from M2Crypto import X509
+import time
 import unittest
+import urllib
+
+import webob
+import webob.dec
 
 from nova import crypto
+from nova import fakememcache
 from nova import flags
 from nova import log as logging
 from nova import test
+from nova.auth import dbdriver
 from nova.auth import manager
+from nova.auth import signer
+from nova.api import ec2
 from nova.api.ec2 import cloud
 from nova.auth import fakeldap
 
@@ -389,6 +398,146 @@ class AuthManagerDbTestCase(_AuthManagerBaseTestCase):
     auth_driver = 'nova.auth.dbdriver.DbDriver'
 
 
+class AuthManagerDbCachedTestCase(AuthManagerDbTestCase):
+    """Runs the same tests with the credential cache enabled."""
+    def setUp(self):
+        super(AuthManagerDbCachedTestCase, self).setUp()
+        self.flags(auth_cache_ttl=60)
+        self.manager.cache.clear()
+
+    def test_secrets_stay_out_of_memcache(self):
+        self.flags(auth_cache_memcache=True)
+        with user_generator(self.manager, name='test1', secret='classified',
+                            access='private-party'):
+            user = self.manager.get_user_from_access_key('private-party')
+            self.assertEqual(user.secret, 'classified')
+            for _timeout, value in self.manager.mc.cache.values():
+                self.assertFalse('classified' in repr(value))
+
+    def test_modified_secret_is_not_served_from_cache(self):
+        with user_generator(self.manager, name='test1', secret='old',
+                            access='private-party'):
+            self.manager.get_user_from_access_key('private-party')
+            self.manager.modify_user('test1', secret_key='new')
+            user = self.manager.get_user_from_access_key('private-party')
+            self.assertEqual(user.secret, 'new')
+
+
+class CredentialCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(CredentialCacheTestCase, self).setUp()
+        self.flags(auth_cache_ttl=60, auth_cache_size=4)
+        self.mc = fakememcache.Client()
+        self.cache = manager.CredentialCache(self.mc)
+
+    def test_disabled(self):
+        self.flags(auth_cache_ttl=0)
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.local.entries['a'][0] = time.time() - 1
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_least_recently_used_are_evicted(self):
+        for key in 'abcd':
+            self.cache.set(key, key)
+        self.cache.get('a')
+        self.cache.set('e', 'e')
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(len(self.cache.local.entries), 4)
+
+    def test_memcache_tier(self):
+        self.flags(auth_cache_memcache=True)
+        self.cache.set('a', 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_unshared_entries_stay_out_of_memcache(self):
+        self.flags(auth_cache_memcache=True)
+        self.cache.set('a', 1, shared=False)
+        self.assertEqual(self.mc.cache, {})
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.get('a'), None)
+
+
+class AuthenticateCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(AuthenticateCacheTestCase, self).setUp()
+        self.flags(auth_driver='nova.auth.dbdriver.DbDriver',
+                   connection_type='fake')
+        self.manager = manager.AuthManager(new=True)
+        self.manager.mc.cache = {}
+        self.manager.cache.clear()
+        self.user = self.manager.create_user('cached', 'cached', 'secret')
+        self.project = self.manager.create_project('cached', 'cached')
+
+        @webob.dec.wsgify
+        def fake_app(req):
+            return req.environ['nova.context'].project_id
+
+        self.app = ec2.Authenticate(fake_app)
+
+    def tearDown(self):
+        self.manager.delete_project(self.project)
+        self.manager.delete_user(self.user)
+        self.manager.cache.clear()
+        super(AuthenticateCacheTestCase, self).tearDown()
+
+    def _request(self):
+        params = {'AWSAccessKeyId': 'cached:cached',
+                  'Action': 'DescribeRegions',
+                  'SignatureMethod': 'HmacSHA256',
+                  'SignatureVersion': '2',
+                  'Timestamp': '2011-10-01T12:00:00',
+                  'Version': '2009-11-30'}
+        params['Signature'] = signer.Signer('secret').generate(
+                params, 'GET', 'localhost:8773', '/services/Cloud/')
+        req = webob.Request.blank('/services/Cloud/?' +
+                                  urllib.urlencode(params))
+        req.host = 'localhost:8773'
+        return req
+
+    def _count_driver_lookups(self):
+        """Record the user and project lookups made through the driver."""
+        self.lookups = []
+
+        def counting(name):
+            orig = getattr(dbdriver.DbDriver, name)
+
+            def counted(drv, *args, **kwargs):
+                self.lookups.append(name)
+                return orig(drv, *args, **kwargs)
+            return counted
+
+        for name in ('get_user_from_access_key', 'get_project'):
+            self.stubs.Set(dbdriver.DbDriver, name, counting(name))
+
+    def _authenticate(self, requests):
+        """Authenticate requests times, return the driver lookups made."""
+        del self.lookups[:]
+        self.manager.cache.clear()
+        for i in xrange(requests):
+            res = self._request().get_response(self.app)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, 'cached')
+        return sorted(self.lookups)
+
+    def test_cache_saves_driver_lookups(self):
+        self._count_driver_lookups()
+        self.flags(auth_cache_ttl=0)
+        self.assertEqual(len(self._authenticate(5)), 10)
+        self.flags(auth_cache_ttl=60)
+        self.assertEqual(self._authenticate(5),
+                         ['get_project', 'get_user_from_access_key'])
+
+
 if __name__ == "__main__":
     # TODO: Implement use_fake as an option
     unittest.main()
@@ -29,6 +29,7 @@ from nova import db
 from nova import exception
 from nova import flags
 from nova import log as logging
+from nova.scheduler import api as scheduler_api
 from nova.scheduler import driver as scheduler_driver
 from nova import rpc
 from nova import test
@@ -889,6 +890,69 @@ class ComputeTestCase(test.TestCase):
         self.assertEqual(len(instances), 1)
         self.assertEqual(power_state.NOSTATE, instances[0]['power_state'])
 
+    def test_periodic_tasks_share_instance_snapshot(self):
+        """Power states are synced in one batch from a single fetch"""
+        self.stubs.Set(compute_manager.ComputeManager,
+                '_report_driver_status', nop_report_driver_status)
+        admin_context = context.get_admin_context()
+        instance_ids = [self._create_instance({'host': self.compute.host,
+                                               'power_state': state})
+                        for state in (power_state.RUNNING,
+                                      power_state.PAUSED,
+                                      power_state.NOSTATE)]
+
+        fetches = []
+        updates = []
+        compute_db = self.compute.db
+        real_get_all_by_host = compute_db.instance_get_all_by_host
+        real_update_power_states = compute_db.instance_update_power_states
+
+        def fake_get_all_by_host(context, host):
+            fetches.append(host)
+            return real_get_all_by_host(context, host)
+
+        def fake_update_power_states(context, power_states):
+            updates.append(power_states)
+            return real_update_power_states(context, power_states)
+
+        self.stubs.Set(compute_db, 'instance_get_all_by_host',
+                       fake_get_all_by_host)
+        self.stubs.Set(compute_db, 'instance_update_power_states',
+                       fake_update_power_states)
+
+        # None of the instances exist on the hypervisor
+        error_list = self.compute.periodic_tasks(admin_context)
+        self.assertFalse(error_list)
+        self.assertEqual(fetches, [self.compute.host])
+        self.assertEqual(updates, [{instance_ids[0]: power_state.NOSTATE,
+                                    instance_ids[1]: power_state.NOSTATE}])
+        for instance_id in instance_ids:
+            instance = db.instance_get(admin_context, instance_id)
+            self.assertEqual(power_state.NOSTATE, instance['power_state'])
+            db.instance_destroy(admin_context, instance_id)
+
+    def test_init_host_applies_firewall_before_reboot(self):
+        """Guests are restarted only once their rules are in place"""
+        self.flags(start_guests_on_host_boot=True)
+        admin_context = context.get_admin_context()
+        instance_id = self._create_instance({'host': self.compute.host,
+                                             'power_state':
+                                                 power_state.RUNNING})
+        calls = []
+
+        def fake_filter_defer_apply_off():
+            calls.append('apply')
+
+        def fake_reboot_instance(context, instance_id):
+            calls.append(('reboot', instance_id))
+
+        self.stubs.Set(self.compute.driver, 'filter_defer_apply_off',
+                       fake_filter_defer_apply_off)
+        self.stubs.Set(self.compute, 'reboot_instance', fake_reboot_instance)
+        self.compute.init_host()
+        self.assertEqual(calls, ['apply', ('reboot', instance_id)])
+        db.instance_destroy(admin_context, instance_id)
+
     def test_get_all_by_name_regexp(self):
         """Test searching instances by name (display_name)"""
         c = context.get_admin_context()
@@ -934,6 +998,35 @@ class ComputeTestCase(test.TestCase):
         db.instance_destroy(c, instance_id2)
         db.instance_destroy(c, instance_id3)
 
+    def test_get_all_pages_through_child_zones(self):
+        """A marker from a child zone pages the combined listing"""
+        c = context.get_admin_context()
+        instance_id = self._create_instance({'display_name': 'zoned'})
+        search_opts = {'name': 'zoned', 'deleted': False}
+
+        class FakeServer(object):
+            def __init__(self, server_id):
+                self._info = {'id': server_id}
+
+        def fake_call_zone_method(context, method_name, **kwargs):
+            return [('child', [FakeServer(1001), FakeServer(1002)])]
+
+        self.stubs.Set(self.compute_api.db, 'zone_get_all',
+                       lambda context: ['child'])
+        self.stubs.Set(scheduler_api, 'call_zone_method',
+                       fake_call_zone_method)
+        instances = self.compute_api.get_all(c, search_opts, limit=2,
+                                             marker=instance_id)
+        self.assertEqual([instance['id'] for instance in instances],
+                         [1001, 1002])
+        instances = self.compute_api.get_all(c, search_opts, limit=2,
+                                             marker=1001)
+        self.assertEqual([instance['id'] for instance in instances], [1002])
+        self.assertRaises(exception.MarkerNotFound,
+                          self.compute_api.get_all, c, search_opts,
+                          marker=999)
+        db.instance_destroy(c, instance_id)
+
     def test_get_all_by_instance_name_regexp(self):
         """Test searching instances by name"""
         self.flags(instance_name_template='instance-%d')
@@ -23,17 +23,20 @@ import datetime
 from nova import test
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
+from nova.db.sqlalchemy import api as sqlalchemy_api
 
 FLAGS = flags.FLAGS
 
 
-def _setup_networking(instance_id, ip='1.2.3.4', flo_addr='1.2.1.2'):
+def _setup_networking(instance_id, ip='1.2.3.4', flo_addr='1.2.1.2',
+                      mac='56:12:12:12:12:12'):
     ctxt = context.get_admin_context()
     network_ref = db.project_get_networks(ctxt,
                                            'fake',
                                            associate=True)[0]
-    vif = {'address': '56:12:12:12:12:12',
+    vif = {'address': mac,
            'network_id': network_ref['id'],
            'instance_id': instance_id}
     vif_ref = db.virtual_interface_create(ctxt, vif)
@@ -101,6 +104,121 @@ class DbApiTestCase(test.TestCase):
         else:
             self.assertTrue(result[1].deleted)
 
+    def test_instance_get_all_by_filters_regexp(self):
+        for name in ('woot', 'woo', 'not-woot', 'a_b%'):
+            db.instance_create(self.context, {'display_name': name,
+                                              'project_id': self.project_id})
+
+        def _names(filters):
+            result = db.instance_get_all_by_filters(self.context, filters)
+            return sorted([inst['display_name'] for inst in result])
+
+        self.assertEqual(['woo', 'woot'], _names({'display_name': 'woo.*'}))
+        self.assertEqual(['not-woot', 'woot'],
+                         _names({'display_name': '.*oot'}))
+        self.assertEqual(['woo'], _names({'display_name': '^woo$'}))
+        self.assertEqual(['woot'], _names({'display_name': 'wo+t'}))
+        self.assertEqual(['a_b%'], _names({'display_name': 'a_b%'}))
+        self.assertEqual([], _names({'display_name': 'axb'}))
+
+    def test_instance_get_all_by_filters_metadata(self):
+        inst1 = db.instance_create(self.context,
+                                   {'project_id': self.project_id,
+                                    'metadata': {'key3': 'value3'}})
+        inst2 = db.instance_create(self.context,
+                                   {'project_id': self.project_id,
+                                    'metadata': {'key3': 'value3',
+                                                 'key4': 'value4'}})
+
+        def _ids(filters):
+            result = db.instance_get_all_by_filters(self.context, filters)
+            return sorted([inst['id'] for inst in result])
+
+        self.assertEqual(sorted([inst1['id'], inst2['id']]),
+                         _ids({'metadata': {'key3': 'value3'}}))
+        self.assertEqual([inst2['id']],
+                         _ids({'metadata': [{'key4': 'value4'},
+                                            {'key3': 'value3'}]}))
+        self.assertEqual([], _ids({'metadata': {'key3': 'value4'}}))
+        self.assertEqual([], _ids({'metadata': [{'key3': 'value3',
+                                                 'key4': 'value4'}]}))
+
+    def test_instance_get_all_by_filters_paginated(self):
+        created_at = datetime.datetime(2011, 1, 1)
+        instances = []
+        for i in xrange(6):
+            # Pairs of instances share a created_at, so id breaks the tie
+            values = {'display_name': 'inst%d' % (i % 2),
+                      'project_id': self.project_id,
+                      'created_at': created_at +
+                                    datetime.timedelta(seconds=i / 2)}
+            instances.append(db.instance_create(self.context, values))
+        instances.sort(key=lambda inst: (inst['created_at'], inst['id']),
+                       reverse=True)
+        ids = [inst['id'] for inst in instances]
+        inst1_ids = [inst['id'] for inst in instances
+                     if inst['display_name'] == 'inst1']
+
+        def _page(filters, limit, marker=None):
+            result = db.instance_get_all_by_filters(self.context, filters,
+                                                    limit=limit,
+                                                    marker=marker)
+            return [inst['id'] for inst in result]
+
+        self.assertEqual(ids[:4], _page({}, 4))
+        self.assertEqual(ids[2:5], _page({}, 3, marker=ids[1]))
+        self.assertEqual([], _page({}, 3, marker=ids[5]))
+
+        # 'inst[1]' can't be done in SQL, so rows dropped by the python
+        # filter have to be made up from the following rows
+        self.assertEqual(inst1_ids[:2],
+                         _page({'display_name': 'inst[1]'}, 2))
+        self.assertEqual(inst1_ids[1:],
+                         _page({'display_name': 'inst[1]'}, 2,
+                               marker=inst1_ids[0]))
+
+        self.assertRaises(exception.MarkerNotFound,
+                          db.instance_get_all_by_filters, self.context, {},
+                          marker=-1)
+
+    def test_instance_get_all_by_filters_marker_is_scoped(self):
+        other_context = context.RequestContext('other', 'other')
+        other = db.instance_create(other_context, {'project_id': 'other'})
+        deleted = db.instance_create(self.context,
+                                     {'project_id': self.project_id})
+        db.instance_destroy(self.context, deleted['id'])
+
+        # another project's instance is not a valid marker
+        self.assertRaises(exception.MarkerNotFound,
+                          db.instance_get_all_by_filters, self.context, {},
+                          limit=2, marker=other['id'])
+        # neither is a deleted one when deleted instances aren't listed
+        self.assertRaises(exception.MarkerNotFound,
+                          db.instance_get_all_by_filters, self.context,
+                          {'deleted': False}, limit=2, marker=deleted['id'])
+
+    def test_regexp_to_like(self):
+        self.assertEqual('woo%', sqlalchemy_api._regexp_to_like('woo.*'))
+        self.assertEqual('%oot%', sqlalchemy_api._regexp_to_like('.*oot'))
+        self.assertEqual('1.2.3.4',
+                         sqlalchemy_api._regexp_to_like('^1\\.2\\.3\\.4$'))
+        self.assertEqual('a_b\\%%', sqlalchemy_api._regexp_to_like('a.b%'))
+        self.assertEqual(None, sqlalchemy_api._regexp_to_like('\\d+'))
+        self.assertEqual(None, sqlalchemy_api._regexp_to_like('wo+t'))
+
+    def test_instance_update_power_states(self):
+        ctxt = context.get_admin_context()
+        instances = [db.instance_create(ctxt, {'power_state': 1})
+                     for x in xrange(4)]
+        db.instance_update_power_states(ctxt,
+                {instances[0]['id']: 4, instances[1]['id']: 4,
+                 instances[2]['id']: 0})
+        states = [db.instance_get(ctxt, instance['id'])['power_state']
+                  for instance in instances]
+        self.assertEqual([4, 4, 0, 1], states)
+        self.assertNotEqual(None,
+                db.instance_get(ctxt, instances[0]['id'])['updated_at'])
+
     def test_migration_get_all_unconfirmed(self):
         ctxt = context.get_admin_context()
 
@@ -123,3 +241,51 @@ class DbApiTestCase(test.TestCase):
         results = db.migration_get_all_unconfirmed(ctxt, 10)
         self.assertEqual(0, len(results))
         db.migration_update(ctxt, migration.id, {"status": "CONFIRMED"})
+
+    def test_fixed_ip_bulk_create_and_associate_by_address(self):
+        ctxt = context.get_admin_context()
+        network = db.network_create_safe(ctxt, {'cidr': '10.9.0.0/29'})
+        ips = [{'network_id': network['id'],
+                'address': '10.9.0.%d' % i,
+                'reserved': i < 2} for i in xrange(8)]
+        db.fixed_ip_bulk_create(ctxt, ips)
+        free = db.fixed_ip_get_free_by_network(ctxt, network['id'])
+        self.assertEqual(sorted(free), ['10.9.0.%d' % i for i in xrange(2, 8)])
+
+        instance = db.instance_create(ctxt, {})
+        address = db.fixed_ip_associate_pool(ctxt, network['id'],
+                                             instance['id'],
+                                             address='10.9.0.5')
+        self.assertEqual(address, '10.9.0.5')
+        self.assertRaises(exception.NoMoreFixedIps,
+                          db.fixed_ip_associate_pool, ctxt, network['id'],
+                          instance['id'], address='10.9.0.5')
+        self.assertRaises(exception.NoMoreFixedIps,
+                          db.fixed_ip_associate_pool, ctxt, network['id'],
+                          instance['id'], address='10.9.0.1')
+        free = db.fixed_ip_get_free_by_network(ctxt, network['id'])
+        self.assertFalse('10.9.0.5' in free)
+
+    def test_virtual_interface_get_by_ip_filter(self):
+        ctxt = context.get_admin_context()
+        instance1 = db.instance_create(ctxt, {})
+        instance2 = db.instance_create(ctxt, {})
+        _setup_networking(instance1['id'], ip='10.1.0.5', flo_addr='1.2.1.2')
+        _setup_networking(instance2['id'], ip='10.2.0.5', flo_addr='1.3.1.2',
+                          mac='56:12:12:12:12:13')
+
+        def _instances(**filters):
+            vifs = db.virtual_interface_get_by_ip_filter(ctxt, **filters)
+            return sorted(vif['instance_id'] for vif in vifs)
+
+        self.assertEqual(_instances(fixed_ip='10.1.0.5'), [instance1['id']])
+        self.assertEqual(_instances(ip='10\.2\.'), [instance2['id']])
+        self.assertEqual(_instances(ip='1.3.1'), [instance2['id']])
+        self.assertEqual(_instances(ip='10.*5$'),
+                         sorted([instance1['id'], instance2['id']]))
+        self.assertEqual(_instances(ip='192.168'), [])
+        self.assertEqual(_instances(), [])
+        # NOTE: an empty regexp matches everything, so it is left to the
+        #       caller to list all vifs
+        self.assertEqual(db.virtual_interface_get_by_ip_filter(ctxt, ip=''),
+                         None)
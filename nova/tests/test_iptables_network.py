@@ -162,3 +162,74 @@ class IptablesManagerTestCase(test.TestCase):
             self.assertTrue('-A %s -j run_tests.py-%s' \
                             % (chain, chain) in new_lines,
                             "Built-in chain %s not wrapped" % (chain,))
+
+    def test_remove_chain_removes_jumps(self):
+        table = self.manager.ipv4['filter']
+        table.add_chain('inst-1')
+        table.add_chain('inst-10')
+        table.add_rule('inst-1', '-j ACCEPT')
+        table.add_rule('inst-10', '-j ACCEPT')
+        table.add_rule('local', '-d 10.0.0.1 -j $inst-1')
+        table.add_rule('local', '-d 10.0.0.10 -j $inst-10')
+
+        table.remove_chain('inst-1')
+        rules = [(rule.chain, rule.rule) for rule in table.rules
+                 if rule.chain in ('local', 'inst-1', 'inst-10')]
+        self.assertEqual(rules, [('inst-10', '-j ACCEPT'),
+                                 ('local', '-d 10.0.0.10 -j %s-inst-10' %
+                                           linux_net.binary_name)])
+
+    def test_empty_chain(self):
+        table = self.manager.ipv4['filter']
+        table.add_rule('INPUT', '-s 1.2.3.4 -j DROP')
+        table.add_rule('INPUT', '-s 1.2.3.5 -j DROP')
+        table.empty_chain('INPUT')
+        self.assertFalse([rule for rule in table.rules
+                          if rule.chain == 'INPUT' and rule.wrap])
+        # The unwrapped builtin chain keeps its jump to the wrapped one
+        self.assertTrue([rule for rule in table.rules
+                         if rule.chain == 'INPUT' and not rule.wrap])
+
+    def _fake_execute(self, calls):
+        def fake_execute(*cmd, **kwargs):
+            calls.append(cmd)
+            if cmd[0].endswith('-save'):
+                if cmd[-1] == 'nat':
+                    return '\n'.join(self.sample_nat), ''
+                return '\n'.join(self.sample_filter), ''
+            return '', ''
+        return fake_execute
+
+    def test_apply_only_changed_tables(self):
+        self.flags(use_ipv6=False)
+        calls = []
+        self.manager.execute = self._fake_execute(calls)
+        self.manager.apply()
+        self.assertEqual(len(calls), 4)
+
+        # Nothing changed, nothing to do
+        calls[:] = []
+        self.manager.apply()
+        self.assertEqual(calls, [])
+
+        self.manager.ipv4['nat'].add_rule('snat', '-s 1.2.3.4 -j SNAT')
+        self.manager.apply()
+        self.assertEqual(calls, [('iptables-save', '-t', 'nat'),
+                                 ('iptables-restore',)])
+
+    def test_deferred_apply(self):
+        self.flags(use_ipv6=False)
+        calls = []
+        self.manager.execute = self._fake_execute(calls)
+        self.manager.apply()
+        calls[:] = []
+
+        self.manager.defer_apply_on()
+        for x in xrange(10):
+            self.manager.ipv4['filter'].add_rule('FORWARD',
+                                                 '-s 1.2.3.%d -j DROP' % x)
+            self.manager.apply()
+        self.assertEqual(calls, [])
+        self.manager.defer_apply_off()
+        self.assertEqual(calls, [('iptables-save', '-t', 'filter'),
+                                 ('iptables-restore',)])
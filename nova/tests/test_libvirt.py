@@ -22,6 +22,7 @@ import re
 import shutil
 import sys
 import tempfile
+import time
 
 from xml.etree.ElementTree import fromstring as xml_to_tree
 from xml.dom.minidom import parseString as xml_to_dom
@@ -36,9 +37,13 @@ from nova import utils
 from nova.api.ec2 import cloud
 from nova.compute import power_state
 from nova.compute import vm_states
+from nova.network import linux_net
+from nova.scheduler import abstract_scheduler
+from nova.scheduler.filters import instance_type_filter
 from nova.virt import driver
 from nova.virt.libvirt import connection
 from nova.virt.libvirt import firewall
+from nova.virt.libvirt import imagecache
 from nova.virt.libvirt import volume
 from nova.volume import driver as volume_driver
 from nova.tests import fake_network
@@ -214,6 +219,120 @@ class CacheConcurrencyTestCase(test.TestCase):
             eventlet.sleep(0)
 
 
+class ImageCacheManagerTestCase(test.TestCase):
+    def setUp(self):
+        super(ImageCacheManagerTestCase, self).setUp()
+        self.instances_path = tempfile.mkdtemp()
+        self.flags(instances_path=self.instances_path,
+                   image_cache_min_age=600,
+                   image_cache_max_unused_age=3600,
+                   image_cache_max_size_mb=0)
+        self.base_dir = os.path.join(self.instances_path, '_base')
+        os.mkdir(self.base_dir)
+        self.backing_files = {}
+        self.stubs.Set(imagecache, 'get_backing_file',
+                       lambda path: self.backing_files.get(path))
+        self.manager = imagecache.ImageCacheManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.instances_path)
+        super(ImageCacheManagerTestCase, self).tearDown()
+
+    def _make_base(self, fname, age, size_mb=1):
+        path = os.path.join(self.base_dir, fname)
+        with open(path, 'w') as f:
+            f.write('x' * (size_mb * 1024 * 1024))
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def _make_instance(self, name, base):
+        instance_dir = os.path.join(self.instances_path, name)
+        os.mkdir(instance_dir)
+        disk = os.path.join(instance_dir, 'disk')
+        open(disk, 'w').close()
+        self.backing_files[disk] = base
+
+    def test_removes_old_unused_bases(self):
+        used = self._make_base('used', 7200)
+        old = self._make_base('old', 7200)
+        recent = self._make_base('recent', 60)
+        self._make_instance('instance-00000001', used)
+        self.manager.verify_base_images()
+        self.assertTrue(os.path.exists(used))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+        self.assertEqual(self.manager.evicted, 1)
+
+    def test_removes_least_recently_used_over_budget(self):
+        self.flags(image_cache_max_unused_age=0, image_cache_max_size_mb=1)
+        oldest = self._make_base('oldest', 3000)
+        older = self._make_base('older', 2000)
+        newest = self._make_base('newest', 1000)
+        self.manager.verify_base_images()
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_cache_base_records_hits_and_misses(self):
+        created = []
+
+        def fake_create(target):
+            created.append(target)
+            open(target, 'w').close()
+
+        conn = connection.LibvirtConnection
+        conn._cache_base(fake_create, 'fname')
+        conn._cache_base(fake_create, 'fname')
+        self.assertEqual(created, [os.path.join(self.base_dir, 'fname')])
+        stats = connection.image_cache.get_stats()
+        self.assertTrue(stats['image_cache_hits'] >= 1)
+        self.assertTrue(stats['image_cache_misses'] >= 1)
+        self.assertEqual(stats['image_cache_images'], 1)
+        # the lock files stay out of the way of the bases
+        self.assertTrue(os.path.isdir(os.path.join(self.base_dir, 'locks')))
+
+    def test_precreate_local_bases(self):
+        inst_types = {'m1.tiny': {'local_gb': 0, 'swap': 0},
+                      'm1.small': {'local_gb': 20, 'swap': 512},
+                      'm1.medium': {'local_gb': 40, 'swap': 512}}
+        self.stubs.Set(connection.instance_types, 'get_all_types',
+                       lambda: inst_types)
+        conn = connection.LibvirtConnection(True)
+        created = []
+        self.stubs.Set(conn, '_cache_base',
+                       lambda fn, fname, **kwargs: created.append(fname))
+        conn._precreate_local_bases(['linux'])
+        self.assertEqual(created, ['ephemeral_0_20_linux',
+                                   'ephemeral_0_40_linux',
+                                   'swap_512'])
+
+    def test_host_stats_can_be_scheduled_on(self):
+        self.flags(image_cache_manager_interval=60)
+        conn = connection.LibvirtConnection(True)
+        self.stubs.Set(conn, 'get_memory_mb_total', lambda: 2048)
+        self.stubs.Set(conn, 'get_memory_mb_used', lambda: 512)
+        stats = conn.get_host_stats(refresh=True)
+        self.assertEqual(stats['host_memory_free'], 1536 * 1024 * 1024)
+        self.assertTrue('image_cache_hits' in stats)
+
+        host_list = [('host1', stats)]
+        instance_type = {'memory_mb': 1024, 'local_gb': 0, 'extra_specs': {}}
+        hosts = instance_type_filter.InstanceTypeFilter().filter_hosts(
+                host_list, instance_type)
+        self.assertEqual([host for host, caps in hosts], ['host1'])
+        scheduler = abstract_scheduler.AbstractScheduler()
+        hosts = scheduler.filter_hosts('compute',
+                                       {'instance_type': instance_type},
+                                       host_list)
+        self.assertEqual([host for host, caps in hosts], ['host1'])
+
+    def test_no_host_stats_when_cache_is_not_managed(self):
+        self.flags(image_cache_manager_interval=0)
+        conn = connection.LibvirtConnection(True)
+        self.assertEqual(conn.get_host_stats(refresh=True), None)
+
+
 class FakeVolumeDriver(object):
     def __init__(self, *args, **kwargs):
         pass
@@ -949,6 +1068,50 @@ class LibvirtConnTestCase(test.TestCase):
         shutil.rmtree(os.path.join(FLAGS.instances_path, instance.name))
         shutil.rmtree(os.path.join(FLAGS.instances_path, '_base'))
 
+    def _create_image_concurrently(self, fail=None):
+        """Run _create_image with _cache_image blocked until all started"""
+        self.flags(instances_path=tempfile.mkdtemp())
+        self.stubs.Set(utils, 'execute', lambda *args, **kwargs: None)
+
+        instance_data = dict(self.test_instance)
+        instance_data['kernel_id'] = '1'
+        instance_data['ramdisk_id'] = '2'
+        instance = db.instance_create(self.context, instance_data)
+
+        started = []
+        release = eventlet.event.Event()
+
+        def fake_cache_image(fn, target, fname, cow=False, *args, **kwargs):
+            started.append(os.path.basename(target))
+            release.wait()
+            if fname == fail:
+                raise exception.Error(fname)
+
+        conn = connection.LibvirtConnection(False)
+        self.stubs.Set(conn, '_cache_image', fake_cache_image)
+        creating = eventlet.spawn(conn._create_image, self.context,
+                                  instance, '<domain/>', network_info=[])
+        eventlet.sleep(0)
+        # every image started before any of them is done
+        self.assertEqual(sorted(started),
+                         ['disk', 'disk.local', 'kernel', 'ramdisk'])
+        self.assertFalse(creating.dead)
+        release.send()
+        return creating
+
+    def test_create_image_in_parallel(self):
+        try:
+            self._create_image_concurrently().wait()
+        finally:
+            shutil.rmtree(FLAGS.instances_path)
+
+    def test_create_image_waits_for_all_images_on_failure(self):
+        try:
+            creating = self._create_image_concurrently(fail='00000001')
+            self.assertRaises(exception.Error, creating.wait)
+        finally:
+            shutil.rmtree(FLAGS.instances_path)
+
     def test_get_host_ip_addr(self):
         conn = connection.LibvirtConnection(False)
         ip = conn.get_host_ip_addr()
@@ -1306,14 +1469,235 @@ class IptablesFirewallTestCase(test.TestCase):
 
     def test_do_refresh_security_group_rules(self):
         instance_ref = self._create_instance_ref()
+        self.fw.instances[instance_ref['id']] = instance_ref
         self.mox.StubOutWithMock(self.fw,
                                  'add_filters_for_instance',
                                  use_mock_anything=True)
-        self.fw.prepare_instance_filter(instance_ref, mox.IgnoreArg())
-        self.fw.instances[instance_ref['id']] = instance_ref
+        self.mox.StubOutWithMock(self.fw,
+                                 'remove_filters_for_instance',
+                                 use_mock_anything=True)
         self.mox.ReplayAll()
+        # Instance chains only jump to the group chains, so refreshing a
+        # group the instance neither joined nor left must not rebuild them
         self.fw.do_refresh_security_group_rules("fake")
 
+    def test_refresh_security_group_rules_membership(self):
+        admin_ctxt = context.get_admin_context()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 22,
+                                       'to_port': 22,
+                                       'cidr': '192.168.10.0/24'})
+        instance_ref = self._create_instance_ref()
+        db.instance_add_security_group(admin_ctxt, instance_ref['id'],
+                                       secgroup['id'])
+        self.stubs.Set(self.fw.iptables, 'apply', lambda: None)
+        self.fw.prepare_instance_filter(instance_ref,
+                                        _fake_network_info(self.stubs, 1))
+
+        chain_name = self.fw._security_group_chain_name(secgroup['id'])
+        jump = '-j %s-%s' % (linux_net.binary_name, chain_name)
+        instance_chain = self.fw._instance_chain_name(instance_ref)
+
+        def instance_chain_rules():
+            return [rule.rule
+                    for rule in self.fw.iptables.ipv4['filter'].rules
+                    if rule.chain == instance_chain]
+
+        self.assertTrue(jump in instance_chain_rules())
+
+        # remove_security_group casts a rules refresh of the group, which
+        # has to take the access it granted away
+        db.instance_remove_security_group(admin_ctxt, instance_ref['id'],
+                                          secgroup['id'])
+        self.fw.refresh_security_group_rules(secgroup['id'])
+        self.assertFalse(jump in instance_chain_rules())
+        self.assertEquals(self._security_group_chain_rules(secgroup['id']),
+                          [])
+        self.assertFalse(secgroup['id'] in self.fw.security_group_rules)
+
+        # and add_security_group one which grants it again
+        db.instance_add_security_group(admin_ctxt, instance_ref['id'],
+                                       secgroup['id'])
+        self.fw.refresh_security_group_rules(secgroup['id'])
+        self.assertTrue(jump in instance_chain_rules())
+        self.assertEquals(self._security_group_chain_rules(secgroup['id']),
+                          ['-j ACCEPT -p tcp --dport 22 -s 192.168.10.0/24'])
+
+    def _security_group_chain_rules(self, security_group_id):
+        chain_name = self.fw._security_group_chain_name(security_group_id)
+        return [rule.rule for rule in self.fw.iptables.ipv4['filter'].rules
+                if rule.chain == chain_name]
+
+    def test_shared_security_group_chains(self):
+        admin_ctxt = context.get_admin_context()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        src_secgroup = db.security_group_create(admin_ctxt,
+                                                {'user_id': 'fake',
+                                                 'project_id': 'fake',
+                                                 'name': 'testsourcegroup',
+                                                 'description': 'src group'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 22,
+                                       'to_port': 22,
+                                       'cidr': '192.168.10.0/24'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 80,
+                                       'to_port': 80,
+                                       'group_id': src_secgroup['id']})
+
+        instances = [self._create_instance_ref() for i in range(2)]
+        src_instance_ref = self._create_instance_ref()
+        for instance_ref in instances:
+            db.instance_add_security_group(admin_ctxt, instance_ref['id'],
+                                           secgroup['id'])
+        db.instance_add_security_group(admin_ctxt, src_instance_ref['id'],
+                                       src_secgroup['id'])
+
+        src_ips = ['10.0.0.1']
+        self.stubs.Set(db, 'instance_get_fixed_addresses',
+                       lambda *args, **kwargs: src_ips)
+        self.stubs.Set(self.fw.iptables, 'apply', lambda: None)
+
+        network_info = _fake_network_info(self.stubs, 1)
+        for instance_ref in instances:
+            self.fw.prepare_instance_filter(instance_ref, network_info)
+
+        # The group is rendered once, and both instances jump to it
+        self.assertEquals(self._security_group_chain_rules(secgroup['id']),
+                          ['-j ACCEPT -p tcp --dport 22 -s 192.168.10.0/24',
+                           '-j ACCEPT -p tcp --dport 80 -s 10.0.0.1'])
+        chain_name = self.fw._security_group_chain_name(secgroup['id'])
+        jump = '-j %s-%s' % (linux_net.binary_name, chain_name)
+        for instance_ref in instances:
+            instance_chain = self.fw._instance_chain_name(instance_ref)
+            self.assertTrue(jump in [rule.rule for rule in
+                                     self.fw.iptables.ipv4['filter'].rules
+                                     if rule.chain == instance_chain])
+
+        self.mox.StubOutWithMock(self.fw, 'add_filters_for_instance')
+        self.mox.ReplayAll()
+
+        # A new rule only re-renders the group chain
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'udp',
+                                       'from_port': 53,
+                                       'to_port': 53,
+                                       'cidr': '192.168.10.0/24'})
+        self.fw.refresh_security_group_rules(secgroup['id'])
+        self.assertTrue('-j ACCEPT -p udp --dport 53 -s 192.168.10.0/24' in
+                        self._security_group_chain_rules(secgroup['id']))
+
+        # New members of the grantee group re-render the granting group
+        src_ips.append('10.0.0.2')
+        self.fw.refresh_security_group_members(src_secgroup['id'])
+        self.assertTrue('-j ACCEPT -p tcp --dport 80 -s 10.0.0.2' in
+                        self._security_group_chain_rules(secgroup['id']))
+
+        # The chain goes away with the last instance using it
+        self.fw.remove_filters_for_instance(instances[0])
+        self.assertTrue(secgroup['id'] in self.fw.security_group_rules)
+        self.fw.remove_filters_for_instance(instances[1])
+        self.assertFalse(secgroup['id'] in self.fw.security_group_rules)
+        self.assertEquals(self._security_group_chain_rules(secgroup['id']),
+                          [])
+        self.assertFalse(chain_name in
+                         self.fw.iptables.ipv4['filter'].chains)
+
+    def test_security_group_ipsets(self):
+        self.flags(firewall_use_ipset=True)
+        admin_ctxt = context.get_admin_context()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        src_secgroup = db.security_group_create(admin_ctxt,
+                                                {'user_id': 'fake',
+                                                 'project_id': 'fake',
+                                                 'name': 'testsourcegroup',
+                                                 'description': 'src group'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 80,
+                                       'to_port': 80,
+                                       'group_id': src_secgroup['id']})
+        instance_ref = self._create_instance_ref()
+        db.instance_add_security_group(admin_ctxt, instance_ref['id'],
+                                       secgroup['id'])
+        for i in range(2):
+            src_instance_ref = self._create_instance_ref()
+            db.instance_add_security_group(admin_ctxt,
+                                           src_instance_ref['id'],
+                                           src_secgroup['id'])
+
+        def get_fixed_ips(context, instance_id):
+            return src_ips.get(instance_id, [])
+
+        commands = []
+
+        def fake_execute(*cmd, **kwargs):
+            commands.append(cmd)
+            return '', ''
+
+        src_ips = dict((instance['id'], ['10.0.0.%d' % instance['id']])
+                       for instance in db.security_group_get(
+                           admin_ctxt, src_secgroup['id'])['instances'])
+        self.stubs.Set(db, 'instance_get_fixed_addresses', get_fixed_ips)
+        self.stubs.Set(utils, 'execute', fake_execute)
+        self.stubs.Set(self.fw.iptables, 'apply', lambda: None)
+
+        network_info = _fake_network_info(self.stubs, 1)
+        self.fw.prepare_instance_filter(instance_ref, network_info)
+
+        # One rule matches the whole group
+        set_name = self.fw._security_group_set_name(src_secgroup['id'])
+        self.assertEquals(self._security_group_chain_rules(secgroup['id']),
+                          ['-j ACCEPT -p tcp --dport 80 '
+                           '-m set --match-set %s src' % set_name])
+        self.assertEquals(commands[:2],
+                          [('ipset', 'create', set_name, 'hash:ip', '-exist'),
+                           ('ipset', 'flush', set_name)])
+        self.assertEquals(sorted(cmd[3] for cmd in commands[2:]),
+                          sorted(ip for ips in src_ips.values()
+                                 for ip in ips))
+
+        # Membership changes only touch the changed members
+        commands[:] = []
+        first, second = sorted(src_ips.keys())
+        del src_ips[first]
+        src_ips[second].append('10.0.1.1')
+        self.fw.refresh_security_group_members(src_secgroup['id'])
+        self.assertEquals(sorted(commands),
+                          [('ipset', 'add', set_name, '10.0.1.1', '-exist'),
+                           ('ipset', 'del', set_name, '10.0.0.%d' % first,
+                            '-exist')])
+
+        # The set is destroyed once no rule refers to it
+        commands[:] = []
+        self.fw.instances[instance_ref['id']] = instance_ref
+        self.fw.network_infos[instance_ref['id']] = network_info
+        self.stubs.Set(self.fw.nwfilter, 'unfilter_instance',
+                       lambda *args: None)
+        self.fw.unfilter_instance(instance_ref, network_info)
+        self.assertEquals(commands, [('ipset', 'destroy', set_name)])
+
     def test_unfilter_instance_undefines_nwfilter(self):
         # Skip if non-libvirt environment
         if not self.lazy_load_library_exists():
@@ -15,6 +15,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import eventlet
+
 from nova import context
 from nova import db
 from nova import exception
@@ -201,23 +203,16 @@ class LinuxNetworkTestCase(test.TestCase):
     def test_update_dhcp_for_nw00(self):
         self.flags(use_single_default_gateway=True)
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+        self.mox.StubOutWithMock(db,
+                                 'virtual_interface_get_first_network_ids')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[0],
                                                         fixed_ips[3]])
-
-        db.network_get_associated_fixed_ips(mox.IgnoreArg(),
-                                            mox.IgnoreArg())\
-                                            .AndReturn([fixed_ips[0],
-                                                        fixed_ips[3]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0], vifs[1]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2], vifs[3]])
+        db.virtual_interface_get_first_network_ids(mox.IgnoreArg(),
+                                                   set([0, 1]))\
+                                                   .AndReturn({0: 0, 1: 1})
         self.mox.ReplayAll()
 
         self.driver.update_dhcp(None, "eth0", networks[0])
@@ -225,27 +220,89 @@ class LinuxNetworkTestCase(test.TestCase):
     def test_update_dhcp_for_nw01(self):
         self.flags(use_single_default_gateway=True)
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+        self.mox.StubOutWithMock(db,
+                                 'virtual_interface_get_first_network_ids')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[1],
                                                         fixed_ips[2]])
-
-        db.network_get_associated_fixed_ips(mox.IgnoreArg(),
-                                            mox.IgnoreArg())\
-                                            .AndReturn([fixed_ips[1],
-                                                        fixed_ips[2]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0], vifs[1]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2], vifs[3]])
+        db.virtual_interface_get_first_network_ids(mox.IgnoreArg(),
+                                                   set([0, 1]))\
+                                                   .AndReturn({0: 0, 1: 1})
         self.mox.ReplayAll()
 
         self.driver.update_dhcp(None, "eth0", networks[0])
 
+    def test_update_dhcp_skips_unchanged_hosts(self):
+        self.stubs.Set(db, 'network_get_associated_fixed_ips',
+                       lambda *args: [fixed_ips[0]])
+        self.stubs.Set(self.driver, '_dnsmasq_pid_for', lambda dev: 42)
+        conffile = self.driver._dhcp_file('fakedev', 'conf')
+        executes = []
+
+        def fake_execute(*cmd, **kwargs):
+            executes.append(cmd)
+            return conffile, ''
+        self.stubs.Set(self.driver, '_execute', fake_execute)
+        self.driver._dhcp_files.pop('fakedev', None)
+
+        self.driver.update_dhcp(None, 'fakedev', networks[0])
+        self.driver.update_dhcp(None, 'fakedev', networks[0])
+        hups = [cmd for cmd in executes if cmd[0] == 'kill']
+        self.assertEqual(hups, [('kill', '-HUP', 42)])
+
+    def test_update_dhcp_delayed(self):
+        self.flags(dhcp_update_delay=0.01)
+        updates = []
+        self.stubs.Set(self.driver, '_update_dhcp',
+                       lambda *args: updates.append(args))
+        for network in networks:
+            self.driver.update_dhcp(None, 'fakedev', network)
+        self.assertEqual(updates, [])
+        eventlet.sleep(0.05)
+        self.assertEqual(updates, [(None, 'fakedev', networks[1], None)])
+
+    def test_update_dhcp_delayed_merges_addresses(self):
+        self.flags(dhcp_update_delay=0.01)
+        updates = []
+        self.stubs.Set(self.driver, '_update_dhcp',
+                       lambda *args: updates.append(args))
+        self.driver.update_dhcp(None, 'fakedev', networks[0], '10.0.0.1')
+        self.driver.update_dhcp(None, 'fakedev', networks[0], '10.0.0.2')
+        eventlet.sleep(0.05)
+        self.assertEqual(updates, [(None, 'fakedev', networks[0],
+                                    set(['10.0.0.1', '10.0.0.2']))])
+
+    def test_update_dhcp_refreshes_only_given_address(self):
+        self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
+        db.network_get_associated_fixed_ips(mox.IgnoreArg(),
+                                            0).AndReturn([fixed_ips[0]])
+        db.network_get_associated_fixed_ips(mox.IgnoreArg(), 0,
+                set(['192.168.1.101'])).AndReturn([fixed_ips[3]])
+        db.network_get_associated_fixed_ips(mox.IgnoreArg(), 0,
+                set(['192.168.0.100'])).AndReturn([])
+        self.mox.ReplayAll()
+        self.stubs.Set(self.driver, '_dnsmasq_pid_for', lambda dev: 42)
+        conffile = self.driver._dhcp_file('fakedev', 'conf')
+        self.stubs.Set(self.driver, '_execute',
+                       lambda *cmd, **kwargs: (conffile, ''))
+        self.driver._dhcp_tables.pop('fakedev', None)
+
+        self.driver.update_dhcp(None, 'fakedev', networks[0])
+        self.driver.update_dhcp(None, 'fakedev', networks[0],
+                                '192.168.1.101')
+        self.assertEqual(self.driver._dhcp_files['fakedev'][0],
+                         "10.0.0.1,fake_instance00.novalocal,"
+                             "192.168.0.100\n"
+                         "10.0.0.4,fake_instance01.novalocal,"
+                             "192.168.1.101")
+        self.driver.update_dhcp(None, 'fakedev', networks[0],
+                                '192.168.0.100')
+        self.assertEqual(self.driver._dhcp_files['fakedev'][0],
+                         "10.0.0.4,fake_instance01.novalocal,"
+                             "192.168.1.101")
+
     def test_get_dhcp_hosts_for_nw00(self):
         self.flags(use_single_default_gateway=True)
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
@@ -286,23 +343,17 @@ class LinuxNetworkTestCase(test.TestCase):
 
     def test_get_dhcp_opts_for_nw00(self):
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+        self.mox.StubOutWithMock(db,
+                                 'virtual_interface_get_first_network_ids')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[0],
                                                         fixed_ips[3],
                                                         fixed_ips[4]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0],
-                                                         vifs[1],
-                                                         vifs[4]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2],
-                                                         vifs[3],
-                                                         vifs[5]])
+        db.virtual_interface_get_first_network_ids(mox.IgnoreArg(),
+                                                   set([0, 1]))\
+                                                   .AndReturn({0: 0, 1: 1})
         self.mox.ReplayAll()
 
         expected_opts = 'NW-i00000001-0,3'
@@ -312,23 +363,17 @@ class LinuxNetworkTestCase(test.TestCase):
 
     def test_get_dhcp_opts_for_nw01(self):
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+        self.mox.StubOutWithMock(db,
+                                 'virtual_interface_get_first_network_ids')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[1],
                                                         fixed_ips[2],
                                                         fixed_ips[5]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0],
-                                                         vifs[1],
-                                                         vifs[4]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2],
-                                                         vifs[3],
-                                                         vifs[5]])
+        db.virtual_interface_get_first_network_ids(mox.IgnoreArg(),
+                                                   set([0, 1]))\
+                                                   .AndReturn({0: 0, 1: 1})
         self.mox.ReplayAll()
 
         expected_opts = "NW-i00000000-1,3"
@@ -21,6 +21,7 @@
 import base64
 import webob
 
+from nova.api.ec2 import cloud
 from nova.api.ec2 import metadatarequesthandler
 from nova.db.sqlalchemy import api
 from nova import exception
@@ -78,6 +79,9 @@ class MetadataTestCase(test.TestCase):
         def floating_get(*args, **kwargs):
             return '99.99.99.99'
 
+        def fixed_ip_get_by_address(*args, **kwargs):
+            return {'instance_id': self.instance['id']}
+
         self.stubs.Set(network.API, 'get_instance_nw_info',
                 fake_get_instance_nw_info)
         self.stubs.Set(network.API, 'get_floating_ips_by_fixed_address',
@@ -85,11 +89,17 @@ class MetadataTestCase(test.TestCase):
         self.stubs.Set(api, 'instance_get', instance_get)
         self.stubs.Set(api, 'instance_get_all_by_filters', instance_get_list)
         self.stubs.Set(api, 'instance_get_floating_address', floating_get)
+        self.stubs.Set(api, 'fixed_ip_get_by_address', fixed_ip_get_by_address)
         self.app = metadatarequesthandler.MetadataRequestHandler()
         network_manager = fake_network.FakeNetworkManager()
         self.stubs.Set(self.app.cc.network_api,
                        'get_instance_uuids_by_ip_filter',
                        network_manager.get_instance_uuids_by_ip_filter)
+        cloud.metadata_cache.invalidate()
+
+    def tearDown(self):
+        cloud.metadata_cache.invalidate()
+        super(MetadataTestCase, self).tearDown()
 
     def request(self, relative_url):
         request = webob.Request.blank(relative_url)
@@ -144,3 +154,52 @@ class MetadataTestCase(test.TestCase):
     def test_local_hostname_fqdn(self):
         self.assertEqual(self.request('/meta-data/local-hostname'),
             "%s.%s" % (self.instance['hostname'], FLAGS.dhcp_domain))
+
+    def test_metadata_is_cached(self):
+        self.instance['user_data'] = base64.b64encode('happy')
+        self.assertEqual(self.request('/user-data'), 'happy')
+
+        def instance_get(*args, **kwargs):
+            self.fail('metadata was not cached')
+
+        self.stubs.Set(api, 'instance_get', instance_get)
+        self.assertEqual(self.request('/user-data'), 'happy')
+
+    def test_metadata_cache_invalidate(self):
+        self.instance['user_data'] = base64.b64encode('happy')
+        self.assertEqual(self.request('/user-data'), 'happy')
+        self.instance['user_data'] = base64.b64encode('happier')
+        cloud.metadata_cache.invalidate(self.instance['id'])
+        self.assertEqual(self.request('/user-data'), 'happier')
+
+    def test_metadata_cache_reused_address(self):
+        self.instance['user_data'] = base64.b64encode('happy')
+        self.assertEqual(self.request('/user-data'), 'happy')
+        # the address went to another instance, which this process was
+        # not told about
+        self.instance = dict(self.instance, id=2, project_id='other',
+                             user_data=base64.b64encode('other'))
+        self.assertEqual(self.request('/user-data'), 'other')
+
+    def test_metadata_cache_ttl(self):
+        self.flags(metadata_cache_ttl=0)
+        self.instance['user_data'] = base64.b64encode('happy')
+        self.assertEqual(self.request('/user-data'), 'happy')
+        self.instance['user_data'] = base64.b64encode('happier')
+        self.assertEqual(self.request('/user-data'), 'happier')
+
+    def test_mpi_computed_on_request(self):
+        calls = []
+
+        def get_mpi_data(*args):
+            calls.append(args)
+            return {'None': ['192.168.0.3 slots=1']}
+
+        self.stubs.Set(cloud.CloudController, '_get_mpi_data', get_mpi_data)
+        self.assertTrue('mpi/' in self.request('/meta-data/').split('\n'))
+        self.assertEqual(calls, [])
+        self.assertEqual(self.request('/meta-data/mpi/None'),
+                         '192.168.0.3 slots=1')
+        self.assertEqual(self.request('/meta-data/mpi/None'),
+                         '192.168.0.3 slots=1')
+        self.assertEqual(len(calls), 1)
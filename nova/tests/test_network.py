@@ -15,6 +15,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import mox
+from eventlet import greenpool
 
 from nova import context
 from nova import db
@@ -429,22 +430,24 @@ class VlanNetworkTestCase(test.TestCase):
             return {'address': '10.0.0.1'}
 
         def fake2(*args, **kwargs):
-            return 25
+            return {'floating_ips': 25}
 
         def fake3(*args, **kwargs):
-            return 0
+            return {'floating_ips': 0}
 
         self.stubs.Set(self.network.db, 'floating_ip_allocate_address', fake1)
 
         # this time should raise
-        self.stubs.Set(self.network.db, 'floating_ip_count_by_project', fake2)
+        self.stubs.Set(self.network.db, 'quota_usage_get_all_by_project',
+                       fake2)
         self.assertRaises(quota.QuotaError,
                           self.network.allocate_floating_ip,
                           ctxt,
                           ctxt.project_id)
 
         # this time should not
-        self.stubs.Set(self.network.db, 'floating_ip_count_by_project', fake3)
+        self.stubs.Set(self.network.db, 'quota_usage_get_all_by_project',
+                       fake3)
         self.network.allocate_floating_ip(ctxt, ctxt.project_id)
 
     def test_deallocate_floating_ip(self):
@@ -972,3 +975,81 @@ class CommonNetworkTestCase(test.TestCase):
         self.assertTrue(res)
         self.assertEqual(len(res), 1)
         self.assertEqual(res[0]['instance_id'], _vifs[2]['instance_id'])
+
+
+class FreeAddressMapTestCase(test.TestCase):
+    def test_take_round_robin(self):
+        free = network_manager.FreeAddressMap('10.0.0.0/29',
+                                              ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(len(free), 2)
+        self.assertEqual(free.take(), '10.0.0.2')
+        free.release('10.0.0.2')
+        self.assertEqual(free.take(), '10.0.0.3')
+        self.assertEqual(free.take(), '10.0.0.2')
+        self.assertEqual(free.take(), None)
+
+    def test_release_outside_cidr_is_ignored(self):
+        free = network_manager.FreeAddressMap('10.0.0.0/29', [])
+        free.release('10.0.1.2')
+        self.assertEqual(len(free), 0)
+
+    def test_associate_skips_taken_addresses(self):
+        manager = network_manager.FlatManager(host=HOST)
+        self.mox.StubOutWithMock(db, 'fixed_ip_get_free_by_network')
+        self.mox.StubOutWithMock(db, 'fixed_ip_associate_addresses')
+        db.fixed_ip_get_free_by_network(mox.IgnoreArg(),
+                                        0).AndReturn(['10.0.0.2',
+                                                      '10.0.0.3'])
+        db.fixed_ip_associate_addresses(mox.IgnoreArg(), 0, [1],
+                                        ['10.0.0.2']).AndReturn({})
+        db.fixed_ip_associate_addresses(mox.IgnoreArg(), 0, [1],
+                ['10.0.0.3']).AndReturn({1: '10.0.0.3'})
+        self.mox.ReplayAll()
+        ctxt = context.get_admin_context()
+        network = {'id': 0, 'cidr': '10.0.0.0/29'}
+        self.assertEqual(manager._associate_pool_address(ctxt, network, 1),
+                         '10.0.0.3')
+
+    def test_concurrent_requests_are_associated_together(self):
+        manager = network_manager.FlatManager(host=HOST)
+        self.mox.StubOutWithMock(db, 'fixed_ip_get_free_by_network')
+        self.mox.StubOutWithMock(db, 'fixed_ip_associate_addresses')
+        db.fixed_ip_get_free_by_network(mox.IgnoreArg(),
+                                        0).AndReturn(['10.0.0.2',
+                                                      '10.0.0.3'])
+        db.fixed_ip_associate_addresses(mox.IgnoreArg(), 0, [1, 2],
+                ['10.0.0.2', '10.0.0.3']).AndReturn({1: '10.0.0.2',
+                                                     2: '10.0.0.3'})
+        self.mox.ReplayAll()
+        ctxt = context.get_admin_context()
+        network = {'id': 0, 'cidr': '10.0.0.0/29'}
+        pool = greenpool.GreenPool()
+        first = pool.spawn(manager._associate_pool_address, ctxt, network, 1)
+        second = pool.spawn(manager._associate_pool_address, ctxt, network, 2)
+        self.assertEqual(first.wait(), '10.0.0.2')
+        self.assertEqual(second.wait(), '10.0.0.3')
+
+    def test_exhausted_batch_raises_for_the_rest(self):
+        manager = network_manager.FlatManager(host=HOST)
+        self.mox.StubOutWithMock(db, 'fixed_ip_get_free_by_network')
+        self.mox.StubOutWithMock(db, 'fixed_ip_associate_pool')
+        db.fixed_ip_get_free_by_network(mox.IgnoreArg(), 0).AndReturn([])
+        db.fixed_ip_associate_pool(mox.IgnoreArg(), 0,
+                1).AndRaise(exception.NoMoreFixedIps())
+        self.mox.ReplayAll()
+        ctxt = context.get_admin_context()
+        network = {'id': 0, 'cidr': '10.0.0.0/29'}
+        self.assertRaises(exception.NoMoreFixedIps,
+                          manager._associate_pool_address, ctxt, network, 1)
+        self.assertFalse(0 in manager.free_addresses)
+
+    def test_timed_out_addresses_invalidate_maps(self):
+        manager = network_manager.FlatDHCPManager(host=HOST)
+        manager.free_addresses[0] = network_manager.FreeAddressMap(
+                '10.0.0.0/29', [])
+        self.mox.StubOutWithMock(db, 'fixed_ip_disassociate_all_by_timeout')
+        db.fixed_ip_disassociate_all_by_timeout(mox.IgnoreArg(), HOST,
+                                                mox.IgnoreArg()).AndReturn(2)
+        self.mox.ReplayAll()
+        manager.periodic_tasks(context.get_admin_context())
+        self.assertEqual(manager.free_addresses, {})
@@ -128,6 +128,46 @@ class S3APITestCase(test.TestCase):
 
         self._ensure_no_buckets(bucket.get_all_keys())
 
+    def test_get_key_range(self):
+        """Test reading part of a key."""
+        self.flags(s3_chunk_size=4)
+        b = self.conn.create_bucket('testbucket')
+        k = b.new_key('somekey')
+        k.set_contents_from_string('0123456789')
+
+        key = b.get_key('somekey')
+        self.assertEquals(key.get_contents_as_string(), '0123456789')
+        self.assertEquals(key.get_contents_as_string(
+                                headers={'Range': 'bytes=2-4'}), '234')
+        self.assertEquals(key.get_contents_as_string(
+                                headers={'Range': 'bytes=7-'}), '789')
+        self.assertEquals(key.get_contents_as_string(
+                                headers={'Range': 'bytes=-2'}), '89')
+        self.assertRaises(boto_exception.S3ResponseError,
+                          key.get_contents_as_string,
+                          headers={'Range': 'bytes=10-'})
+
+    def test_list_keys(self):
+        """Test listing keys with prefix, marker and max-keys."""
+        b = self.conn.create_bucket('testbucket')
+        for key_name in ('c', 'a/2', 'b', 'a/1', 'a/3'):
+            b.new_key(key_name).set_contents_from_string(key_name)
+
+        names = [k.name for k in b.get_all_keys()]
+        self.assertEquals(names, ['a/1', 'a/2', 'a/3', 'b', 'c'])
+        names = [k.name for k in b.get_all_keys(prefix='a/')]
+        self.assertEquals(names, ['a/1', 'a/2', 'a/3'])
+        names = [k.name for k in b.get_all_keys(prefix='a/', marker='a/1')]
+        self.assertEquals(names, ['a/2', 'a/3'])
+        keys = b.get_all_keys(max_keys=2)
+        self.assertEquals([k.name for k in keys], ['a/1', 'a/2'])
+        self.assertTrue(keys.is_truncated)
+
+        b.get_key('a/2').delete()
+        b.new_key('a/0').set_contents_from_string('a/0')
+        names = [k.name for k in b.get_all_keys(prefix='a/')]
+        self.assertEquals(names, ['a/0', 'a/1', 'a/3'])
+
     def test_unknown_bucket(self):
         bucket_name = 'falalala'
         self.assertRaises(boto_exception.S3ResponseError,
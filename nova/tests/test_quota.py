@@ -25,6 +25,9 @@ from nova import rpc
 from nova import test
 from nova import volume
 from nova.compute import instance_types
+from nova.db.sqlalchemy import api as sqlalchemy_api
+from nova.db.sqlalchemy import models
+from nova.db.sqlalchemy.session import get_session
 from nova.scheduler import driver as scheduler_driver
 
 
@@ -393,3 +396,127 @@ class QuotaTestCase(test.TestCase):
         files = [(path, 'config = quotatest')]
         self.assertRaises(quota.QuotaError,
                           self._create_with_injected_files, files)
+
+    def test_usage_follows_instance_create_and_destroy(self):
+        admin_context = context.get_admin_context()
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['instances'], 0)
+        self.assertEqual(usage['cores'], 0)
+        instance_id = self._create_instance(cores=2)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['instances'], 1)
+        self.assertEqual(usage['cores'], 2)
+        db.instance_destroy(self.context, instance_id)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['instances'], 0)
+        self.assertEqual(usage['cores'], 0)
+
+    def test_usage_follows_volume_create_and_destroy(self):
+        admin_context = context.get_admin_context()
+        db.quota_usage_get_all_by_project(admin_context, self.project_id, 300)
+        volume_id = self._create_volume(size=5)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['volumes'], 1)
+        self.assertEqual(usage['gigabytes'], 5)
+        db.volume_destroy(self.context, volume_id)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['volumes'], 0)
+        self.assertEqual(usage['gigabytes'], 0)
+
+    def test_usage_follows_resize(self):
+        admin_context = context.get_admin_context()
+        instance_id = self._create_instance(cores=2)
+        db.quota_usage_get_all_by_project(admin_context, self.project_id, 300)
+        db.instance_update(self.context, instance_id, {'vcpus': 4,
+                                                       'memory_mb': 1024})
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['cores'], 4)
+        self.assertEqual(usage['ram'], 1024)
+        db.instance_destroy(self.context, instance_id)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['cores'], 0)
+        self.assertEqual(usage['ram'], 0)
+
+    def test_usage_follows_floating_ips(self):
+        admin_context = context.get_admin_context()
+        db.quota_usage_get_all_by_project(admin_context, self.project_id, 300)
+        address = '192.168.0.100'
+        db.floating_ip_create(admin_context, {'address': address})
+        db.floating_ip_allocate_address(admin_context, self.project_id)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['floating_ips'], 1)
+        db.floating_ip_set_auto_assigned(admin_context, address)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['floating_ips'], 0)
+        db.floating_ip_deallocate(admin_context, address)
+        db.floating_ip_allocate_address(admin_context, self.project_id)
+        db.floating_ip_destroy(admin_context, address)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['floating_ips'], 0)
+
+    def test_usage_refreshed_after_max_age(self):
+        admin_context = context.get_admin_context()
+        instance_id = self._create_instance(cores=2)
+        db.quota_usage_get_all_by_project(admin_context, self.project_id, 300)
+        # a change made behind the counters is only seen once refreshed
+        session = get_session()
+        session.query(models.Instance).\
+                filter_by(id=instance_id).\
+                update({'vcpus': 4})
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['cores'], 2)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, -1)
+        self.assertEqual(usage['cores'], 4)
+        db.instance_destroy(self.context, instance_id)
+
+    def test_usage_created_concurrently(self):
+        admin_context = context.get_admin_context()
+        instance_id = self._create_instance(cores=2)
+        refresh = sqlalchemy_api._quota_usage_refresh
+
+        def racing_refresh(context, session, project_id):
+            usages = refresh(context, session, project_id)
+            # another worker stores the counters before this one commits
+            other_session = get_session()
+            with other_session.begin():
+                refresh(context, other_session, project_id)
+            return usages
+
+        self.stubs.Set(sqlalchemy_api, '_quota_usage_refresh',
+                       racing_refresh)
+        usage = db.quota_usage_get_all_by_project(admin_context,
+                                                  self.project_id, 300)
+        self.assertEqual(usage['instances'], 1)
+        self.assertEqual(usage['cores'], 2)
+        db.instance_destroy(self.context, instance_id)
+
+    def test_quota_cache(self):
+        self.flags(quota_cache_ttl=60)
+        instance_type = self._get_instance_type('m1.small')
+        try:
+            num_instances = quota.allowed_instances(self.context, 100,
+                                                    instance_type)
+            self.assertEqual(num_instances, 2)
+            db.quota_create(self.context, self.project_id, 'instances', 3)
+            num_instances = quota.allowed_instances(self.context, 100,
+                                                    instance_type)
+            self.assertEqual(num_instances, 2)
+            quota.invalidate_project_quotas(self.project_id)
+            num_instances = quota.allowed_instances(self.context, 100,
+                                                    instance_type)
+            self.assertEqual(num_instances, 3)
+        finally:
+            quota.invalidate_project_quotas()
+            db.quota_destroy_all_by_project(self.context, self.project_id)
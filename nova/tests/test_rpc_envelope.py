@@ -0,0 +1,109 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2011 OpenStack LLC
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Unit Tests for rpc message envelopes
+"""
+
+import datetime
+
+from nova import context
+from nova import exception
+from nova import test
+from nova import utils
+from nova.rpc import envelope
+from nova.rpc import impl_kombu
+
+
+class FakeModel(object):
+    def __init__(self, **kwargs):
+        self.values = kwargs
+
+    def iteritems(self):
+        return self.values.iteritems()
+
+
+class ReprSerializer(object):
+    def dumps(self, value):
+        return repr(value)
+
+    def loads(self, data):
+        raise ValueError(data)
+
+
+class RpcEnvelopeTestCase(test.TestCase):
+    def setUp(self):
+        super(RpcEnvelopeTestCase, self).setUp()
+        now = datetime.datetime(2011, 9, 1, 12, 0, 0)
+        self.msg = {'method': 'update_service_capabilities',
+                    'args': {'capabilities': {'host_memory_free': 1024,
+                                              'updated_at': now,
+                                              'tags': set(['a'])},
+                             'instance': FakeModel(id=1, created_at=now)}}
+        self.expected = {'method': 'update_service_capabilities',
+                         'args': {'capabilities': {
+                                      'host_memory_free': 1024,
+                                      'updated_at': str(now),
+                                      'tags': ['a']},
+                                  'instance': {'id': 1,
+                                               'created_at': str(now)}}}
+
+    def test_round_trip(self):
+        self.flags(rpc_compress_threshold=0)
+        wrapped = envelope.serialize(self.msg)
+        self.assertEqual(wrapped['nova_encoding'], None)
+        self.assertEqual(envelope.deserialize(wrapped), self.expected)
+
+    def test_round_trip_compressed(self):
+        self.flags(rpc_compress_threshold=16)
+        wrapped = envelope.serialize(self.msg)
+        self.assertEqual(wrapped['nova_encoding'], 'zlib')
+        self.assertEqual(envelope.deserialize(wrapped), self.expected)
+
+    def test_plain_message_passes_through(self):
+        msg = {'method': 'echo', 'args': {'value': 1}}
+        self.assertEqual(envelope.deserialize(msg), msg)
+
+    def test_unknown_version(self):
+        wrapped = envelope.serialize(self.expected)
+        wrapped['nova_envelope'] = envelope.ENVELOPE_VERSION + 1
+        self.assertRaises(exception.Error, envelope.deserialize, wrapped)
+
+    def test_context_packed_as_one_object(self):
+        self.flags(rpc_envelope=True)
+        ctxt = context.RequestContext('user', 'project')
+        msg = {}
+        impl_kombu._pack_context(msg, ctxt)
+        self.assertEqual(msg.keys(), ['_context'])
+        unpacked = impl_kombu._unpack_context(msg)
+        self.assertEqual(unpacked.user_id, 'user')
+        self.assertEqual(unpacked.project_id, 'project')
+
+    def test_matches_utils_dumps(self):
+        now = utils.utcnow()
+        msg = {'method': 'run_instance',
+               'args': {'instance_properties': {'launched_at': now},
+                        'hosts': [FakeModel(id=i, updated_at=now)
+                                  for i in xrange(3)]}}
+        self.assertEqual(utils.loads(utils.dumps(msg)),
+                         envelope.deserialize(envelope.serialize(msg)))
+
+    def test_serializer_follows_flag(self):
+        wrapped = envelope.serialize(self.msg)
+        self.flags(rpc_serializer='nova.tests.test_rpc_envelope.'
+                                  'ReprSerializer')
+        self.assertEqual(envelope.serialize({'a': 1})['nova_message'],
+                         "{'a': 1}")
+        self.assertRaises(ValueError, envelope.deserialize, wrapped)
@@ -19,6 +19,8 @@
 Unit Tests for remote procedure calls using kombu
 """
 
+from eventlet import greenpool
+
 from nova import context
 from nova import log as logging
 from nova import test
@@ -108,3 +110,115 @@ class RpcKombuTestCase(test_rpc_common._BaseRpcTestCase):
         conn2.consume(limit=1)
         conn2.close()
         self.assertEqual(self.received_message, message)
+
+
+class RpcKombuReplyProxyTestCase(RpcKombuTestCase):
+    """Runs the same tests, waiting for replies on a shared queue."""
+    def setUp(self):
+        super(RpcKombuReplyProxyTestCase, self).setUp()
+        self.flags(rpc_reply_proxy=True)
+
+    def tearDown(self):
+        if self.rpc._reply_proxy:
+            self.rpc._reply_proxy.close()
+            self.rpc._reply_proxy = None
+        super(RpcKombuReplyProxyTestCase, self).tearDown()
+
+    def test_reply_proxy_is_shared(self):
+        self.rpc.call(self.context, 'test', {"method": "echo",
+                                             "args": {"value": 1}})
+        reply_proxy = self.rpc._reply_proxy
+        self.rpc.call(self.context, 'test', {"method": "echo",
+                                             "args": {"value": 2}})
+        self.assertTrue(reply_proxy is self.rpc._reply_proxy)
+        self.assertEqual(reply_proxy.waiters, {})
+
+    def test_concurrent_calls(self):
+        def _call(value):
+            return self.rpc.call(self.context, 'test',
+                                 {"method": "echo_three_times_yield",
+                                  "args": {"value": value}})
+
+        pool = greenpool.GreenPool()
+        values = range(0, 100, 10)
+        self.assertEqual(list(pool.imap(_call, values)),
+                         [value + 2 for value in values])
+
+    def test_abandoned_waiter_is_removed(self):
+        results = iter(self.rpc.multicall(self.context, 'test',
+                                          {"method": "echo_three_times_yield",
+                                           "args": {"value": 1}}))
+        self.assertEqual(results.next(), 1)
+        reply_proxy = self.rpc._reply_proxy
+        self.assertEqual(len(reply_proxy.waiters), 1)
+        del results
+        self.assertEqual(reply_proxy.waiters, {})
+
+
+class RpcKombuEnvelopeTestCase(RpcKombuTestCase):
+    """Runs the same tests, sending every message in an envelope."""
+    def setUp(self):
+        super(RpcKombuEnvelopeTestCase, self).setUp()
+        self.flags(rpc_envelope=True, rpc_compress_threshold=16)
+
+
+class FakeProxy(object):
+    def __init__(self):
+        self.calls = []
+
+    def record(self, context, value):
+        self.calls.append(value)
+
+
+class ProxyCallbackTestCase(test.TestCase):
+    def setUp(self):
+        super(ProxyCallbackTestCase, self).setUp()
+        self.flags(rpc_thread_pool_size=1,
+                   rpc_queue_max_depth=2,
+                   rpc_high_priority_methods=['urgent'],
+                   rpc_low_priority_methods=['lazy'])
+        self.context = context.get_admin_context()
+        self.proxy = FakeProxy()
+        self.proxy.urgent = self.proxy.record
+        self.proxy.lazy = self.proxy.record
+        self.callback = impl_kombu.ProxyCallback(self.proxy)
+
+    def _message(self, method, value):
+        msg = {'method': method, 'args': {'value': value}}
+        impl_kombu._pack_context(msg, self.context)
+        return msg
+
+    def test_high_priority_first(self):
+        self.callback(self._message('lazy', 'low'))
+        self.callback(self._message('record', 'normal'))
+        self.callback(self._message('urgent', 'high'))
+        self.assertEqual(self.callback.get_stats()['queued'], 3)
+        self.callback.pool.waitall()
+        self.assertEqual(self.proxy.calls, ['high', 'normal', 'low'])
+        stats = self.callback.get_stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['processed'], 3)
+
+    def test_shed_low_priority_when_full(self):
+        self.flags(rpc_shed_low_priority=True)
+        for i in xrange(3):
+            self.callback(self._message('record', i))
+        self.callback(self._message('lazy', 'dropped'))
+        self.callback.pool.waitall()
+        self.assertEqual(self.proxy.calls, [0, 1, 2])
+        self.assertEqual(self.callback.get_stats()['shed'], 1)
+
+    def test_messages_acked_once_processed(self):
+        acked = []
+
+        def _ack():
+            acked.append(list(self.proxy.calls))
+
+        self.callback(self._message('record', 1), ack=_ack)
+        self.assertEqual(acked, [])
+        self.callback.pool.waitall()
+        self.assertEqual(acked, [[1]])
+
+    def test_prefetch_covers_pool_and_queue(self):
+        # rpc_thread_pool_size + rpc_queue_max_depth
+        self.assertEqual(self.callback.prefetch_count, 3)
@@ -17,6 +17,7 @@
 import datetime
 import os
 import tempfile
+import time
 
 import nova
 from nova import exception
@@ -301,6 +302,47 @@ class GenericUtilsTestCase(test.TestCase):
         self.assertEqual(generated_url, actual_url)
 
 
+class FakeFlag(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class TTLCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(TTLCacheTestCase, self).setUp()
+        self.ttl = FakeFlag(60)
+        self.cache = utils.TTLCache(self.ttl, FakeFlag(4))
+
+    def test_disabled(self):
+        self.ttl.value = 0
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.entries['a'][0] = time.time() - 1
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.items(), [])
+
+    def test_least_recently_used_are_evicted(self):
+        for key in 'abcd':
+            self.cache.set(key, key)
+        self.cache.get('a')
+        self.cache.set('e', 'e')
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(len(self.cache.entries), 4)
+
+    def test_invalidate(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.items(), [('b', 2)])
+        self.cache.invalidate()
+        self.assertEqual(self.cache.items(), [])
+
+
 class IsUUIDLikeTestCase(test.TestCase):
     def assertUUIDLike(self, val, expected):
         result = utils.is_uuid_like(val)
@@ -15,9 +15,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+import os
+import shutil
+import tempfile
+
+from nova import context
+from nova import exception
 from nova import flags
 from nova import test
+from nova import utils
+import nova.image
 from nova.virt import driver
+from nova.virt import images
 
 FLAGS = flags.FLAGS
 
@@ -81,3 +91,65 @@ class TestVirtDriver(test.TestCase):
                                                 'swap_size': 0}))
         self.assertTrue(driver.swap_is_usable({'device_name': '/dev/sdb',
                                                 'swap_size': 1}))
+
+
+class FakeImageService(object):
+    def __init__(self, data, checksum=None):
+        self.data = data
+        self.checksum = checksum
+
+    def get(self, context, image_id, data):
+        for i in xrange(0, len(self.data), 3):
+            data.write(self.data[i:i + 3])
+        return {'id': image_id, 'checksum': self.checksum}
+
+
+class TestFetchToRaw(test.TestCase):
+    def setUp(self):
+        super(TestFetchToRaw, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'image')
+        self.context = context.get_admin_context()
+        self.executed = []
+
+        def fake_execute(*cmd, **kwargs):
+            self.executed.append(cmd)
+            return 'file format: raw\n', ''
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestFetchToRaw, self).tearDown()
+
+    def _stub_image(self, data, checksum=None):
+        service = FakeImageService(data, checksum)
+        self.stubs.Set(nova.image, 'get_image_service',
+                       lambda context, image_href: (service, image_href))
+
+    def test_raw_image_is_not_converted(self):
+        data = '\0' * 1000 + 'raw disk'
+        self._stub_image(data, hashlib.md5(data).hexdigest())
+        images.fetch_to_raw(self.context, '1', self.path, 'fake', 'fake')
+        self.assertEqual(open(self.path).read(), data)
+        self.assertEqual(len(self.executed), 1)
+        self.assertEqual(self.executed[0][-2:],
+                         ('info', self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_checksum_mismatch(self):
+        self._stub_image('raw disk', 'not the checksum')
+        self.assertRaises(exception.ImageUnacceptable,
+                          images.fetch_to_raw,
+                          self.context, '1', self.path, 'fake', 'fake')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_other_formats_go_through_qemu_img(self):
+        # qcow2, vhdx and luks
+        for head in ('QFI\xfb', 'vhdxfile', 'LUKS\xba\xbe'):
+            self.executed = []
+            self._stub_image(head + '\0' * 100)
+            images.fetch_to_raw(self.context, '1', self.path, 'fake', 'fake')
+            self.assertEqual(self.executed[0][-2:],
+                             ('info', self.path + '.part'))
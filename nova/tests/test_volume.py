@@ -21,6 +21,9 @@ Tests for Volume Code.
 """
 
 import cStringIO
+import os
+import shutil
+import tempfile
 
 from nova import context
 from nova import exception
@@ -31,6 +34,7 @@ from nova import rpc
 from nova import test
 from nova import utils
 from nova import volume
+from nova.volume import driver
 
 FLAGS = flags.FLAGS
 LOG = logging.getLogger('nova.tests.volume')
@@ -255,6 +259,77 @@ class VolumeTestCase(test.TestCase):
         db.volume_destroy(self.context, volume_id)
 
 
+class VolumeWipeTestCase(test.TestCase):
+    """Test Case for background wiping of deleted volumes."""
+
+    def setUp(self):
+        super(VolumeWipeTestCase, self).setUp()
+        self.state_path = tempfile.mkdtemp()
+        self.flags(volume_wipe_lazy=True,
+                   volume_wipe_chunk_mb=512,
+                   volume_wipe_state_path=self.state_path)
+        self.commands = []
+        self.lvs_output = ''
+
+        def _fake_execute(*cmd, **kwargs):
+            self.commands.append(cmd)
+            if cmd[0] == 'lvs':
+                return self.lvs_output, ''
+            if cmd[0] == 'vgs':
+                return '  %s\n' % FLAGS.volume_group, ''
+            return '', ''
+
+        self.driver = driver.VolumeDriver(execute=_fake_execute)
+        # run the wipe workers right away
+        self.stubs.Set(driver.greenthread, 'spawn',
+                       lambda f, *args, **kwargs: f(*args, **kwargs))
+
+    def tearDown(self):
+        shutil.rmtree(self.state_path)
+        super(VolumeWipeTestCase, self).tearDown()
+
+    def _dd_commands(self):
+        return [cmd for cmd in self.commands if 'dd' in cmd]
+
+    def test_delete_volume_queues_wipe(self):
+        self.driver.delete_volume({'name': 'volume-1', 'size': 1})
+        self.assertTrue(('lvrename', FLAGS.volume_group, 'volume-1',
+                         'wipe-volume-1') in self.commands)
+        dds = self._dd_commands()
+        self.assertEqual(len(dds), 2)
+        self.assertEqual(dds[0][:2], ('ionice', '-c3'))
+        self.assertTrue('seek=0' in dds[0])
+        self.assertTrue('seek=512' in dds[1])
+        self.assertEqual(self.commands[-1],
+                         ('lvremove', '-f',
+                          '%s/wipe-volume-1' % FLAGS.volume_group))
+        self.assertFalse(os.listdir(self.state_path))
+        stats = self.driver.get_wipe_stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['wiped'], 1)
+
+    def test_resume_wipes(self):
+        with open(os.path.join(self.state_path, 'wipe-volume-2'), 'w') as f:
+            f.write('512')
+        self.lvs_output = '  wipe-volume-2 1024.00\n  volume-3 10.00\n'
+        self.driver._resume_wipes()
+        dds = self._dd_commands()
+        self.assertEqual(len(dds), 1)
+        self.assertTrue('seek=512' in dds[0])
+        self.assertEqual(self.commands[-1],
+                         ('lvremove', '-f',
+                          '%s/wipe-volume-2' % FLAGS.volume_group))
+
+    def test_setup_resumes_wipes_only_when_lazy(self):
+        self.lvs_output = '  wipe-volume-2 1024.00\n'
+        self.flags(volume_wipe_lazy=False)
+        self.driver.check_for_setup_error()
+        self.assertEqual(self._dd_commands(), [])
+        self.flags(volume_wipe_lazy=True)
+        self.driver.check_for_setup_error()
+        self.assertEqual(len(self._dd_commands()), 2)
+
+
 class DriverTestCase(test.TestCase):
     """Base Test class for Drivers."""
     driver_name = "nova.volume.driver.FakeBaseDriver"
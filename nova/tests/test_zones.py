@@ -232,11 +232,11 @@ class ZoneManagerTestCase(test.TestCase):
         expiry_time = (FLAGS.periodic_interval * 3) + 1
 
         # One service became stale
+        time_past = utils.utcnow() - datetime.timedelta(seconds=expiry_time)
+        utils.set_time_override(time_past)
         zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2))
+        utils.clear_time_override()
         zm.update_service_capabilities("svc2", "host1", dict(a=3, b=4))
-        caps = zm.service_states["host1"]["svc1"]
-        caps["timestamp"] = utils.utcnow() - \
-                               datetime.timedelta(seconds=expiry_time)
         self.assertTrue(zm.host_service_caps_stale("host1", "svc1"))
         self.assertFalse(zm.host_service_caps_stale("host1", "svc2"))
 
@@ -272,6 +272,17 @@ class ZoneManagerTestCase(test.TestCase):
         self.assertFalse("host1" in zm.service_states)
         self.assertFalse("host2" in zm.service_states)
 
+    def test_expiry_heap_is_bounded(self):
+        zm = zone_manager.ZoneManager()
+
+        # Hosts keep reporting without anyone reading the capabilities
+        for i in xrange(100):
+            zm.update_service_capabilities("svc1", "host1", dict(a=i))
+            zm.update_service_capabilities("svc1", "host2", dict(a=i))
+        self.assertTrue(len(zm.host_states.expiry) <= 4)
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(99, 99)))
+
     def test_get_zone_capabilities_one_host(self):
         zm = zone_manager.ZoneManager()
 
@@ -306,11 +317,11 @@ class ZoneManagerTestCase(test.TestCase):
         expiry_time = (FLAGS.periodic_interval * 3) + 1
 
         # One host service capabilities become stale
+        time_past = utils.utcnow() - datetime.timedelta(seconds=expiry_time)
+        utils.set_time_override(time_past)
         zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2))
+        utils.clear_time_override()
         zm.update_service_capabilities("svc1", "host2", dict(a=3, b=4))
-        serv_caps = zm.service_states["host1"]["svc1"]
-        serv_caps["timestamp"] = utils.utcnow() - \
-                               datetime.timedelta(seconds=expiry_time)
         caps = zm.get_zone_capabilities(None)
         self.assertEquals(caps, dict(svc1_a=(3, 3), svc1_b=(4, 4)))
 
@@ -331,16 +342,13 @@ class ZoneManagerTestCase(test.TestCase):
         expiry_time = (FLAGS.periodic_interval * 3) + 1
 
         # Two host services among four become stale
-        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2))
+        time_past = utils.utcnow() - datetime.timedelta(seconds=expiry_time)
+        utils.set_time_override(time_past)
         zm.update_service_capabilities("svc1", "host2", dict(a=3, b=4))
         zm.update_service_capabilities("svc2", "host1", dict(a=5, b=6))
+        utils.clear_time_override()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2))
         zm.update_service_capabilities("svc2", "host2", dict(a=7, b=8))
-        serv_caps_1 = zm.service_states["host1"]["svc2"]
-        serv_caps_1["timestamp"] = utils.utcnow() - \
-                               datetime.timedelta(seconds=expiry_time)
-        serv_caps_2 = zm.service_states["host2"]["svc1"]
-        serv_caps_2["timestamp"] = utils.utcnow() - \
-                               datetime.timedelta(seconds=expiry_time)
         caps = zm.get_zone_capabilities(None)
         self.assertEquals(caps, dict(svc1_a=(1, 1), svc1_b=(2, 2),
                                      svc2_a=(7, 7), svc2_b=(8, 8)))
@@ -350,19 +358,13 @@ class ZoneManagerTestCase(test.TestCase):
         expiry_time = (FLAGS.periodic_interval * 3) + 1
 
         # Three host services among four become stale
-        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2))
+        time_past = utils.utcnow() - datetime.timedelta(seconds=expiry_time)
+        utils.set_time_override(time_past)
         zm.update_service_capabilities("svc1", "host2", dict(a=3, b=4))
         zm.update_service_capabilities("svc2", "host1", dict(a=5, b=6))
         zm.update_service_capabilities("svc2", "host2", dict(a=7, b=8))
-        serv_caps_1 = zm.service_states["host1"]["svc2"]
-        serv_caps_1["timestamp"] = utils.utcnow() - \
-                               datetime.timedelta(seconds=expiry_time)
-        serv_caps_2 = zm.service_states["host2"]["svc1"]
-        serv_caps_2["timestamp"] = utils.utcnow() - \
-                               datetime.timedelta(seconds=expiry_time)
-        serv_caps_3 = zm.service_states["host2"]["svc2"]
-        serv_caps_3["timestamp"] = utils.utcnow() - \
-                               datetime.timedelta(seconds=expiry_time)
+        utils.clear_time_override()
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2))
         caps = zm.get_zone_capabilities(None)
         self.assertEquals(caps, dict(svc1_a=(1, 1), svc1_b=(2, 2)))
 
@@ -379,3 +381,66 @@ class ZoneManagerTestCase(test.TestCase):
         utils.set_time_override(time_future)
         caps = zm.get_zone_capabilities(None)
         self.assertEquals(caps, {})
+        utils.clear_time_override()
+
+    def test_get_zone_capabilities_updated_host(self):
+        zm = zone_manager.ZoneManager()
+
+        # A new report replaces the values that set the bounds
+        zm.update_service_capabilities("svc1", "host1", dict(a=1, b=2))
+        zm.update_service_capabilities("svc1", "host2", dict(a=3, b=4))
+        zm.update_service_capabilities("svc1", "host1", dict(a=5, b=6))
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(3, 5), svc1_b=(4, 6)))
+
+    def test_get_zone_capabilities_disabled_service(self):
+        zm = zone_manager.ZoneManager()
+
+        zm.update_service_capabilities("svc1", "host1", dict(a=1))
+        zm.update_service_capabilities("svc1", "host2",
+                                       dict(a=3, enabled=False))
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(1, 1)))
+        self.assertTrue("host2" in zm.service_states)
+
+    def test_get_zone_capabilities_stale_then_reported(self):
+        zm = zone_manager.ZoneManager()
+        expiry_time = (FLAGS.periodic_interval * 3) + 1
+
+        # A service that reported again must survive its old expiry
+        time_past = utils.utcnow() - datetime.timedelta(seconds=expiry_time)
+        utils.set_time_override(time_past)
+        zm.update_service_capabilities("svc1", "host1", dict(a=1))
+        utils.clear_time_override()
+        zm.update_service_capabilities("svc1", "host1", dict(a=2))
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(2, 2)))
+        self.assertTrue("host1" in zm.service_states)
+
+    def test_get_zone_capabilities_assigned_service_states(self):
+        zm = zone_manager.ZoneManager()
+        zm.service_states = {"host1": {"svc1": dict(a=1)},
+                             "host2": {"svc1": dict(a=3)}}
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps, dict(svc1_a=(1, 3)))
+
+    def test_consume_service_capabilities(self):
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("compute", "host1",
+                                       dict(host_memory_free=100))
+        zm.update_service_capabilities("compute", "host2",
+                                       dict(host_memory_free=80))
+        zm.consume_service_capabilities("compute", "host1",
+                                        dict(host_memory_free=60))
+        zm.consume_service_capabilities("compute", "host3",
+                                        dict(host_memory_free=60))
+        self.assertEquals(
+                zm.service_states["host1"]["compute"]["host_memory_free"], 40)
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps["compute_host_memory_free"], (40, 80))
+
+        # The next report from the host resets the debit
+        zm.update_service_capabilities("compute", "host1",
+                                       dict(host_memory_free=100))
+        caps = zm.get_zone_capabilities(None)
+        self.assertEquals(caps["compute_host_memory_free"], (80, 100))
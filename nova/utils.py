@@ -511,6 +511,68 @@ class LoopingCall(object):
         return self.done.wait()
 
 
+class TTLCache(object):
+    """Values kept for the seconds in the ttl flag after they were set.
+
+    The flags are passed as objects, FLAGS['<name>'], so the cache follows
+    their current values.  A ttl of 0 disables the cache.  With size, the
+    least recently used quarter of the entries is dropped once there are
+    more than the size flag allows.
+
+    """
+
+    def __init__(self, ttl, size=None):
+        self.ttl = ttl
+        self.size = size
+        # { <key> : [<expiry time>, <value>, <last use>] }
+        self.entries = {}
+        self.clock = 0
+        self.next_prune = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return default
+        self.clock += 1
+        entry[2] = self.clock
+        return entry[1]
+
+    def set(self, key, value):
+        ttl = self.ttl.value
+        if ttl <= 0:
+            return
+        now = time.time()
+        self.clock += 1
+        self.entries[key] = [now + ttl, value, self.clock]
+        if now >= self.next_prune:
+            # NOTE: expired entries are dropped once per ttl rather than
+            #       on every set, which would cost a pass over all of them
+            self.next_prune = now + ttl
+            for old_key, entry in self.entries.items():
+                if entry[0] <= now:
+                    del self.entries[old_key]
+        if self.size is not None and len(self.entries) > self.size.value:
+            keys = sorted(self.entries, key=lambda k: self.entries[k][2])
+            for old_key in keys[:max(len(keys) // 4, 1)]:
+                del self.entries[old_key]
+
+    def items(self):
+        """Return the (key, value) pairs which have not expired."""
+        now = time.time()
+        return [(key, entry[1]) for key, entry in self.entries.items()
+                if entry[0] > now]
+
+    def invalidate(self, key=None):
+        """Drop the entry of key, or all of them."""
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+
 def xhtml_escape(value):
     """Escapes a string so it is valid within XML or XHTML.
 
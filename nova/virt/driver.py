@@ -439,6 +439,18 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
+    def filter_defer_apply_on(self):
+        """Defer application of firewall rule changes.
+
+        Lets the caller set up filtering for many instances at once and
+        have the firewall updated once, by filter_defer_apply_off().
+        """
+        pass
+
+    def filter_defer_apply_off(self):
+        """Apply firewall rule changes deferred by filter_defer_apply_on()"""
+        pass
+
     def set_admin_password(self, context, instance_id, new_pass=None):
         """
         Set the root password on the specified instance.
@@ -494,6 +506,15 @@ class ComputeDriver(object):
         """Reboots, shuts down or powers up the host."""
         raise NotImplementedError()
 
+    def manage_image_cache(self, context):
+        """Called periodically so drivers caching images on the host can
+        drop the ones no longer needed."""
+        pass
+
+    def prefetch_images(self, context, image_ids):
+        """Fetch images into the host's image cache ahead of their use."""
+        raise NotImplementedError()
+
     def set_host_enabled(self, host, enabled):
         """Sets the specified host's ability to accept new instances."""
         # TODO(Vek): Need to pass context in for access to auth_token
@@ -140,6 +140,9 @@ class FakeConnection(driver.ComputeDriver):
     def poll_unconfirmed_resizes(self, resize_confirm_window):
         pass
 
+    def prefetch_images(self, context, image_ids):
+        pass
+
     def pause(self, instance, callback):
         pass
 
@@ -21,7 +21,9 @@
 Handling of VM disk images.
 """
 
+import hashlib
 import os
+import time
 
 from nova import exception
 from nova import flags
@@ -32,40 +34,117 @@ from nova import utils
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('image_fetch_progress_mb', 512,
+                     'log the progress of image downloads every this many '
+                     'megabytes')
+flags.DEFINE_boolean('image_fetch_verify_checksum', True,
+                     'check downloaded images against the checksum of the '
+                     'image service')
 LOG = logging.getLogger('nova.virt.images')
 
+# bytes read at a time when hashing a downloaded image
+_READ_BYTES = 1024 * 1024
 
-def fetch(context, image_href, path, _user_id, _project_id):
+
+class _ImageWriter(object):
+    """File wrapper hashing and timing an image as it is written."""
+
+    def __init__(self, image_file, image_href):
+        self.image_file = image_file
+        self.image_href = image_href
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.start = time.time()
+        self.next_progress = FLAGS.image_fetch_progress_mb * 1024 * 1024
+
+    def write(self, chunk):
+        self.image_file.write(chunk)
+        self.update(chunk)
+
+    def update(self, chunk):
+        """Hash chunk, the next bytes of the image."""
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        if self.next_progress > 0 and self.size >= self.next_progress:
+            LOG.debug(_('Fetched %(mb)dM of image %(image)s, %(rate).1fM/s')
+                      % {'mb': self.size // (1024 * 1024),
+                         'image': self.image_href,
+                         'rate': self.rate()})
+            self.next_progress += FLAGS.image_fetch_progress_mb * 1024 * 1024
+
+    def rate(self):
+        """Megabytes per second since the download started."""
+        elapsed = max(time.time() - self.start, 0.001)
+        return self.size / elapsed / (1024 * 1024)
+
+
+def _fetch(context, image_href, path):
+    """Download an image to path, returning its metadata and the writer."""
     # TODO(vish): Improve context handling and add owner and auth data
     #             when it is added to glance.  Right now there is no
     #             auth checking in glance, so we assume that access was
     #             checked before we got here.
     (image_service, image_id) = nova.image.get_image_service(context,
                                                              image_href)
-    with open(path, "wb") as image_file:
-        metadata = image_service.get(context, image_id, image_file)
+    download = getattr(image_service, 'download', None)
+    if download is not None and FLAGS.glance_download_segments > 0:
+        # NOTE: the ranges arrive out of order, so the image is hashed
+        #       once it is all there
+        writer = _ImageWriter(None, image_href)
+        metadata = download(context, image_id, path)
+        writer.next_progress = 0
+        with open(path, "rb") as image_file:
+            for chunk in iter(lambda: image_file.read(_READ_BYTES), ''):
+                writer.update(chunk)
+    else:
+        with open(path, "wb") as image_file:
+            writer = _ImageWriter(image_file, image_href)
+            metadata = image_service.get(context, image_id, writer)
+    LOG.debug(_('Fetched %(size)d bytes of image %(image_href)s at '
+                '%(rate).1fM/s') % {'size': writer.size,
+                                    'image_href': image_href,
+                                    'rate': writer.rate()})
+    return metadata, writer
+
+
+def fetch(context, image_href, path, _user_id, _project_id):
+    metadata, writer = _fetch(context, image_href, path)
     return metadata
 
 
-def fetch_to_raw(context, image_href, path, user_id, project_id):
-    path_tmp = "%s.part" % path
-    metadata = fetch(context, image_href, path_tmp, user_id, project_id)
+def _qemu_img_info(path):
+    out, err = utils.execute('env', 'LC_ALL=C', 'LANG=C',
+        'qemu-img', 'info', path)
 
-    def _qemu_img_info(path):
+    # output of qemu-img is 'field: value'
+    # the fields of interest are 'file format' and 'backing file'
+    data = {}
+    for line in out.splitlines():
+        (field, val) = line.split(':', 1)
+        if val[0] == " ":
+            val = val[1:]
+        data[field] = val
 
-        out, err = utils.execute('env', 'LC_ALL=C', 'LANG=C',
-            'qemu-img', 'info', path)
+    return(data)
 
-        # output of qemu-img is 'field: value'
-        # the fields of interest are 'file format' and 'backing file'
-        data = {}
-        for line in out.splitlines():
-            (field, val) = line.split(':', 1)
-            if val[0] == " ":
-                val = val[1:]
-            data[field] = val
 
-        return(data)
+def fetch_to_raw(context, image_href, path, user_id, project_id):
+    """Download an image to path as a raw image.
+
+    The image is hashed while it downloads.  qemu-img info only reads
+    the headers of the staged image, so it still decides the format, and
+    raw images are renamed into place without a conversion.
+    """
+    path_tmp = "%s.part" % path
+    metadata, writer = _fetch(context, image_href, path_tmp)
+
+    checksum = metadata.get('checksum')
+    if (FLAGS.image_fetch_verify_checksum and checksum and
+        checksum != writer.md5.hexdigest()):
+        os.unlink(path_tmp)
+        raise exception.ImageUnacceptable(image_id=image_href,
+            reason=_("checksum %(actual)s does not match %(checksum)s") %
+            {'actual': writer.md5.hexdigest(), 'checksum': checksum})
 
     data = _qemu_img_info(path_tmp)
 
@@ -39,6 +39,7 @@ Supports KVM, LXC, QEMU, UML, and XEN.
 
 import hashlib
 import functools
+import lockfile
 import multiprocessing
 import netaddr
 import os
@@ -70,6 +71,7 @@ from nova.compute import power_state
 from nova.virt import disk
 from nova.virt import driver
 from nova.virt import images
+from nova.virt.libvirt import imagecache
 from nova.virt.libvirt import netutils
 
 
@@ -80,6 +82,8 @@ Template = None
 
 LOG = logging.getLogger('nova.virt.libvirt_conn')
 
+image_cache = imagecache.ImageCacheManager()
+
 
 FLAGS = flags.FLAGS
 flags.DECLARE('live_migration_retry_count', 'nova.compute.manager')
@@ -101,6 +105,10 @@ flags.DEFINE_string('libvirt_uri',
 flags.DEFINE_bool('allow_same_net_traffic',
                   True,
                   'Whether to allow network traffic from same network')
+flags.DEFINE_bool('firewall_use_ipset',
+                  False,
+                  'Match security group members with one ipset per group '
+                  'instead of one iptables rule per member (needs ipset)')
 flags.DEFINE_bool('use_cow_images',
                   True,
                   'Whether to use cow images')
@@ -147,6 +155,11 @@ flags.DEFINE_string('default_local_format',
 flags.DEFINE_bool('libvirt_use_virtio_for_bridges',
                   False,
                   'Use virtio for bridge interfaces')
+flags.DEFINE_list('libvirt_precreate_os_types',
+                  [],
+                  'os types to create the ephemeral base images of every '
+                  'instance type for, along with the swap bases, in the '
+                  'background when nova-compute starts')
 
 
 def get_connection(read_only):
@@ -198,7 +211,9 @@ class LibvirtConnection(driver.ComputeDriver):
 
     def init_host(self, host):
         # NOTE(nsokolov): moved instance restarting to ComputeManager
-        pass
+        if FLAGS.libvirt_precreate_os_types:
+            greenthread.spawn(self._precreate_local_bases,
+                              FLAGS.libvirt_precreate_os_types)
 
     def _get_connection(self):
         if not self._wrapped_conn or not self._test_connection():
@@ -780,17 +795,7 @@ class LibvirtConnection(driver.ComputeDriver):
         """
 
         if not os.path.exists(target):
-            base_dir = os.path.join(FLAGS.instances_path, '_base')
-            if not os.path.exists(base_dir):
-                os.mkdir(base_dir)
-            base = os.path.join(base_dir, fname)
-
-            @utils.synchronized(fname)
-            def call_if_not_exists(base, fn, *args, **kwargs):
-                if not os.path.exists(base):
-                    fn(target=base, *args, **kwargs)
-
-            call_if_not_exists(base, fn, *args, **kwargs)
+            base = LibvirtConnection._cache_base(fn, fname, *args, **kwargs)
 
             if cow:
                 utils.execute('qemu-img', 'create', '-f', 'qcow2', '-o',
@@ -799,6 +804,106 @@ class LibvirtConnection(driver.ComputeDriver):
             else:
                 utils.execute('cp', base, target)
 
+    @staticmethod
+    def _cache_base(fn, fname, *args, **kwargs):
+        """Create the base image fname with fn unless it already exists.
+
+        Returns the path of the base image."""
+        base_dir = imagecache.get_base_dir()
+        if not os.path.exists(base_dir):
+            os.mkdir(base_dir)
+        base = os.path.join(base_dir, fname)
+
+        @utils.synchronized(fname)
+        def call_if_not_exists(base, fn, *args, **kwargs):
+            lock = imagecache.base_lock(fname)
+            try:
+                lock.acquire(timeout=0)
+            except lockfile.LockError:
+                # NOTE: another compute sharing instances_path is creating
+                #       the base, its progress is in that compute's log
+                LOG.info(_('Waiting for base image %s created elsewhere'),
+                         fname)
+                lock.acquire()
+            try:
+                if not os.path.exists(base):
+                    image_cache.record_miss(base)
+                    fn(target=base, *args, **kwargs)
+                else:
+                    # NOTE: touched under the lock so the image cache
+                    #       manager can't remove the base before it is used
+                    image_cache.record_hit(base)
+            finally:
+                lock.release()
+
+        call_if_not_exists(base, fn, *args, **kwargs)
+        return base
+
+    def _precreate_local_bases(self, os_types):
+        """Create the ephemeral and swap bases of every instance type.
+
+        _create_image names these bases after their size and os type, so
+        creating them ahead keeps mkfs and mkswap out of later spawns.
+        """
+        inst_types = instance_types.get_all_types().values()
+        for local_gb in sorted(set(inst_type['local_gb']
+                                   for inst_type in inst_types
+                                   if inst_type['local_gb'])):
+            for os_type in os_types:
+                fn = functools.partial(self._create_ephemeral,
+                                       fs_label='ephemeral0',
+                                       os_type=os_type)
+                self._precreate_base(fn, "ephemeral_%s_%s_%s" %
+                                     ("0", local_gb, os_type),
+                                     local_size=local_gb)
+        for swap_mb in sorted(set(inst_type['swap']
+                                  for inst_type in inst_types
+                                  if inst_type['swap'] > 0)):
+            self._precreate_base(self._create_swap, "swap_%s" % swap_mb,
+                                 swap_mb=swap_mb)
+
+    def _precreate_base(self, fn, fname, **kwargs):
+        try:
+            self._cache_base(fn, fname, **kwargs)
+        except Exception:
+            LOG.exception(_('Failed to create base image %s'), fname)
+
+    def prefetch_images(self, context, image_ids):
+        """Fetch images, and their kernels and ramdisks, into _base.
+
+        Root disks are cached the way _create_image caches them for flavors
+        with a root disk of minimum_root_size.
+        """
+        for image_id in image_ids:
+            image_id = str(image_id)
+            LOG.info(_('Prefetching image %s'), image_id)
+            try:
+                (image_service, service_image_id) = \
+                    nova.image.get_image_service(context, image_id)
+                image = image_service.show(context, service_image_id)
+                properties = image.get('properties', {})
+                for key in ('kernel_id', 'ramdisk_id'):
+                    if properties.get(key):
+                        self._cache_base(fn=self._fetch_image,
+                                         fname='%08x' % int(properties[key]),
+                                         context=context,
+                                         image_id=properties[key],
+                                         user_id=context.user_id,
+                                         project_id=context.project_id)
+                self._cache_base(fn=self._fetch_image,
+                                 fname=hashlib.sha1(image_id).hexdigest(),
+                                 context=context,
+                                 image_id=image_id,
+                                 user_id=context.user_id,
+                                 project_id=context.project_id,
+                                 size=FLAGS.minimum_root_size)
+            except Exception:
+                LOG.exception(_('Failed to prefetch image %s'), image_id)
+
+    def manage_image_cache(self, context):
+        """Remove unused base images, see nova.virt.libvirt.imagecache."""
+        image_cache.periodic_verify()
+
     def _fetch_image(self, context, target, image_id, user_id, project_id,
                      size=None):
         """Grab image and optionally attempt to resize it"""
@@ -860,24 +965,34 @@ class LibvirtConnection(driver.ComputeDriver):
                            'kernel_id': inst['kernel_id'],
                            'ramdisk_id': inst['ramdisk_id']}
 
+        # NOTE: the disks of an instance don't depend on each other, so the
+        #       kernel, ramdisk, root, ephemeral and swap images are all
+        #       fetched or created at once and waited for before injection.
+        #       Instances needing the same base image share its creation,
+        #       _cache_image only creates a base once.
+        pending = []
+
+        def cache_image(**kwargs):
+            pending.append(greenthread.spawn(self._cache_image, **kwargs))
+
         if disk_images['kernel_id']:
             fname = '%08x' % int(disk_images['kernel_id'])
-            self._cache_image(fn=self._fetch_image,
-                              context=context,
-                              target=basepath('kernel'),
-                              fname=fname,
-                              image_id=disk_images['kernel_id'],
-                              user_id=inst['user_id'],
-                              project_id=inst['project_id'])
+            cache_image(fn=self._fetch_image,
+                        context=context,
+                        target=basepath('kernel'),
+                        fname=fname,
+                        image_id=disk_images['kernel_id'],
+                        user_id=inst['user_id'],
+                        project_id=inst['project_id'])
             if disk_images['ramdisk_id']:
                 fname = '%08x' % int(disk_images['ramdisk_id'])
-                self._cache_image(fn=self._fetch_image,
-                                  context=context,
-                                  target=basepath('ramdisk'),
-                                  fname=fname,
-                                  image_id=disk_images['ramdisk_id'],
-                                  user_id=inst['user_id'],
-                                  project_id=inst['project_id'])
+                cache_image(fn=self._fetch_image,
+                            context=context,
+                            target=basepath('ramdisk'),
+                            fname=fname,
+                            image_id=disk_images['ramdisk_id'],
+                            user_id=inst['user_id'],
+                            project_id=inst['project_id'])
 
         root_fname = hashlib.sha1(disk_images['image_id']).hexdigest()
         size = FLAGS.minimum_root_size
@@ -890,15 +1005,15 @@ class LibvirtConnection(driver.ComputeDriver):
 
         if not self._volume_in_mapping(self.default_root_device,
                                        block_device_info):
-            self._cache_image(fn=self._fetch_image,
-                              context=context,
-                              target=basepath('disk'),
-                              fname=root_fname,
-                              cow=FLAGS.use_cow_images,
-                              image_id=disk_images['image_id'],
-                              user_id=inst['user_id'],
-                              project_id=inst['project_id'],
-                              size=size)
+            cache_image(fn=self._fetch_image,
+                        context=context,
+                        target=basepath('disk'),
+                        fname=root_fname,
+                        cow=FLAGS.use_cow_images,
+                        image_id=disk_images['image_id'],
+                        user_id=inst['user_id'],
+                        project_id=inst['project_id'],
+                        size=size)
 
         local_gb = inst['local_gb']
         if local_gb and not self._volume_in_mapping(
@@ -906,23 +1021,23 @@ class LibvirtConnection(driver.ComputeDriver):
             fn = functools.partial(self._create_ephemeral,
                                    fs_label='ephemeral0',
                                    os_type=inst.os_type)
-            self._cache_image(fn=fn,
-                              target=basepath('disk.local'),
-                              fname="ephemeral_%s_%s_%s" %
-                              ("0", local_gb, inst.os_type),
-                              cow=FLAGS.use_cow_images,
-                              local_size=local_gb)
+            cache_image(fn=fn,
+                        target=basepath('disk.local'),
+                        fname="ephemeral_%s_%s_%s" %
+                        ("0", local_gb, inst.os_type),
+                        cow=FLAGS.use_cow_images,
+                        local_size=local_gb)
 
         for eph in driver.block_device_info_get_ephemerals(block_device_info):
             fn = functools.partial(self._create_ephemeral,
                                    fs_label='ephemeral%d' % eph['num'],
                                    os_type=inst.os_type)
-            self._cache_image(fn=fn,
-                              target=basepath(_get_eph_disk(eph)),
-                              fname="ephemeral_%s_%s_%s" %
-                              (eph['num'], eph['size'], inst.os_type),
-                              cow=FLAGS.use_cow_images,
-                              local_size=eph['size'])
+            cache_image(fn=fn,
+                        target=basepath(_get_eph_disk(eph)),
+                        fname="ephemeral_%s_%s_%s" %
+                        (eph['num'], eph['size'], inst.os_type),
+                        cow=FLAGS.use_cow_images,
+                        local_size=eph['size'])
 
         swap_mb = 0
 
@@ -935,11 +1050,11 @@ class LibvirtConnection(driver.ComputeDriver):
             swap_mb = inst_type['swap']
 
         if swap_mb > 0:
-            self._cache_image(fn=self._create_swap,
-                              target=basepath('disk.swap'),
-                              fname="swap_%s" % swap_mb,
-                              cow=FLAGS.use_cow_images,
-                              swap_mb=swap_mb)
+            cache_image(fn=self._create_swap,
+                        target=basepath('disk.swap'),
+                        fname="swap_%s" % swap_mb,
+                        cow=FLAGS.use_cow_images,
+                        swap_mb=swap_mb)
 
         # For now, we assume that if we're not using a kernel, we're using a
         # partitioned disk image where the target partition is the first
@@ -956,16 +1071,27 @@ class LibvirtConnection(driver.ComputeDriver):
 
         if config_drive_id:
             fname = '%08x' % int(config_drive_id)
-            self._cache_image(fn=self._fetch_image,
-                              target=basepath('disk.config'),
-                              fname=fname,
-                              image_id=config_drive_id,
-                              user_id=inst['user_id'],
-                              project_id=inst['project_id'],)
+            cache_image(fn=self._fetch_image,
+                        target=basepath('disk.config'),
+                        fname=fname,
+                        image_id=config_drive_id,
+                        user_id=inst['user_id'],
+                        project_id=inst['project_id'],)
         elif config_drive:
             self._create_local(basepath('disk.config'), 64, unit='M',
                                fs_format='msdos')  # 64MB
 
+        failure = None
+        for image in pending:
+            try:
+                image.wait()
+            except Exception:
+                LOG.exception(_('instance %s: failed to create an image'),
+                              inst['name'])
+                failure = failure or sys.exc_info()
+        if failure:
+            raise failure[0], failure[1], failure[2]
+
         if inst['key_data']:
             key = str(inst['key_data'])
         else:
@@ -1537,6 +1663,12 @@ class LibvirtConnection(driver.ComputeDriver):
     def refresh_provider_fw_rules(self):
         self.firewall_driver.refresh_provider_fw_rules()
 
+    def filter_defer_apply_on(self):
+        self.firewall_driver.filter_defer_apply_on()
+
+    def filter_defer_apply_off(self):
+        self.firewall_driver.filter_defer_apply_off()
+
     def update_available_resource(self, ctxt, host):
         """Updates compute manager resource info on ComputeNode table.
 
@@ -1923,8 +2055,28 @@ class LibvirtConnection(driver.ComputeDriver):
         pass
 
     def get_host_stats(self, refresh=False):
-        """See xenapi_conn.py implementation."""
-        pass
+        """Return the host capabilities when the base image cache is managed.
+
+        Memory and disk are reported under the keys of the xenapi host
+        stats, in bytes, so the scheduler filters can use them next to
+        the cache stats.
+        """
+        if FLAGS.image_cache_manager_interval <= 0:
+            return
+        memory_total = self.get_memory_mb_total()
+        memory_used = self.get_memory_mb_used()
+        hddinfo = os.statvfs(FLAGS.instances_path)
+        disk_total = hddinfo.f_frsize * hddinfo.f_blocks
+        disk_available = hddinfo.f_frsize * hddinfo.f_bavail
+        stats = {'host_memory_total': memory_total * 1024 * 1024,
+                 'host_memory_free': (memory_total - memory_used) *
+                                     1024 * 1024,
+                 'disk_total': disk_total,
+                 'disk_used': disk_total - disk_available,
+                 'disk_available': disk_available,
+                 'vcpus': self.get_vcpu_total()}
+        stats.update(image_cache.get_stats())
+        return stats
 
     def host_power_action(self, host, action):
         """Reboots, shuts down or powers up the host."""
@@ -22,6 +22,7 @@ from eventlet import tpool
 
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
 from nova import log as logging
 from nova import utils
@@ -96,6 +97,14 @@ class FirewallDriver(object):
         """Check nova-instance-instance-xxx exists"""
         raise NotImplementedError()
 
+    def filter_defer_apply_on(self):
+        """Defer application of filters until filter_defer_apply_off()."""
+        pass
+
+    def filter_defer_apply_off(self):
+        """Apply the filters changed since filter_defer_apply_on()."""
+        pass
+
 
 class NWFilterFirewall(FirewallDriver):
     """
@@ -511,6 +520,18 @@ class IptablesFirewallDriver(FirewallDriver):
         self.network_infos = {}
         self.nwfilter = NWFilterFirewall(kwargs['get_connection'])
         self.basicly_filtered = False
+        # Security groups rendered into shared chains, and which instances
+        # and groups refer to them:
+        #   { <group id> : (ipv4 rules, ipv6 rules) }
+        self.security_group_rules = {}
+        #   { <instance id> : [<group id>, ...] }
+        self.instance_security_groups = {}
+        #   { <grantee group id> : set([<id of group granting it>, ...]) }
+        self.security_group_grantees = {}
+        # With FLAGS.firewall_use_ipset, the member addresses of each
+        # grantee group, as loaded into its ipset:
+        #   { <grantee group id> : set([<ip>, ...]) }
+        self.ipsets = {}
 
         self.iptables.ipv4['filter'].add_chain('sg-fallback')
         self.iptables.ipv4['filter'].add_rule('sg-fallback', '-j DROP')
@@ -529,12 +550,20 @@ class IptablesFirewallDriver(FirewallDriver):
         """No-op. Everything is done in prepare_instance_filter"""
         pass
 
+    def filter_defer_apply_on(self):
+        self.iptables.defer_apply_on()
+
+    def filter_defer_apply_off(self):
+        self.iptables.defer_apply_off()
+        self._destroy_unused_ipsets()
+
     def unfilter_instance(self, instance, network_info):
         if self.instances.pop(instance['id'], None):
             # NOTE(vish): use the passed info instead of the stored info
             self.network_infos.pop(instance['id'])
             self.remove_filters_for_instance(instance)
             self.iptables.apply()
+            self._destroy_unused_ipsets()
             self.nwfilter.unfilter_instance(instance, network_info)
         else:
             LOG.info(_('Attempted to unfilter instance %s which is not '
@@ -589,6 +618,31 @@ class IptablesFirewallDriver(FirewallDriver):
         if FLAGS.use_ipv6:
             self.iptables.ipv6['filter'].remove_chain(chain_name)
 
+        group_ids = self.instance_security_groups.pop(instance['id'], [])
+        self._remove_unused_security_group_chains(group_ids)
+
+    def _rebuild_instance_chain(self, instance):
+        """Re-render the chain of an instance which joined or left groups."""
+        chain_name = self._instance_chain_name(instance)
+        self.iptables.ipv4['filter'].empty_chain(chain_name)
+        if FLAGS.use_ipv6:
+            self.iptables.ipv6['filter'].empty_chain(chain_name)
+        group_ids = self.instance_security_groups.pop(instance['id'], [])
+        network_info = self.network_infos[instance['id']]
+        ipv4_rules, ipv6_rules = self.instance_rules(instance, network_info)
+        self._add_filters(chain_name, ipv4_rules, ipv6_rules)
+        self._remove_unused_security_group_chains(group_ids)
+
+    def _remove_unused_security_group_chains(self, group_ids):
+        """Drop the chains of the groups no instance here is in any more."""
+        in_use = set()
+        for other_group_ids in self.instance_security_groups.values():
+            in_use.update(other_group_ids)
+        for security_group_id in group_ids:
+            if (security_group_id not in in_use and
+                security_group_id in self.security_group_rules):
+                self._remove_security_group_chain(security_group_id)
+
     def instance_rules(self, instance, network_info):
         ctxt = context.get_admin_context()
 
@@ -641,96 +695,253 @@ class IptablesFirewallDriver(FirewallDriver):
         security_groups = db.security_group_get_by_instance(ctxt,
                                                             instance['id'])
 
-        # then, security group chains and rules
-        for security_group in security_groups:
-            rules = db.security_group_rule_get_by_security_group(ctxt,
-                                                          security_group['id'])
+        # then, jumps to the shared security group chains
+        group_ids = [security_group['id']
+                     for security_group in security_groups]
+        self.instance_security_groups[instance['id']] = group_ids
+        for security_group_id in group_ids:
+            self._ensure_security_group_chain(ctxt, security_group_id)
+            chain_name = self._security_group_chain_name(security_group_id)
+            ipv4_rules += ['-j $%s' % (chain_name,)]
+            ipv6_rules += ['-j $%s' % (chain_name,)]
 
-            for rule in rules:
-                LOG.debug(_('Adding security group rule: %r'), rule)
+        ipv4_rules += ['-j $sg-fallback']
+        ipv6_rules += ['-j $sg-fallback']
 
-                if not rule.cidr:
-                    version = 4
-                else:
-                    version = netutils.get_ip_version(rule.cidr)
+        return ipv4_rules, ipv6_rules
+
+    def _ensure_security_group_chain(self, ctxt, security_group_id):
+        """Render a security group into its chain, unless it already is.
+
+        Instances in the group jump to this one chain, so a group is only
+        expanded once per host however many of its instances live here.
+        """
+        if security_group_id in self.security_group_rules:
+            return
+        chain_name = self._security_group_chain_name(security_group_id)
+        self.iptables.ipv4['filter'].add_chain(chain_name)
+        if FLAGS.use_ipv6:
+            self.iptables.ipv6['filter'].add_chain(chain_name)
+        self._fill_security_group_chain(ctxt, security_group_id)
+
+    def _fill_security_group_chain(self, ctxt, security_group_id):
+        chain_name = self._security_group_chain_name(security_group_id)
+        ipv4_rules, ipv6_rules, grantee_ids = \
+                self._security_group_rules(ctxt, security_group_id)
+        self.security_group_rules[security_group_id] = (ipv4_rules,
+                                                        ipv6_rules)
+        for grantee_id in grantee_ids:
+            self.security_group_grantees.setdefault(grantee_id,
+                                                    set()).add(
+                                                        security_group_id)
+        self._add_filters(chain_name, ipv4_rules, ipv6_rules)
+
+    def _refill_security_group_chain(self, ctxt, security_group_id):
+        """Re-render a security group whose rules or grantees changed."""
+        chain_name = self._security_group_chain_name(security_group_id)
+        self.iptables.ipv4['filter'].empty_chain(chain_name)
+        if FLAGS.use_ipv6:
+            self.iptables.ipv6['filter'].empty_chain(chain_name)
+        for parent_ids in self.security_group_grantees.values():
+            parent_ids.discard(security_group_id)
+        self._fill_security_group_chain(ctxt, security_group_id)
+
+    def _remove_security_group_chain(self, security_group_id):
+        chain_name = self._security_group_chain_name(security_group_id)
+        self.iptables.ipv4['filter'].remove_chain(chain_name)
+        if FLAGS.use_ipv6:
+            self.iptables.ipv6['filter'].remove_chain(chain_name)
+        del self.security_group_rules[security_group_id]
+        for parent_ids in self.security_group_grantees.values():
+            parent_ids.discard(security_group_id)
+
+    def _security_group_rules(self, ctxt, security_group_id):
+        """Returns the ipv4 and ipv6 rules of a security group, and the ids
+        of the groups its rules grant access to."""
+        ipv4_rules = []
+        ipv6_rules = []
+        grantee_ids = set()
+        grantee_ips = {}
+
+        rules = db.security_group_rule_get_by_security_group(ctxt,
+                                                          security_group_id)
+
+        for rule in rules:
+            LOG.debug(_('Adding security group rule: %r'), rule)
+
+            if not rule.cidr:
+                version = 4
+            else:
+                version = netutils.get_ip_version(rule.cidr)
+
+            if version == 4:
+                fw_rules = ipv4_rules
+            else:
+                fw_rules = ipv6_rules
+
+            protocol = rule.protocol
+            if version == 6 and rule.protocol == 'icmp':
+                protocol = 'icmpv6'
+
+            args = ['-j ACCEPT']
+            if protocol:
+                args += ['-p', protocol]
 
-                if version == 4:
-                    fw_rules = ipv4_rules
+            if protocol in ['udp', 'tcp']:
+                if rule.from_port == rule.to_port:
+                    args += ['--dport', '%s' % (rule.from_port,)]
                 else:
-                    fw_rules = ipv6_rules
-
-                protocol = rule.protocol
-                if version == 6 and rule.protocol == 'icmp':
-                    protocol = 'icmpv6'
-
-                args = ['-j ACCEPT']
-                if protocol:
-                    args += ['-p', protocol]
-
-                if protocol in ['udp', 'tcp']:
-                    if rule.from_port == rule.to_port:
-                        args += ['--dport', '%s' % (rule.from_port,)]
-                    else:
-                        args += ['-m', 'multiport',
-                                 '--dports', '%s:%s' % (rule.from_port,
-                                                        rule.to_port)]
-                elif protocol == 'icmp':
-                    icmp_type = rule.from_port
-                    icmp_code = rule.to_port
-
-                    if icmp_type == -1:
-                        icmp_type_arg = None
-                    else:
-                        icmp_type_arg = '%s' % icmp_type
-                        if not icmp_code == -1:
-                            icmp_type_arg += '/%s' % icmp_code
-
-                    if icmp_type_arg:
-                        if version == 4:
-                            args += ['-m', 'icmp', '--icmp-type',
-                                     icmp_type_arg]
-                        elif version == 6:
-                            args += ['-m', 'icmp6', '--icmpv6-type',
-                                     icmp_type_arg]
-
-                if rule.cidr:
-                    LOG.info('Using cidr %r', rule.cidr)
-                    args += ['-s', rule.cidr]
-                    fw_rules += [' '.join(args)]
+                    args += ['-m', 'multiport',
+                             '--dports', '%s:%s' % (rule.from_port,
+                                                    rule.to_port)]
+            elif protocol == 'icmp':
+                icmp_type = rule.from_port
+                icmp_code = rule.to_port
+
+                if icmp_type == -1:
+                    icmp_type_arg = None
                 else:
-                    if rule['grantee_group']:
-                        for instance in rule['grantee_group']['instances']:
-                            LOG.info('instance: %r', instance)
-                            ips = db.instance_get_fixed_addresses(ctxt,
-                                                                instance['id'])
-                            LOG.info('ips: %r', ips)
-                            for ip in ips:
-                                subrule = args + ['-s %s' % ip]
-                                fw_rules += [' '.join(subrule)]
-
-                LOG.info('Using fw_rules: %r', fw_rules)
-        ipv4_rules += ['-j $sg-fallback']
-        ipv6_rules += ['-j $sg-fallback']
+                    icmp_type_arg = '%s' % icmp_type
+                    if not icmp_code == -1:
+                        icmp_type_arg += '/%s' % icmp_code
 
-        return ipv4_rules, ipv6_rules
+                if icmp_type_arg:
+                    if version == 4:
+                        args += ['-m', 'icmp', '--icmp-type',
+                                 icmp_type_arg]
+                    elif version == 6:
+                        args += ['-m', 'icmp6', '--icmpv6-type',
+                                 icmp_type_arg]
+
+            if rule.cidr:
+                LOG.info('Using cidr %r', rule.cidr)
+                args += ['-s', rule.cidr]
+                fw_rules += [' '.join(args)]
+            else:
+                if rule['grantee_group'] and FLAGS.firewall_use_ipset:
+                    grantee_id = rule['grantee_group']['id']
+                    grantee_ids.add(grantee_id)
+                    self._ensure_ipset(ctxt, rule['grantee_group'])
+                    args += ['-m set --match-set %s src' %
+                             self._security_group_set_name(grantee_id)]
+                    fw_rules += [' '.join(args)]
+                elif rule['grantee_group']:
+                    grantee_id = rule['grantee_group']['id']
+                    grantee_ids.add(grantee_id)
+                    if grantee_id not in grantee_ips:
+                        grantee_ips[grantee_id] = self._security_group_ips(
+                                ctxt, rule['grantee_group'])
+                    for ip in grantee_ips[grantee_id]:
+                        subrule = args + ['-s %s' % ip]
+                        fw_rules += [' '.join(subrule)]
+
+            LOG.info('Using fw_rules: %r', fw_rules)
+
+        return ipv4_rules, ipv6_rules, grantee_ids
+
+    def _security_group_ips(self, ctxt, security_group):
+        """Returns the fixed addresses of the members of a group."""
+        ips = []
+        for instance in security_group['instances']:
+            LOG.info('instance: %r', instance)
+            ips += db.instance_get_fixed_addresses(ctxt, instance['id'])
+        LOG.info('ips: %r', ips)
+        return ips
+
+    def _ensure_ipset(self, ctxt, security_group):
+        """Create and fill the ipset of a grantee group, unless it exists."""
+        if security_group['id'] in self.ipsets:
+            return
+        set_name = self._security_group_set_name(security_group['id'])
+        utils.execute('ipset', 'create', set_name, 'hash:ip', '-exist',
+                      run_as_root=True)
+        utils.execute('ipset', 'flush', set_name, run_as_root=True)
+        self.ipsets[security_group['id']] = set()
+        self._sync_ipset(ctxt, security_group)
+
+    def _sync_ipset(self, ctxt, security_group):
+        """Add and remove only the members which changed since the ipset
+        of a grantee group was last synced."""
+        set_name = self._security_group_set_name(security_group['id'])
+        current_ips = self.ipsets[security_group['id']]
+        ips = set(self._security_group_ips(ctxt, security_group))
+        for ip in ips - current_ips:
+            utils.execute('ipset', 'add', set_name, ip, '-exist',
+                          run_as_root=True)
+        for ip in current_ips - ips:
+            utils.execute('ipset', 'del', set_name, ip, '-exist',
+                          run_as_root=True)
+        self.ipsets[security_group['id']] = ips
+
+    def _destroy_unused_ipsets(self):
+        """Destroy the ipsets no rule refers to any more.
+
+        This has to wait until the rules referring to them are gone from
+        iptables, since the kernel refuses to destroy a set in use."""
+        if self.iptables.apply_deferred:
+            return
+        for grantee_id in self.ipsets.keys():
+            if self.security_group_grantees.get(grantee_id):
+                continue
+            utils.execute('ipset', 'destroy',
+                          self._security_group_set_name(grantee_id),
+                          run_as_root=True)
+            del self.ipsets[grantee_id]
 
     def instance_filter_exists(self, instance, network_info):
         """Check nova-instance-instance-xxx exists"""
         return self.nwfilter.instance_filter_exists(instance, network_info)
 
     def refresh_security_group_members(self, security_group):
-        self.do_refresh_security_group_rules(security_group)
+        self.do_refresh_security_group_members(security_group)
         self.iptables.apply()
 
     def refresh_security_group_rules(self, security_group):
         self.do_refresh_security_group_rules(security_group)
         self.iptables.apply()
+        self._destroy_unused_ipsets()
 
     @utils.synchronized('iptables', external=True)
     def do_refresh_security_group_rules(self, security_group):
-        for instance in self.instances.values():
-            self.remove_filters_for_instance(instance)
-            self.add_filters_for_instance(instance)
+        """Re-render the chain of a group whose rules changed.
+
+        Adding an instance to a group or removing it from one is signalled
+        by this refresh too, so the chains of the instances here which
+        joined or left the group are rebuilt.  Those of the others only
+        jump to the group chain and are left alone."""
+        ctxt = context.get_admin_context()
+        try:
+            group = db.security_group_get(ctxt, security_group)
+            member_ids = set(instance['id'] for instance in group.instances)
+        except exception.SecurityGroupNotFound:
+            member_ids = set()
+        # a group first rendered by a rebuild below is already up to date
+        rendered = security_group in self.security_group_rules
+        for instance_id, instance in self.instances.items():
+            was_member = security_group in self.instance_security_groups.get(
+                    instance_id, ())
+            if was_member != (instance_id in member_ids):
+                self._rebuild_instance_chain(instance)
+        if rendered and security_group in self.security_group_rules:
+            self._refill_security_group_chain(ctxt, security_group)
+
+    @utils.synchronized('iptables', external=True)
+    def do_refresh_security_group_members(self, security_group):
+        """Re-render the chains of the groups granting access to a group
+        which gained or lost members.
+
+        With FLAGS.firewall_use_ipset the rules only refer to the group's
+        ipset, so just the changed members are added to or removed from
+        it."""
+        ctxt = context.get_admin_context()
+        if FLAGS.firewall_use_ipset:
+            if security_group in self.ipsets:
+                self._sync_ipset(ctxt, db.security_group_get(ctxt,
+                                                             security_group))
+            return
+        parent_ids = self.security_group_grantees.get(security_group, ())
+        for security_group_id in list(parent_ids):
+            self._refill_security_group_chain(ctxt, security_group_id)
 
     def refresh_provider_fw_rules(self):
         """See class:FirewallDriver: docs."""
@@ -814,5 +1025,8 @@ class IptablesFirewallDriver(FirewallDriver):
     def _security_group_chain_name(self, security_group_id):
         return 'nova-sg-%s' % (security_group_id,)
 
+    def _security_group_set_name(self, security_group_id):
+        return 'nova-sg-%s' % (security_group_id,)
+
     def _instance_chain_name(self, instance):
         return 'inst-%s' % (instance['id'],)
@@ -0,0 +1,235 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Bookkeeping and eviction for the base images in instances_path/_base.
+
+Base images are shared by the instances of a host, either as the backing
+file of their qcow2 disks or as the source their disks were copied from.
+A base is in use while the disk of an instance on this host is backed by
+it; bases that are not in use are removed oldest first once they are older
+than image_cache_max_unused_age, or while the cache is larger than
+image_cache_max_size_mb.
+
+"""
+
+import lockfile
+import os
+import time
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+from nova import utils
+
+
+LOG = logging.getLogger('nova.virt.libvirt.imagecache')
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('image_cache_manager_interval', 0,
+                     'seconds between removals of unused base images, '
+                     '0 disables removing them')
+flags.DEFINE_integer('image_cache_max_size_mb', 0,
+                     'remove unused base images while _base is larger than '
+                     'this many megabytes, 0 for no limit')
+flags.DEFINE_integer('image_cache_max_unused_age', 24 * 3600,
+                     'remove base images unused for this many seconds, '
+                     '0 to only remove them to stay under '
+                     'image_cache_max_size_mb')
+flags.DEFINE_integer('image_cache_min_age', 600,
+                     'never remove base images used in the last '
+                     'this many seconds')
+
+
+def get_base_dir():
+    return os.path.join(FLAGS.instances_path, '_base')
+
+
+def base_lock(fname):
+    """Return a file lock for creating or removing the base image fname.
+
+    The lock files live in _base/locks, so the lock holds across every
+    process and host sharing instances_path.  It is taken inside the
+    in-process utils.synchronized(fname) lock.
+    """
+    lock_dir = os.path.join(get_base_dir(), 'locks')
+    if not os.path.exists(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(lock_dir):
+                raise
+    return lockfile.FileLock(os.path.join(lock_dir, fname))
+
+
+def get_backing_file(path):
+    """Return the backing file of a disk image, or None."""
+    out, err = utils.execute('qemu-img', 'info', path)
+    for line in out.split('\n'):
+        if line.startswith('backing file:'):
+            backing_file = line.split(':', 1)[1].strip()
+            if '(actual path:' in backing_file:
+                backing_file = backing_file.split('(actual path:')[1]
+                backing_file = backing_file.strip()[:-1]
+            return backing_file.split()[0]
+    return None
+
+
+class ImageCacheManager(object):
+    """Tracks hits on and removes unused base images."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.last_run = 0
+        # { <instance disk path> : <base path or None> }, a disk never
+        # changes its backing file so qemu-img only runs once per disk
+        self.backing_files = {}
+
+    def touch(self, base):
+        """Mark a base image as just used."""
+        try:
+            os.utime(base, None)
+        except OSError:
+            pass
+
+    def record_hit(self, base):
+        self.hits += 1
+        self.touch(base)
+
+    def record_miss(self, base):
+        self.misses += 1
+
+    def get_stats(self):
+        """Return the cache stats reported in the host capabilities."""
+        base_dir = get_base_dir()
+        count = 0
+        size = 0
+        if os.path.isdir(base_dir):
+            for fname in os.listdir(base_dir):
+                path = os.path.join(base_dir, fname)
+                if os.path.isfile(path):
+                    count += 1
+                    size += self._disk_usage(path)
+        return {'image_cache_hits': self.hits,
+                'image_cache_misses': self.misses,
+                'image_cache_evicted': self.evicted,
+                'image_cache_images': count,
+                'image_cache_size_mb': size // (1024 * 1024)}
+
+    @staticmethod
+    def _disk_usage(path):
+        # base images are mostly sparse, count what they really use
+        return os.stat(path).st_blocks * 512
+
+    def _used_bases(self):
+        """Return the base images backing the disks of local instances."""
+        used = set()
+        seen = set()
+        base_dir = get_base_dir()
+        for instance_dir in os.listdir(FLAGS.instances_path):
+            instance_path = os.path.join(FLAGS.instances_path, instance_dir)
+            if instance_path == base_dir or not os.path.isdir(instance_path):
+                continue
+            for fname in os.listdir(instance_path):
+                if not fname.startswith('disk'):
+                    continue
+                path = os.path.join(instance_path, fname)
+                seen.add(path)
+                if path not in self.backing_files:
+                    try:
+                        self.backing_files[path] = get_backing_file(path)
+                    except exception.ProcessExecutionError:
+                        # not an image qemu-img understands, so nothing
+                        # backs it
+                        self.backing_files[path] = None
+                backing_file = self.backing_files[path]
+                if backing_file:
+                    used.add(os.path.join(base_dir,
+                                          os.path.basename(backing_file)))
+        for path in self.backing_files.keys():
+            if path not in seen:
+                del self.backing_files[path]
+        return used
+
+    def _remove_base(self, path, mtime):
+        fname = os.path.basename(path)
+
+        @utils.synchronized(fname)
+        def remove_if_unchanged():
+            # NOTE: the locks are the ones _cache_image creates bases
+            #       under, and a base used since the scan has a new mtime
+            with base_lock(fname):
+                try:
+                    if os.stat(path).st_mtime != mtime:
+                        return False
+                except OSError:
+                    return False
+                os.unlink(path)
+                return True
+
+        if remove_if_unchanged():
+            LOG.info(_('Removed unused base image %s'), path)
+            self.evicted += 1
+            return True
+        return False
+
+    def verify_base_images(self):
+        """Remove unused base images that are too old or over budget."""
+        base_dir = get_base_dir()
+        if not os.path.isdir(base_dir):
+            return
+        used = self._used_bases()
+        now = time.time()
+        total = 0
+        candidates = []
+        for fname in os.listdir(base_dir):
+            path = os.path.join(base_dir, fname)
+            if not os.path.isfile(path):
+                continue
+            info = os.stat(path)
+            size = info.st_blocks * 512
+            total += size
+            if path in used:
+                continue
+            if now - info.st_mtime < FLAGS.image_cache_min_age:
+                continue
+            candidates.append((info.st_mtime, path, size))
+        candidates.sort()
+
+        budget = FLAGS.image_cache_max_size_mb * 1024 * 1024
+        max_age = FLAGS.image_cache_max_unused_age
+        for mtime, path, size in candidates:
+            too_old = max_age > 0 and now - mtime > max_age
+            over_budget = budget > 0 and total > budget
+            if not too_old and not over_budget:
+                # candidates are oldest first, so the rest are kept too
+                break
+            if self._remove_base(path, mtime):
+                total -= size
+        if budget > 0 and total > budget:
+            LOG.warn(_('Base images use %(total)d bytes, more than the '
+                       '%(budget)d allowed, but the rest are in use')
+                     % locals())
+
+    def periodic_verify(self):
+        """Run verify_base_images if image_cache_manager_interval passed."""
+        interval = FLAGS.image_cache_manager_interval
+        if interval <= 0 or time.time() - self.last_run < interval:
+            return
+        self.last_run = time.time()
+        self.verify_base_images()
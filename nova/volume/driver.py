@@ -20,10 +20,13 @@ Drivers for volumes.
 
 """
 
+import collections
 import os
 import time
 from xml.etree import ElementTree
 
+from eventlet import greenthread
+
 from nova import exception
 from nova import flags
 from nova import log as logging
@@ -49,6 +52,23 @@ flags.DEFINE_string('iscsi_ip_address', '$my_ip',
                     'use this ip for iscsi')
 flags.DEFINE_string('rbd_pool', 'rbd',
                     'the rbd pool in which volumes are stored')
+flags.DEFINE_boolean('volume_wipe_lazy', False,
+                     'rename deleted volumes and zero them out in the '
+                     'background instead of during delete_volume')
+flags.DEFINE_integer('volume_wipe_concurrency', 1,
+                     'number of volumes zeroed out at the same time')
+flags.DEFINE_integer('volume_wipe_chunk_mb', 1024,
+                     'megabytes zeroed out by each dd of a background wipe')
+flags.DEFINE_float('volume_wipe_interval', 0,
+                   'seconds to pause between chunks of a background wipe')
+flags.DEFINE_string('volume_wipe_ionice', '-c3',
+                    'ionice options for background wipes, empty to not '
+                    'use ionice')
+flags.DEFINE_string('volume_wipe_state_path', '$state_path/volume_wipes',
+                    'where the progress of background wipes is kept')
+
+# deleted volumes waiting to be zeroed out are renamed with this prefix
+WIPE_PREFIX = 'wipe-'
 
 
 class VolumeDriver(object):
@@ -57,6 +77,12 @@ class VolumeDriver(object):
         # NOTE(vish): db is set by Manager
         self.db = None
         self.set_execute(execute)
+        # background wipes: (<lv name>, <size in MB>) waiting for a worker,
+        # names being wiped and number of running workers
+        self._wipe_queue = collections.deque()
+        self._wiping = set()
+        self._wipe_workers = 0
+        self._wiped_count = 0
 
     def set_execute(self, execute):
         self._execute = execute
@@ -86,6 +112,8 @@ class VolumeDriver(object):
         if not FLAGS.volume_group in volume_groups:
             raise exception.Error(_("volume group %s doesn't exist")
                                   % FLAGS.volume_group)
+        if FLAGS.volume_wipe_lazy:
+            self._resume_wipes()
 
     def _create_volume(self, volume_name, sizestr):
         self._try_execute('lvcreate', '-L', sizestr, '-n',
@@ -115,6 +143,102 @@ class VolumeDriver(object):
                            self._escape_snapshot(volume['name'])),
                           run_as_root=True)
 
+    def _queue_wipe(self, volume, size_in_g):
+        """Rename a logical volume out of the way and wipe it later."""
+        wipe_name = WIPE_PREFIX + volume['name']
+        self._try_execute('lvrename', FLAGS.volume_group,
+                          volume['name'], wipe_name, run_as_root=True)
+        size_mb = int(size_in_g) * 1024 or 100
+        self._wipe_queue.append((wipe_name, size_mb))
+        self._start_wipe_workers()
+
+    def _resume_wipes(self):
+        """Queue the volumes a previous run did not finish wiping."""
+        out, err = self._execute('lvs', '--noheadings', '--nosuffix',
+                                 '--units', 'm', '-o', 'lv_name,lv_size',
+                                 FLAGS.volume_group, run_as_root=True)
+        queued = set(name for name, size_mb in self._wipe_queue)
+        for line in (out or '').splitlines():
+            fields = line.split()
+            if len(fields) != 2 or not fields[0].startswith(WIPE_PREFIX):
+                continue
+            name = fields[0]
+            if name in queued or name in self._wiping:
+                continue
+            self._wipe_queue.append((name, int(float(fields[1]))))
+        if self._wipe_queue:
+            LOG.info(_("Resuming wipe of %d deleted volumes"),
+                     len(self._wipe_queue))
+            self._start_wipe_workers()
+
+    def _start_wipe_workers(self):
+        while (self._wipe_workers < FLAGS.volume_wipe_concurrency and
+               len(self._wipe_queue) > self._wipe_workers):
+            self._wipe_workers += 1
+            greenthread.spawn(self._wipe_worker)
+
+    def _wipe_worker(self):
+        try:
+            while self._wipe_queue:
+                name, size_mb = self._wipe_queue.popleft()
+                self._wiping.add(name)
+                try:
+                    self._wipe_volume(name, size_mb)
+                    self._wiped_count += 1
+                except Exception:
+                    # NOTE: the volume keeps its name so the wipe is
+                    #       retried the next time the service starts
+                    LOG.exception(_("Failed to wipe deleted volume %s"),
+                                  name)
+                finally:
+                    self._wiping.discard(name)
+        finally:
+            self._wipe_workers -= 1
+
+    def _wipe_state_file(self, name):
+        return os.path.join(FLAGS.volume_wipe_state_path, name)
+
+    def _wipe_volume(self, name, size_mb):
+        """Zero out a renamed volume in chunks, then remove it.
+
+        The offset reached is saved after every chunk so a restarted
+        service carries on where it stopped."""
+        if not os.path.exists(FLAGS.volume_wipe_state_path):
+            os.makedirs(FLAGS.volume_wipe_state_path)
+        state_file = self._wipe_state_file(name)
+        offset = 0
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                offset = int(f.read().strip() or 0)
+        ionice = []
+        if FLAGS.volume_wipe_ionice:
+            ionice = ['ionice'] + FLAGS.volume_wipe_ionice.split()
+        path = self.local_path({'name': name})
+        LOG.debug(_("Wiping deleted volume %(name)s from %(offset)dM of "
+                    "%(size_mb)dM") % locals())
+        while offset < size_mb:
+            count = min(FLAGS.volume_wipe_chunk_mb, size_mb - offset)
+            command = ionice + ['dd', 'if=/dev/zero', 'of=%s' % path,
+                                'bs=1M', 'seek=%d' % offset,
+                                'count=%d' % count]
+            self._execute(*command, run_as_root=True)
+            offset += count
+            with open(state_file, 'w') as f:
+                f.write(str(offset))
+            greenthread.sleep(FLAGS.volume_wipe_interval)
+        self._try_execute('lvremove', '-f',
+                          '%s/%s' % (FLAGS.volume_group, name),
+                          run_as_root=True)
+        os.unlink(state_file)
+
+    def get_wipe_stats(self):
+        """Return the backlog of background wipes."""
+        return {'queued': len(self._wipe_queue),
+                'queued_mb': sum(size_mb for name, size_mb
+                                 in self._wipe_queue),
+                'wiping': len(self._wiping),
+                'wiped': self._wiped_count}
+
     def _sizestr(self, size_in_g):
         if int(size_in_g) == 0:
             return '100M'
@@ -157,7 +281,10 @@ class VolumeDriver(object):
             if (out[0] == 'o') or (out[0] == 'O'):
                 raise exception.VolumeIsBusy(volume_name=volume['name'])
 
-        self._delete_volume(volume, volume['size'])
+        if FLAGS.volume_wipe_lazy:
+            self._queue_wipe(volume, volume['size'])
+        else:
+            self._delete_volume(volume, volume['size'])
 
     def create_snapshot(self, snapshot):
         """Creates a snapshot."""
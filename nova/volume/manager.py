@@ -288,6 +288,17 @@ class VolumeManager(manager.SchedulerDependentManager):
                         unicode(ex))
             error_list.append(ex)
 
+        try:
+            wipe_stats = self.driver.get_wipe_stats()
+            if wipe_stats['queued'] or wipe_stats['wiping']:
+                LOG.info(_("Deleted volumes waiting to be wiped: %(queued)d "
+                           "(%(queued_mb)dM), being wiped: %(wiping)d, "
+                           "wiped: %(wiped)d") % wipe_stats)
+        except Exception as ex:
+            LOG.warning(_("Error during get_wipe_stats(): %s"),
+                        unicode(ex))
+            error_list.append(ex)
+
         super(VolumeManager, self).periodic_tasks(context)
 
         return error_list
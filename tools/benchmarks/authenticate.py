@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Times signed ec2 requests through Authenticate with and without the
+auth cache.
+
+A temporary user and project are created with the configured auth driver
+and removed afterwards.
+
+Usage: authenticate.py [<flags>] [<number of requests>]
+"""
+
+import gettext
+import os
+import sys
+import time
+import urllib
+
+# If ../../nova/__init__.py exists, add ../../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'nova', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+gettext.install('nova', unicode=1)
+
+import webob
+import webob.dec
+
+from nova import flags
+from nova.api import ec2
+from nova.auth import manager
+from nova.auth import signer
+
+
+FLAGS = flags.FLAGS
+
+
+@webob.dec.wsgify
+def project_app(req):
+    return req.environ['nova.context'].project_id
+
+
+def signed_request(access, secret):
+    params = {'AWSAccessKeyId': access,
+              'Action': 'DescribeRegions',
+              'SignatureMethod': 'HmacSHA256',
+              'SignatureVersion': '2',
+              'Timestamp': '2011-10-01T12:00:00',
+              'Version': '2009-11-30'}
+    params['Signature'] = signer.Signer(secret).generate(
+            params, 'GET', 'localhost:8773', '/services/Cloud/')
+    req = webob.Request.blank('/services/Cloud/?' + urllib.urlencode(params))
+    req.host = 'localhost:8773'
+    return req
+
+
+def main(argv):
+    argv = FLAGS(argv)
+    count = len(argv) > 1 and int(argv[1]) or 200
+    authman = manager.AuthManager()
+    user = authman.create_user('authbench', 'authbench', 'authbench')
+    project = authman.create_project('authbench', user)
+    app = ec2.Authenticate(project_app)
+    try:
+        for ttl in (0, 60):
+            FLAGS.auth_cache_ttl = ttl
+            authman.cache.clear()
+            start = time.time()
+            for i in xrange(count):
+                res = signed_request('authbench:authbench',
+                                     'authbench').get_response(app)
+                if res.status_int != 200:
+                    print 'Request failed: %s' % res.status
+                    return 1
+            elapsed = time.time() - start
+            print ('%d requests with auth_cache_ttl=%d: '
+                   '%.1f requests/second' % (count, ttl, count / elapsed))
+    finally:
+        authman.delete_project(project)
+        authman.delete_user(user)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Times JsonFilter queries, compiled and interpreted, over many hosts.
+
+Usage: json_filter.py [<number of hosts> ...]
+"""
+
+import gettext
+import json
+import os
+import sys
+import time
+
+# If ../../nova/__init__.py exists, add ../../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'nova', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+gettext.install('nova', unicode=1)
+
+from nova.scheduler import filters
+
+
+QUERY = json.dumps(['or',
+                       ['and',
+                           ['<', '$compute.host_memory_free', 30],
+                           ['<', '$compute.disk_available', 300]],
+                       ['and',
+                           ['>', '$compute.host_memory_free', 70],
+                           ['>', '$compute.disk_available', 700]]])
+
+
+def host_list(num_hosts):
+    return [('host%05d' % x,
+             {'compute': {'host_memory_free': 10 + (x % 10) * 10,
+                          'disk_available': 100 + (x % 10) * 100,
+                          'enabled': True}})
+            for x in xrange(num_hosts)]
+
+
+def interpreted_filter_hosts(hf, hosts, query):
+    """JsonFilter.filter_hosts() without compiling the query."""
+    expanded = json.loads(query)
+    filtered_hosts = []
+    for host, capabilities in hosts:
+        result = hf._process_filter(expanded, host, capabilities)
+        if isinstance(result, list):
+            result = any(result)
+        if result:
+            filtered_hosts.append((host, capabilities))
+    return filtered_hosts
+
+
+def main(argv):
+    hf = filters.JsonFilter()
+    for num_hosts in [int(arg) for arg in argv[1:]] or [1000, 10000]:
+        hosts = host_list(num_hosts)
+
+        start = time.time()
+        expected = interpreted_filter_hosts(hf, hosts, QUERY)
+        interpreted = time.time() - start
+
+        start = time.time()
+        filtered = hf.filter_hosts(hosts, QUERY)
+        compiled = time.time() - start
+
+        assert filtered == expected
+        print ('%(num_hosts)d hosts: interpreted %(interpreted).4fs, '
+               'compiled %(compiled).4fs' % locals())
+
+
+if __name__ == '__main__':
+    main(sys.argv)
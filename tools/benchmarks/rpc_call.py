@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Times kombu rpc calls with and without the shared reply queue.
+
+Usage: rpc_call.py [--fake_rabbit] [<flags>] [<number of calls>]
+
+The calls are answered by a consumer in this process, through the broker
+the rabbit flags point at, or in memory with --fake_rabbit.
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import gettext
+import os
+import sys
+import time
+
+# If ../../nova/__init__.py exists, add ../../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'nova', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+gettext.install('nova', unicode=1)
+
+from eventlet import greenpool
+
+from nova import context
+from nova import flags
+from nova.rpc import impl_kombu
+
+
+FLAGS = flags.FLAGS
+TOPIC = 'rpc_benchmark'
+
+
+class Echo(object):
+    def echo(self, context, value):
+        return value
+
+
+def time_calls(calls, concurrency=10):
+    ctxt = context.get_admin_context()
+
+    def _call(value):
+        return impl_kombu.call(ctxt, TOPIC, {'method': 'echo',
+                                             'args': {'value': value}})
+
+    pool = greenpool.GreenPool(concurrency)
+    start = time.time()
+    results = list(pool.imap(_call, xrange(calls)))
+    elapsed = time.time() - start
+    assert results == range(calls)
+    return elapsed
+
+
+def main(argv):
+    argv = FLAGS(argv)
+    calls = len(argv) > 1 and int(argv[1]) or 200
+    conn = impl_kombu.create_connection(True)
+    conn.create_consumer(TOPIC, Echo(), False)
+    conn.consume_in_thread()
+    try:
+        for reply_proxy in (False, True):
+            FLAGS.rpc_reply_proxy = reply_proxy
+            elapsed = time_calls(calls)
+            print ('%d calls with rpc_reply_proxy=%s: %.1f calls/second'
+                   % (calls, reply_proxy, calls / elapsed))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Times serializing a scheduler message with utils.dumps and envelopes.
+
+Usage: rpc_envelope.py [<flags>] [<number of messages>]
+"""
+
+import gettext
+import os
+import sys
+import time
+
+# If ../../nova/__init__.py exists, add ../../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'nova', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+gettext.install('nova', unicode=1)
+
+from nova import flags
+from nova import utils
+from nova.rpc import envelope
+
+
+FLAGS = flags.FLAGS
+
+
+class FakeModel(object):
+    def __init__(self, **kwargs):
+        self.values = kwargs
+
+    def iteritems(self):
+        return self.values.iteritems()
+
+
+def run_instance_message():
+    now = utils.utcnow()
+    spec = {'instance_properties': dict(('key%d' % i, now)
+                                        for i in xrange(50)),
+            'instance_type': dict(('flavor%d' % i, i) for i in xrange(50))}
+    return {'method': 'run_instance',
+            'args': {'request_spec': spec,
+                     'hosts': [FakeModel(id=i, updated_at=now)
+                               for i in xrange(50)]}}
+
+
+def main(argv):
+    argv = FLAGS(argv)
+    count = len(argv) > 1 and int(argv[1]) or 200
+    msg = run_instance_message()
+
+    start = time.time()
+    for i in xrange(count):
+        utils.dumps(msg)
+    legacy = time.time() - start
+
+    start = time.time()
+    for i in xrange(count):
+        envelope.serialize(msg)
+    enveloped = time.time() - start
+
+    print ('Serialized %(count)d messages: %(legacy).3fs with utils.dumps, '
+           '%(enveloped).3fs with envelopes' % locals())
+
+
+if __name__ == '__main__':
+    main(sys.argv)